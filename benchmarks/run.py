@@ -0,0 +1,361 @@
+"""Throughput benchmarks of the PPO training hot paths, with a regression check against a saved baseline.
+
+Unlike charts/SPS during training, each piece of the learner is timed on its own and the full PPO iteration runs on the
+SO100PushCubeNullPhysics-v1 stand-in env, so no simulator cost is included. Benchmarks run on CPU and on the GPU when one is available.
+
+python -m benchmarks.run --output benchmarks/baseline.json
+python -m benchmarks.run --baseline benchmarks/baseline.json --threshold 0.1
+
+The second command exits with a non-zero status if any benchmark's throughput dropped by more than 10% compared to the baseline.
+Results are only comparable between runs on the same machine.
+"""
+from dataclasses import asdict, dataclass, field, replace
+import json
+import platform
+import sys
+import time
+from typing import Callable, Dict, List, Literal, Optional
+
+import numpy as np
+import torch
+import torch.optim as optim
+import tyro
+
+from benchmarks.gae import make_rollout, timeit
+from lerobot_sim2real.envs.null_physics import NullPhysicsVectorEnv
+from lerobot_sim2real.rl.gae import compute_gae
+from lerobot_sim2real.rl.ppo_rgb import Agent, DictArray, ImageStem, MinibatchStagingBuffer, NatureCNN, PPOArgs, update
+
+
+@dataclass
+class Args:
+    devices: Optional[List[str]] = None
+    """devices to benchmark on. Defaults to the CPU and the GPU when one is available"""
+    benchmarks: Optional[List[str]] = None
+    """only run benchmarks whose name starts with one of these prefixes, e.g. nature_cnn gae"""
+    num_envs: int = 64
+    """number of parallel environments for the rollout sized benchmarks"""
+    num_steps: int = 32
+    """rollout length for the rollout sized benchmarks"""
+    num_minibatches: int = 4
+    """number of minibatches the rollout is split into"""
+    update_epochs: int = 2
+    """number of update epochs in the full PPO iteration benchmark"""
+    batch_sizes: List[int] = field(default_factory=lambda: [32, 256])
+    """batch sizes for the network benchmarks"""
+    image_sizes: List[int] = field(default_factory=lambda: [64, 128])
+    """square image sizes for the network benchmarks"""
+    precisions: List[Literal["float32", "bfloat16", "float16"]] = field(default_factory=lambda: ["float32", "bfloat16"])
+    """autocast dtypes the network benchmarks are run with, see PPOArgs.amp_dtype"""
+    channels_last: bool = False
+    """if toggled, the network benchmarks use channels_last conv weights, see PPOArgs.channels_last"""
+    repeats: int = 10
+    """number of timed calls per benchmark, after one warmup call"""
+    seed: int = 0
+    output: Optional[str] = None
+    """if given, the results are saved to this JSON file"""
+    baseline: Optional[str] = None
+    """a JSON file saved by a previous run to compare against"""
+    threshold: float = 0.1
+    """a benchmark regresses if its throughput drops by more than this fraction of the baseline"""
+
+
+@dataclass
+class Benchmark:
+    name: str
+    fn: Callable[[], None]
+    items: int
+    """number of samples processed per call of fn, throughput is reported in items per second"""
+    measure_memory: bool = False
+    """if True, the memory allocated by one call of fn is also reported, see allocated_bytes"""
+
+
+def allocated_bytes(fn: Callable[[], None], device: torch.device):
+    """on CUDA the peak memory allocated by fn above what was allocated before, on CPU the total size of all allocations made by fn"""
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - before
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+
+
+def make_obs_space(image_size: int, state_dim: int = 18):
+    return NullPhysicsVectorEnv(1, image_size=(image_size, image_size), state_dim=state_dim).single_observation_space
+
+
+def random_obs(obs_space, batch_size: int, device: torch.device):
+    return dict(
+        state=torch.randn((batch_size,) + obs_space["state"].shape, device=device),
+        rgb=torch.randint(0, 256, (batch_size,) + obs_space["rgb"].shape, dtype=torch.uint8, device=device),
+    )
+
+
+def network_variants(args: Args, device: torch.device):
+    """yields the name suffix and autocast context for every precision in args.precisions"""
+    layout = "/channels_last" if args.channels_last else ""
+    for precision in args.precisions:
+        suffix = layout if precision == "float32" else f"/{precision}{layout}"
+        dtype = getattr(torch, precision)
+        yield suffix, lambda: torch.autocast(device.type, dtype=dtype, enabled=dtype != torch.float32)
+
+
+def to_memory_format(module: torch.nn.Module, args: Args):
+    return module.to(memory_format=torch.channels_last) if args.channels_last else module
+
+
+def dict_array_benchmarks(args: Args, device: torch.device):
+    obs_space = make_obs_space(128)
+    obs = DictArray((args.num_steps, args.num_envs), obs_space, device=device)
+    step_obs = random_obs(obs_space, args.num_envs, device)
+
+    def write():
+        for step in range(args.num_steps):
+            obs[step] = step_obs
+
+    batch_size = args.num_steps * args.num_envs
+    yield Benchmark("dict_array_write", write, batch_size)
+    yield Benchmark("dict_array_reshape", lambda: obs.reshape((-1,)), batch_size)
+
+
+def minibatch_gather_benchmarks(args: Args, device: torch.device):
+    obs_space = make_obs_space(128)
+    batch_size = args.num_steps * args.num_envs
+    minibatch_size = batch_size // args.num_minibatches
+    b_obs = DictArray((batch_size,), None, data_dict=random_obs(obs_space, batch_size, device))
+
+    def gather():
+        b_inds = torch.randperm(batch_size, device=device)
+        for start in range(0, batch_size, minibatch_size):
+            b_obs[b_inds[start:start + minibatch_size]]
+
+    yield Benchmark("minibatch_gather", gather, batch_size)
+
+    # every rollout tensor the update reads, gathered per minibatch or staged once per epoch with permuted_minibatches
+    rollout_batch = (b_obs,) + tuple(torch.randn(batch_size, device=device) for _ in range(4)) + (torch.randn(batch_size, 6, device=device),)
+    staging_buffer = MinibatchStagingBuffer(rollout_batch)
+
+    def gather_all_fancy_index():
+        b_inds = torch.randperm(batch_size, device=device)
+        for start in range(0, batch_size, minibatch_size):
+            mb_inds = b_inds[start:start + minibatch_size]
+            for x in rollout_batch:
+                x[mb_inds]
+
+    def gather_all_staged():
+        staged = staging_buffer.gather(torch.randperm(batch_size, device=device), rollout_batch)
+        for start in range(0, batch_size, minibatch_size):
+            for x in staged:
+                x[start:start + minibatch_size]
+
+    yield Benchmark("minibatch_gather_all/fancy_index", gather_all_fancy_index, batch_size)
+    yield Benchmark("minibatch_gather_all/staged", gather_all_staged, batch_size)
+
+
+def nature_cnn_benchmarks(args: Args, device: torch.device):
+    for image_size in args.image_sizes:
+        obs_space = make_obs_space(image_size)
+        net = to_memory_format(NatureCNN(random_obs(obs_space, 1, "cpu")).to(device), args)
+        for batch_size in args.batch_sizes:
+            x = random_obs(obs_space, batch_size, device)
+            for suffix, autocast in network_variants(args, device):
+                def forward():
+                    with torch.no_grad(), autocast():
+                        net(x)
+
+                def forward_backward():
+                    net.zero_grad()
+                    with autocast():
+                        features = net(x)
+                    features.float().sum().backward()
+
+                yield Benchmark(f"nature_cnn_forward/img={image_size}/bs={batch_size}{suffix}", forward, batch_size)
+                yield Benchmark(f"nature_cnn_forward_backward/img={image_size}/bs={batch_size}{suffix}", forward_backward, batch_size)
+
+
+def image_stem_benchmarks(args: Args, device: torch.device):
+    """the first conv layer's forward and backward on one minibatch, with the frames normalized beforehand (as NatureCNN used to)
+    and taken as uint8 by the ImageStem"""
+    minibatch_size = args.num_steps * args.num_envs // args.num_minibatches
+    for image_size in args.image_sizes:
+        x = random_obs(make_obs_space(image_size), minibatch_size, device)["rgb"]
+        stem = ImageStem(3, 32, kernel_size=8, stride=4).to(device)
+        reference = torch.nn.Conv2d(3, 32, kernel_size=8, stride=4).to(device)
+        reference.load_state_dict(stem.state_dict())
+
+        def normalize_then_conv():
+            reference.zero_grad()
+            reference(x.float().permute(0, 3, 1, 2) / 255).sum().backward()
+
+        def uint8_stem():
+            stem.zero_grad()
+            stem(x).sum().backward()
+
+        yield Benchmark(f"image_stem/normalize_then_conv/img={image_size}", normalize_then_conv, minibatch_size, measure_memory=True)
+        yield Benchmark(f"image_stem/uint8/img={image_size}", uint8_stem, minibatch_size, measure_memory=True)
+
+
+def get_action_and_value_benchmarks(args: Args, device: torch.device):
+    env = NullPhysicsVectorEnv(1)
+    for batch_size in args.batch_sizes:
+        x = random_obs(env.single_observation_space, batch_size, device)
+        agent = to_memory_format(Agent(env, sample_obs=random_obs(env.single_observation_space, 1, "cpu")).to(device), args)
+        for suffix, autocast in network_variants(args, device):
+            def get_action_and_value():
+                with torch.no_grad(), autocast():
+                    agent.get_action_and_value(x)
+
+            yield Benchmark(f"get_action_and_value/bs={batch_size}{suffix}", get_action_and_value, batch_size)
+
+
+def gae_benchmarks(args: Args, device: torch.device):
+    rollout = make_rollout(args.num_steps, args.num_envs, 0.02, str(device))
+    for finite_horizon_gae in [False, True]:
+        def gae():
+            compute_gae(**rollout, gamma=PPOArgs.gamma, gae_lambda=PPOArgs.gae_lambda, finite_horizon_gae=finite_horizon_gae)
+        yield Benchmark(f"gae/finite_horizon={finite_horizon_gae}", gae, args.num_steps * args.num_envs)
+
+
+def ppo_iteration_benchmarks(args: Args, device: torch.device):
+    """one rollout, GAE and update of ppo_rgb.train with its default settings on the null-physics env, and the update on its own. The
+    update is ppo_rgb.update, the function train runs"""
+    ppo = PPOArgs(num_envs=args.num_envs, num_steps=args.num_steps, num_minibatches=args.num_minibatches, update_epochs=args.update_epochs)
+    ppo.batch_size = args.num_steps * args.num_envs
+    ppo.minibatch_size = ppo.batch_size // args.num_minibatches
+    envs = NullPhysicsVectorEnv(args.num_envs, device=device, seed=args.seed)
+    next_obs, _ = envs.reset()
+    agent = Agent(envs, sample_obs=next_obs).to(device)
+    optimizer = optim.Adam(agent.parameters(), lr=ppo.learning_rate, eps=1e-5)
+    scaler = torch.amp.GradScaler(device.type, enabled=False)
+    obs = DictArray((args.num_steps, args.num_envs), envs.single_observation_space, device=device)
+    actions = torch.zeros((args.num_steps, args.num_envs) + envs.single_action_space.shape, device=device)
+    logprobs = torch.zeros((args.num_steps, args.num_envs), device=device)
+    rewards = torch.zeros((args.num_steps, args.num_envs), device=device)
+    dones = torch.zeros((args.num_steps, args.num_envs), device=device)
+    values = torch.zeros((args.num_steps, args.num_envs), device=device)
+    state = dict(next_obs=next_obs, next_done=torch.zeros(args.num_envs, device=device), staging_buffer=None)
+
+    def rollout():
+        """collects a rollout and returns it flattened the way train passes it to update"""
+        final_values = torch.zeros((args.num_steps, args.num_envs), device=device)
+        next_obs, next_done = state["next_obs"], state["next_done"]
+        agent.eval()
+        for step in range(args.num_steps):
+            obs[step] = next_obs
+            dones[step] = next_done
+            with torch.no_grad():
+                action, logprob, _, value = agent.get_action_and_value(next_obs)
+            values[step] = value.flatten()
+            actions[step] = action
+            logprobs[step] = logprob
+            next_obs, reward, terminations, truncations, infos = envs.step(action)
+            next_done = torch.logical_or(terminations, truncations).to(torch.float32)
+            rewards[step] = reward
+            if "final_info" in infos:
+                done_mask = infos["_final_info"]
+                with torch.no_grad():
+                    final_obs = {k: v[done_mask] for k, v in infos["final_observation"].items()}
+                    final_values[step, torch.arange(args.num_envs, device=device)[done_mask]] = agent.get_value(final_obs).view(-1)
+        state.update(next_obs=next_obs, next_done=next_done)
+        with torch.no_grad():
+            next_value = agent.get_value(next_obs).reshape(1, -1)
+            advantages = compute_gae(rewards, values, dones, final_values, next_value, next_done, gamma=ppo.gamma, gae_lambda=ppo.gae_lambda)
+            returns = advantages + values
+        b_actions = actions.reshape((-1,) + envs.single_action_space.shape)
+        return obs.reshape((-1,)), logprobs.reshape(-1), b_actions, advantages.reshape(-1), returns.reshape(-1), values.reshape(-1)
+
+    def run_update(rollout_batch, ppo):
+        _, _, state["staging_buffer"] = update(agent, optimizer, scaler, ppo, rollout_batch, state["staging_buffer"])
+
+    permuted = replace(ppo, permuted_minibatches=True)
+    yield Benchmark("ppo_iteration", lambda: run_update(rollout(), ppo), ppo.batch_size)
+    yield Benchmark("ppo_iteration/permuted_minibatches", lambda: run_update(rollout(), permuted), ppo.batch_size)
+    rollout_batch = rollout()
+    yield Benchmark("ppo_update", lambda: run_update(rollout_batch, ppo), ppo.batch_size)
+    yield Benchmark("ppo_update/permuted_minibatches", lambda: run_update(rollout_batch, permuted), ppo.batch_size)
+
+
+BENCHMARKS = [
+    dict_array_benchmarks,
+    minibatch_gather_benchmarks,
+    nature_cnn_benchmarks,
+    image_stem_benchmarks,
+    get_action_and_value_benchmarks,
+    gae_benchmarks,
+    ppo_iteration_benchmarks,
+]
+
+
+def run_benchmarks(args: Args) -> Dict[str, dict]:
+    devices = args.devices
+    if devices is None:
+        devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+    results = {}
+    for device in devices:
+        device = torch.device(device)
+        for make_benchmarks in BENCHMARKS:
+            torch.manual_seed(args.seed)
+            np.random.seed(args.seed)
+            for benchmark in make_benchmarks(args, device):
+                name = f"{device.type}/{benchmark.name}"
+                if args.benchmarks is not None and not any(benchmark.name.startswith(prefix) for prefix in args.benchmarks):
+                    continue
+                seconds = timeit(benchmark.fn, args.repeats, str(device))
+                results[name] = dict(time_ms=seconds * 1e3, throughput=benchmark.items / seconds)
+                memory = ""
+                if benchmark.measure_memory:
+                    results[name]["allocated_mb"] = allocated_bytes(benchmark.fn, device) / 2**20
+                    memory = f" {results[name]['allocated_mb']:.1f}MB allocated"
+                print(f"{name}: {seconds * 1e3:.3f}ms {benchmark.items / seconds:,.0f} items/s{memory}")
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float):
+    """prints the throughput of every benchmark relative to the baseline and returns the names of those that regressed"""
+    regressions = []
+    print(f"\n{'benchmark':<60} {'baseline':>14} {'current':>14} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<60} {'-':>14} {result['throughput']:>14,.0f} {'new':>8}")
+            continue
+        change = result["throughput"] / baseline[name]["throughput"] - 1
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<60} {baseline[name]['throughput']:>14,.0f} {result['throughput']:>14,.0f} {change:>+8.1%}{' REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(args: Args):
+    results = run_benchmarks(args)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(
+                metadata=dict(
+                    time=time.strftime("%Y-%m-%d %H:%M:%S"),
+                    torch_version=torch.__version__,
+                    platform=platform.platform(),
+                    processor=platform.processor(),
+                    cuda_device=torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+                    args=asdict(args),
+                ),
+                results=results,
+            ), f, indent=2)
+        print(f"results saved to {args.output}")
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    main(args)
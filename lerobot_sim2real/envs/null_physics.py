@@ -0,0 +1,139 @@
+"""A stand-in vector environment with no physics or rendering, for benchmarking and regression testing the PPO learner on machines without a GPU.
+
+`NullPhysicsVectorEnv` has the same observation and action spaces as SO100PushCube-v1 after `FlattenRGBDObservationWrapper` (a 128x128x3 uint8
+"rgb" image, a float "state" vector and a 6 dimensional action) and behaves like it does after being wrapped by `ManiSkillVectorEnv`: it auto
+resets finished episodes and returns "final_info" / "final_observation" entries along with the recorded episode metrics.
+
+Observations are drawn from a small bank of synthetic frames. Each frame has a target action and the reward is 1 - tanh(|action - target|),
+so a policy can still learn something, but none of the cost of simulation or rendering is included.
+
+It is registered as SO100PushCubeNullPhysics-v1 and can be created with
+`gym.make_vec("SO100PushCubeNullPhysics-v1", num_envs=..., vectorization_mode="vector_entry_point")` or trained on directly with
+`python lerobot_sim2real/scripts/train_ppo_rgb.py --env-id SO100PushCubeNullPhysics-v1`.
+"""
+from typing import Optional, Sequence
+
+import gymnasium as gym
+import numpy as np
+import torch
+from gymnasium.vector.utils import batch_space
+
+
+class NullPhysicsVectorEnv(gym.vector.VectorEnv):
+    """
+    Args:
+        num_envs: number of parallel environments
+        max_episode_steps: episode length, episodes are truncated after this many steps
+        image_size: height and width of the synthetic rgb frames
+        state_dim: size of the state vector. The default matches SO100PushCube-v1 with the pd_joint_target_delta_pos controller
+        action_dim: size of the action vector
+        num_frames: number of distinct synthetic frames to cycle through
+        success_threshold: the episode counts as a success when the action is within this distance of the frame's target action
+        ignore_terminations: same as in ManiSkillVectorEnv, if True episodes only end by truncation
+        device: device the observations and rewards are created on
+        seed: seed used to generate the synthetic frames
+    """
+    metadata = {"autoreset_mode": gym.vector.AutoresetMode.SAME_STEP}
+
+    def __init__(
+        self,
+        num_envs: int = 1,
+        max_episode_steps: int = 64,
+        image_size: Sequence[int] = (128, 128),
+        state_dim: int = 18,
+        action_dim: int = 6,
+        num_frames: int = 32,
+        success_threshold: float = 0.25,
+        ignore_terminations: bool = False,
+        device: Optional[torch.device] = None,
+        seed: int = 0,
+    ):
+        self.num_envs = num_envs
+        self.max_episode_steps = max_episode_steps
+        self.num_frames = num_frames
+        self.success_threshold = success_threshold
+        self.ignore_terminations = ignore_terminations
+        self.device = torch.device("cpu") if device is None else torch.device(device)
+
+        self.single_observation_space = gym.spaces.Dict(
+            state=gym.spaces.Box(-np.inf, np.inf, shape=(state_dim,), dtype=np.float32),
+            rgb=gym.spaces.Box(0, 255, shape=(*image_size, 3), dtype=np.uint8),
+        )
+        self.single_action_space = gym.spaces.Box(-1, 1, shape=(action_dim,), dtype=np.float32)
+        self.observation_space = batch_space(self.single_observation_space, n=num_envs)
+        self.action_space = batch_space(self.single_action_space, n=num_envs)
+
+        self._generator = torch.Generator(device=self.device).manual_seed(seed)
+        self._frames = torch.randint(0, 256, (num_frames, *image_size, 3), dtype=torch.uint8, device=self.device, generator=self._generator)
+        self._states = torch.randn((num_frames, state_dim), device=self.device, generator=self._generator)
+        self._target_actions = torch.rand((num_frames, action_dim), device=self.device, generator=self._generator) * 2 - 1
+
+        self._frame_idx = torch.zeros(num_envs, dtype=torch.long, device=self.device)
+        self.elapsed_steps = torch.zeros(num_envs, dtype=torch.int32, device=self.device)
+        self.returns = torch.zeros(num_envs, device=self.device)
+        self.success_once = torch.zeros(num_envs, dtype=torch.bool, device=self.device)
+
+    def _get_obs(self):
+        return dict(state=self._states[self._frame_idx], rgb=self._frames[self._frame_idx])
+
+    def _reset_envs(self, mask: torch.Tensor):
+        new_frame_idx = torch.randint(0, self.num_frames, (self.num_envs,), device=self.device, generator=self._generator)
+        self._frame_idx = torch.where(mask, new_frame_idx, self._frame_idx)
+        self.elapsed_steps[mask] = 0
+        self.returns[mask] = 0
+        self.success_once[mask] = False
+
+    def reset(self, *, seed: Optional[int] = None, options: Optional[dict] = None):
+        if seed is not None:
+            self._generator.manual_seed(seed)
+        self._reset_envs(torch.ones(self.num_envs, dtype=torch.bool, device=self.device))
+        return self._get_obs(), dict()
+
+    def step(self, actions):
+        actions = torch.as_tensor(actions, dtype=torch.float32, device=self.device).reshape(self.num_envs, -1)
+        distance = torch.linalg.norm(actions - self._target_actions[self._frame_idx], dim=1)
+        reward = 1 - torch.tanh(distance)
+        success = distance < self.success_threshold
+
+        self.elapsed_steps += 1
+        self._frame_idx = (self._frame_idx + 1) % self.num_frames
+        self.returns += reward
+        self.success_once |= success
+        obs = self._get_obs()
+
+        episode_info = {
+            "success_once": self.success_once.clone(),
+            "return": self.returns.clone(),
+            "episode_len": self.elapsed_steps.clone(),
+            "reward": self.returns / self.elapsed_steps,
+        }
+        if self.ignore_terminations:
+            episode_info["success_at_end"] = success.clone()
+            terminations = torch.zeros_like(success)
+        else:
+            terminations = success.clone()
+        truncations = self.elapsed_steps >= self.max_episode_steps
+        infos = dict(success=success, elapsed_steps=self.elapsed_steps.clone(), episode=episode_info)
+
+        dones = terminations | truncations
+        if dones.any():
+            final_obs = obs
+            final_info = infos
+            self._reset_envs(dones)
+            obs = self._get_obs()
+            infos = dict(
+                elapsed_steps=self.elapsed_steps.clone(),
+                final_observation=final_obs,
+                final_info=final_info,
+                _final_info=dones,
+                _final_observation=dones,
+                _elapsed_steps=dones,
+            )
+        return obs, reward, terminations, truncations, infos
+
+
+gym.register(
+    id="SO100PushCubeNullPhysics-v1",
+    vector_entry_point="lerobot_sim2real.envs.null_physics:NullPhysicsVectorEnv",
+    max_episode_steps=64,
+)
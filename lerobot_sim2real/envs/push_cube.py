@@ -1,5 +1,6 @@
+from contextlib import contextmanager
 from dataclasses import asdict, dataclass
-from typing import Any, Dict, Optional, Sequence, Union
+from typing import Any, Dict, Literal, Optional, Sequence, Union
 
 import dacite
 import numpy as np
@@ -13,6 +14,7 @@ from mani_skill.agents.robots.so100.so_100 import SO100
 from mani_skill.envs.tasks.digital_twins.base_env import BaseDigitalTwinEnv
 from mani_skill.sensors.camera import CameraConfig
 from mani_skill.utils import common, sapien_utils
+from mani_skill.utils.geometry.rotation_conversions import axis_angle_to_quaternion, quaternion_multiply
 from mani_skill.utils.logging_utils import logger
 from mani_skill.utils.registration import register_env
 from mani_skill.utils.scene_builder.table import TableSceneBuilder
@@ -32,6 +34,9 @@ class SO100PushCubeDomainRandomizationConfig:
     If you want to randomize it just set this value to "random". If left as None which is
     the default, it will set the robot parts to white and motors to black. For more fine-grained choices on robot colors you need to modify
     mani_skill/assets/robots/so100/so100.urdf in the ManiSkill package."""
+    robot_color_palette_size: Optional[int] = None
+    """If set and robot_color is "random", this many render materials with random colors are made and each visual shape of each robot is
+    given one of them when the robot is built. If None, every part of every robot samples its own color, which is slower to set up"""
     randomize_lighting: bool = True
     max_camera_offset: Sequence[float] = (0.025, 0.025, 0.025)
     """max camera offset from the base camera position in x, y, and z axes"""
@@ -41,6 +46,14 @@ class SO100PushCubeDomainRandomizationConfig:
     """scale of noise added to the camera view rotation"""
     camera_fov_noise: float = np.deg2rad(2)
     """scale of noise added to the camera fov"""
+    camera_resample_mode: Literal["step", "episode", "interval", "random_walk"] = "step"
+    """when camera poses are sampled again. "step" samples new poses every control step, "episode" only when an environment is reset,
+    "interval" every camera_resample_interval control steps and "random_walk" moves the poses a little every control step so they change
+    smoothly while staying within the same bounds and distribution"""
+    camera_resample_interval: int = 10
+    """number of control steps between camera pose samples in the "interval" mode"""
+    camera_random_walk_std: float = 0.05
+    """size of the steps of the "random_walk" mode, relative to the range of each camera pose noise"""
 
     ### task-specific related domain randomizations that occur during scene loading ###
     cube_half_size_range: Sequence[float] = (0.022 / 2, 0.028 / 2)
@@ -48,11 +61,78 @@ class SO100PushCubeDomainRandomizationConfig:
     cube_friction_std: float = 0.05
     cube_friction_bounds: Sequence[float] = (0.1, 0.5)
     randomize_cube_color: bool = True
+    cube_num_buckets: Optional[int] = None
+    """If set, only this many different cubes are sampled and each parallel environment gets one of them at random, which makes building
+    the scene with many parallel environments much faster. If None, every parallel environment samples its own cube"""
+    rerandomize_on_reset: bool = False
+    """If true, the cube friction and color and the lighting are sampled again for every parallel environment that is reset, without
+    rebuilding the scene. The cube size and the robot color are still only sampled when the scene is built (see reconfiguration_freq).
+    Cube colors can only be sampled again if every parallel environment has its own cube (cube_num_buckets is None)"""
 
     def dict(self):
         return {k: v for k, v in asdict(self).items()}
 
 
+def make_reward_buffers(num_envs: int, device: torch.device):
+    """preallocated outputs and scratch space of push_cube_reward_and_success"""
+    return dict(
+        offset=torch.zeros((num_envs, 3), device=device),
+        distance=torch.zeros(num_envs, device=device),
+        mask=torch.zeros(num_envs, dtype=torch.bool, device=device),
+        obj_dist=torch.zeros(num_envs, device=device),
+        reaching=torch.zeros(num_envs, device=device),
+        success=torch.zeros(num_envs, dtype=torch.bool, device=device),
+        reward=torch.zeros(num_envs, device=device),
+    )
+
+
+def push_cube_reward_and_success(
+    cube_pos: torch.Tensor,
+    goal_pos: torch.Tensor,
+    tcp_pos: torch.Tensor,
+    cube_half_sizes: torch.Tensor,
+    qvel: torch.Tensor,
+    touching_table: Optional[torch.Tensor],
+    goal_radius: float,
+    buffers: Dict[str, torch.Tensor],
+    success: Optional[torch.Tensor] = None,
+):
+    """computes the success, distances and dense reward of the push cube task in one pass, writing them into buffers made by
+    make_reward_buffers without allocating any tensors. The reward is skipped if touching_table is None. If success is given, the reward
+    uses it instead of the success computed from the states. The results are identical to computing them out of place as
+    SO100PushCubeEnv did before"""
+    offset, distance, mask = buffers["offset"], buffers["distance"], buffers["mask"]
+    obj_dist, reaching, reward = buffers["obj_dist"], buffers["reaching"], buffers["reward"]
+    state_success = buffers["success"]
+    if success is None:
+        success = state_success
+    # success: the cube is in the goal region and the robot is static
+    torch.sub(cube_pos[:, :2], goal_pos[:, :2], out=offset[:, :2])
+    torch.linalg.vector_norm(offset[:, :2], dim=1, out=obj_dist)
+    torch.lt(obj_dist, goal_radius, out=state_success)
+    torch.linalg.vector_norm(qvel, dim=1, out=distance)
+    torch.lt(distance, 0.2, out=mask)
+    state_success.logical_and_(mask)
+    if touching_table is None:
+        return
+    # reaching: distance of the tcp to a point just behind the cube
+    torch.add(cube_half_sizes, 0.01, out=distance)
+    offset.copy_(cube_pos)
+    offset[:, 0].sub_(distance)
+    offset.sub_(tcp_pos)
+    torch.linalg.vector_norm(offset, dim=1, out=reaching)
+    # reward = 1 - tanh(5 * reaching) + (1 - tanh(5 * obj_dist)) * (reaching < 0.02) - 2 * touching_table, or 3 on success
+    torch.mul(reaching, 5, out=reward)
+    reward.tanh_().neg_().add_(1)
+    torch.mul(obj_dist, 5, out=distance)
+    distance.tanh_().neg_().add_(1)
+    torch.lt(reaching, 0.02, out=mask)
+    distance.mul_(mask)
+    reward.add_(distance)
+    reward.add_(touching_table, alpha=-2)
+    reward.masked_fill_(success, 3.0)
+
+
 @register_env("SO100PushCube-v1", max_episode_steps=64)
 class SO100PushCubeEnv(BaseDigitalTwinEnv):
     """
@@ -106,6 +186,8 @@ class SO100PushCubeEnv(BaseDigitalTwinEnv):
                 data=domain_randomization_config,
                 config=dacite.Config(strict=True),
             )
+        if self.domain_randomization_config.rerandomize_on_reset and self.domain_randomization_config.randomize_cube_color:
+            assert self.domain_randomization_config.cube_num_buckets is None, "cube colors can only be randomized on reset if cube_num_buckets is None"
         self.base_camera_settings = base_camera_settings
         """what the camera fov, position and target are when domain randomization is off. DR is centered around these settings"""
 
@@ -162,15 +244,68 @@ class SO100PushCubeEnv(BaseDigitalTwinEnv):
         )
 
     def _load_agent(self, options: dict):
+        config = self.domain_randomization_config
+        random_robot_color = self.domain_randomization and config.robot_color == "random"
+        # robot colors are given to the robot's visual shapes as shared render materials before the robot is built, which is much cheaper
+        # than recoloring every part of every built robot. Only random colors without a palette are set per part after building
+        robot_materials = None
+        if config.robot_color is not None and config.robot_color != "random":
+            color_material = sapien.render.RenderMaterial(base_color=list(config.robot_color) + [1])
+            robot_materials = lambda build_idx, num_shapes: [color_material] * num_shapes
+        elif random_robot_color and config.robot_color_palette_size is not None:
+            palette_size = config.robot_color_palette_size
+            palette = [
+                sapien.render.RenderMaterial(base_color=color + [1])
+                for color in self._episode_rng.uniform(low=0.0, high=1.0, size=(palette_size, 3)).tolist()
+            ]
+            # robots with random colors are built separately, the i-th build is the robot of parallel environment i
+            robot_materials = lambda build_idx, num_shapes: [
+                palette[j] for j in self._batched_episode_rng[build_idx].randint(0, palette_size, size=num_shapes)
+            ]
         # load the robot arm at this initial pose
-        super()._load_agent(
-            options,
-            sapien.Pose(p=[0, 0, 0], q=euler2quat(0, 0, np.pi / 2)),
-            build_separate=True
-            if self.domain_randomization
-            and self.domain_randomization_config.robot_color == "random"
-            else False,
-        )
+        with self._robot_visual_materials(robot_materials):
+            super()._load_agent(
+                options,
+                sapien.Pose(p=[0, 0, 0], q=euler2quat(0, 0, np.pi / 2)),
+                build_separate=random_robot_color,
+            )
+
+    @contextmanager
+    def _robot_visual_materials(self, robot_materials):
+        """while active, every robot loaded from a URDF gets the render materials returned by robot_materials(build_idx, num_shapes) for
+        its visual shapes, where build_idx counts the robots built so far. Does nothing if robot_materials is None"""
+        if robot_materials is None:
+            yield
+            return
+        create_urdf_loader = self.scene.create_urdf_loader
+        num_builds = 0
+
+        def create_urdf_loader_with_materials():
+            loader = create_urdf_loader()
+            parse = loader.parse
+
+            def parse_with_materials(*args, **kwargs):
+                nonlocal num_builds
+                parsed = parse(*args, **kwargs)
+                records = [
+                    record
+                    for builder in parsed["articulation_builders"]
+                    for link_builder in builder.link_builders
+                    for record in link_builder.visual_records
+                ]
+                for record, material in zip(records, robot_materials(num_builds, len(records))):
+                    record.material = material
+                num_builds += 1
+                return parsed
+
+            loader.parse = parse_with_materials
+            return loader
+
+        self.scene.create_urdf_loader = create_urdf_loader_with_materials
+        try:
+            yield
+        finally:
+            del self.scene.create_urdf_loader
 
     def _load_lighting(self, options: dict):
         if self.domain_randomization:
@@ -190,6 +325,11 @@ class SO100PushCubeEnv(BaseDigitalTwinEnv):
         # where the 0, 0, 0 position is the center of the table
         self.table_scene = TableSceneBuilder(self)
         self.table_scene.build()
+        # the contact query is made for the bodies of this scene, so it is rebuilt lazily after every reconfiguration
+        self._finger_table_contact_query = None
+        self._physics_snapshot = None
+        self._reward_buffers = make_reward_buffers(self.num_envs, self.device)
+        self._buffered_reward_inputs = None
 
         # some default values for cube geometry
         half_sizes = (
@@ -206,59 +346,61 @@ class SO100PushCubeEnv(BaseDigitalTwinEnv):
             np.ones(self.num_envs) * self.domain_randomization_config.cube_friction_mean
         )
 
-        # randomize cube sizes, colors, and frictions
-        if self.domain_randomization:
-            # note that we use self._batched_episode_rng instead of torch.rand or np.random as it ensures even with a different number of parallel
-            # environments the same seed leads to the same RNG, which is important for reproducibility as geometric changes here aren't saveable in environment state
-            half_sizes = self._batched_episode_rng.uniform(
-                low=self.domain_randomization_config.cube_half_size_range[0],
-                high=self.domain_randomization_config.cube_half_size_range[1],
-            )
-            if self.domain_randomization_config.randomize_cube_color:
-                colors = self._batched_episode_rng.uniform(low=0, high=1, size=(3,))
-            frictions = self._batched_episode_rng.normal(
-                self.domain_randomization_config.cube_friction_mean,
-                self.domain_randomization_config.cube_friction_std,
-            )
-            frictions = frictions.clip(
-                *self.domain_randomization_config.cube_friction_bounds
-            )
+        if not self.domain_randomization:
+            # every cube is the same so a single builder builds them in all parallel environments at once
+            self.cube_half_sizes = common.to_tensor(half_sizes, device=self.device)
+            self.cube = self._build_cube(half_sizes[0], frictions[0], colors[0], name="cube")
+        else:
+            num_buckets = self.domain_randomization_config.cube_num_buckets
+            if num_buckets is None:
+                # every parallel environment gets its own cube
+                # note that we use self._batched_episode_rng instead of torch.rand or np.random as it ensures even with a different number of parallel
+                # environments the same seed leads to the same RNG, which is important for reproducibility as geometric changes here aren't saveable in environment state
+                bucket_half_sizes, bucket_frictions, bucket_colors = self._sample_cube_parameters(self._batched_episode_rng)
+                env_buckets = np.arange(self.num_envs)
+            else:
+                # sample num_buckets cubes and give every parallel environment one of them at random. Each environment's cube is still
+                # a sample of the same distribution, but all environments with the same cube share one builder and its materials
+                bucket_half_sizes, bucket_frictions, bucket_colors = self._sample_cube_parameters(self._episode_rng, num_buckets)
+                env_buckets = self._batched_episode_rng.randint(0, num_buckets)
+            half_sizes = bucket_half_sizes[env_buckets]
+            self.cube_half_sizes = common.to_tensor(half_sizes, device=self.device)
+
+            # build our cubes, one builder per distinct cube using our randomized colors, frictions, and sizes
+            cubes = []
+            for bucket in np.unique(env_buckets):
+                scene_idxs = np.flatnonzero(env_buckets == bucket)
+                cube = self._build_cube(
+                    bucket_half_sizes[bucket],
+                    bucket_frictions[bucket],
+                    bucket_colors[bucket],
+                    name=f"cube-{bucket}",
+                    scene_idxs=scene_idxs.tolist(),
+                )
+                cubes.append(cube)
+                self.remove_from_state_dict_registry(cube)
+
+            # since we are building many different cubes but simulating in parallel, we need to merge them into a single actor
+            # so we can access each different cube's information with a single object
+            self.cube = self._merge_in_scene_order(cubes, half_sizes, name="cube")
+            self.add_to_state_dict_registry(self.cube)
+
+            if self.domain_randomization_config.rerandomize_on_reset:
+                # keep handles to the cube materials so resets can change them in place. Cubes built by the same builder share their
+                # materials, so every cube gets its own physx material to be able to change the friction of one environment at a time
+                self._cube_physx_materials, self._cube_render_materials = [], []
+                for obj, friction in zip(self.cube._objs, bucket_frictions[env_buckets]):
+                    material = sapien.pysapien.physx.PhysxMaterial(
+                        static_friction=friction,
+                        dynamic_friction=friction,
+                        restitution=0,
+                    )
+                    for shape in obj.find_component_by_type(sapien.physx.PhysxRigidDynamicComponent).collision_shapes:
+                        shape.set_physical_material(material)
+                    self._cube_physx_materials.append(material)
+                    render_body_component: RenderBodyComponent = obj.find_component_by_type(RenderBodyComponent)
+                    self._cube_render_materials.append([shape.material for shape in render_body_component.render_shapes])
 
-        self.cube_half_sizes = common.to_tensor(half_sizes, device=self.device)
-        colors = np.concatenate([colors, np.ones((self.num_envs, 1))], axis=-1)
-
-        # build our cubes
-        cubes = []
-        for i in range(self.num_envs):
-            # create a different cube in each parallel environment
-            # using our randomized colors, frictions, and sizes
-            builder = self.scene.create_actor_builder()
-            friction = frictions[i]
-            material = sapien.pysapien.physx.PhysxMaterial(
-                static_friction=friction,
-                dynamic_friction=friction,
-                restitution=0,
-            )
-            builder.add_box_collision(
-                half_size=[half_sizes[i]] * 3, material=material, density=200  # 25
-            )
-            builder.add_box_visual(
-                half_size=[half_sizes[i]] * 3,
-                material=sapien.render.RenderMaterial(
-                    base_color=colors[i],
-                ),
-            )
-            builder.initial_pose = sapien.Pose(p=[0, 0, half_sizes[i]])
-            builder.set_scene_idxs([i])
-            cube = builder.build(name=f"cube-{i}")
-            cubes.append(cube)
-            self.remove_from_state_dict_registry(cube)
-
-        # since we are building many different cubes but simulating in parallel, we need to merge them into a single actor
-        # so we can access each different cube's information with a single object
-        self.cube = Actor.merge(cubes, name="cube")
-        self.add_to_state_dict_registry(self.cube)
-        
         builder = self.scene.create_actor_builder()
         builder.add_cylinder_visual(
             radius=self.goal_radius,
@@ -297,72 +439,166 @@ class SO100PushCubeEnv(BaseDigitalTwinEnv):
         builder.initial_pose = sapien.Pose()
         self.camera_mount = builder.build_kinematic("camera_mount")
 
-        # randomize or set a fixed robot color
-        if self.domain_randomization_config.robot_color is not None:
-            for link in self.agent.robot.links:
-                for i, obj in enumerate(link._objs):
-                    # modify the i-th object which is in parallel environment i
-                    render_body_component: RenderBodyComponent = (
-                        obj.entity.find_component_by_type(RenderBodyComponent)
-                    )
-                    if render_body_component is not None:
-                        for render_shape in render_body_component.render_shapes:
-                            for part in render_shape.parts:
-                                if (
-                                    self.domain_randomization
-                                    and self.domain_randomization_config.robot_color
-                                    == "random"
-                                ):
-                                    part.material.set_base_color(
-                                        self._batched_episode_rng[i]
-                                        .uniform(low=0.0, high=1.0, size=(3,))
-                                        .tolist()
-                                        + [1]
-                                    )
-                                else:
-                                    part.material.set_base_color(
-                                        list(
-                                            self.domain_randomization_config.robot_color
-                                        )
-                                        + [1]
-                                    )
+        # camera settings as tensors on the env device, converted once instead of every time camera poses are sampled
+        self._camera_pos = common.to_tensor(self.base_camera_settings["pos"], device=self.device).float()
+        self._camera_target = common.to_tensor(self.base_camera_settings["target"], device=self.device).float()
+        self._max_camera_offset = common.to_tensor(
+            self.domain_randomization_config.max_camera_offset, device=self.device
+        ).float()
+        self._base_camera_pose = sapien_utils.look_at(eye=self._camera_pos, target=self._camera_target, device=self.device)
+        # the noise the camera poses of every parallel environment are made from: a position offset in [-0.5, 0.5] in units of
+        # max_camera_offset, then a target offset and a rotation about the view axis in units of their noise scales
+        self._camera_noise = torch.zeros((self.num_envs, 7), device=self.device)
+        self._camera_noise_step = torch.zeros_like(self._camera_noise)
+        self._camera_step = 0
+
+        # random robot colors without a palette give every part of every robot its own color, which is set on the built robots' materials.
+        # fixed colors and palettes are assigned when the robot is built, see _load_agent
+        if (
+            self.domain_randomization
+            and self.domain_randomization_config.robot_color == "random"
+            and self.domain_randomization_config.robot_color_palette_size is None
+        ):
+            robot_materials = self._get_robot_render_materials()
+            # one call per environment draws the same colors as drawing one color per part
+            colors = self._batched_episode_rng.uniform(low=0.0, high=1.0, size=(len(robot_materials[0]), 3))
+            colors = np.concatenate([colors, np.ones((*colors.shape[:2], 1))], axis=-1).tolist()
+            for materials, env_colors in zip(robot_materials, colors):
+                for material, color in zip(materials, env_colors):
+                    material.set_base_color(color)
+
+    def _get_robot_render_materials(self):
+        """returns the render materials of every part of the robot in each parallel environment, in the same order for every environment"""
+        robot_materials = [[] for _ in range(self.num_envs)]
+        for link in self.agent.robot.links:
+            for i, obj in enumerate(link._objs):
+                # the i-th object is in parallel environment i
+                render_body_component: RenderBodyComponent = (
+                    obj.entity.find_component_by_type(RenderBodyComponent)
+                )
+                if render_body_component is not None:
+                    for render_shape in render_body_component.render_shapes:
+                        robot_materials[i] += [part.material for part in render_shape.parts]
+        return robot_materials
+
+    def _sample_cube_parameters(self, rng: np.random.RandomState, n: Optional[int] = None):
+        """samples cube half sizes, frictions and colors. With a batched RNG and no n there is one sample per parallel environment,
+        otherwise n samples are drawn from rng"""
+        config = self.domain_randomization_config
+        half_sizes = rng.uniform(
+            low=config.cube_half_size_range[0],
+            high=config.cube_half_size_range[1],
+            size=n,
+        )
+        if config.randomize_cube_color:
+            colors = rng.uniform(low=0, high=1, size=(3,) if n is None else (n, 3))
+        else:
+            colors = np.zeros((len(half_sizes), 3))
+            colors[:, 0] = 1
+        frictions = rng.normal(config.cube_friction_mean, config.cube_friction_std, size=n)
+        frictions = frictions.clip(*config.cube_friction_bounds)
+        return half_sizes, frictions, colors
+
+    def _build_cube(self, half_size: float, friction: float, color: np.ndarray, name: str, scene_idxs: Optional[list] = None):
+        """builds a cube in the parallel environments scene_idxs, or in all of them if None"""
+        builder = self.scene.create_actor_builder()
+        material = sapien.pysapien.physx.PhysxMaterial(
+            static_friction=friction,
+            dynamic_friction=friction,
+            restitution=0,
+        )
+        builder.add_box_collision(
+            half_size=[half_size] * 3, material=material, density=200  # 25
+        )
+        builder.add_box_visual(
+            half_size=[half_size] * 3,
+            material=sapien.render.RenderMaterial(
+                base_color=list(color) + [1],
+            ),
+        )
+        builder.initial_pose = sapien.Pose(p=[0, 0, half_size])
+        if scene_idxs is not None:
+            builder.set_scene_idxs(scene_idxs)
+        return builder.build(name=name)
+
+    def _merge_in_scene_order(self, actors: list[Actor], half_sizes: np.ndarray, name: str):
+        """like Actor.merge, but orders the merged objects by the parallel environment they are in, which Actor.merge only does when
+        every actor is in a single environment and they are given in order"""
+        objs, scene_idxs = [], []
+        for actor in actors:
+            objs += actor._objs
+            scene_idxs.append(actor._scene_idxs)
+        scene_idxs = torch.cat(scene_idxs)
+        order = torch.argsort(scene_idxs).tolist()
+        merged_actor = Actor.create_from_entities([objs[i] for i in order], self.scene, scene_idxs[order])
+        merged_actor.name = name
+        initial_p = torch.zeros((self.num_envs, 3))
+        initial_p[:, 2] = common.to_tensor(half_sizes).float()
+        merged_actor.initial_pose = Pose.create_from_pq(p=initial_p)
+        merged_actor.merged = True
+        self.scene.actor_views[name] = merged_actor
+        return merged_actor
+
+    def _rerandomize_episode(self, env_idx: torch.Tensor):
+        """samples the cube friction and color and the lighting of the parallel environments env_idx again and changes them in place.
+
+        SAPIEN has no batched setters for physx materials, render materials or ambient lights, so this makes a few python calls per reset
+        environment. That is still much cheaper than rebuilding the scene, see scripts/benchmark_rerandomize.py"""
+        config = self.domain_randomization_config
+        env_idx = common.to_numpy(env_idx)
+        rng = self._batched_episode_rng[env_idx]
+        frictions = rng.normal(config.cube_friction_mean, config.cube_friction_std)
+        frictions = frictions.clip(*config.cube_friction_bounds).tolist()
+        for i, friction in zip(env_idx, frictions):
+            material = self._cube_physx_materials[i]
+            material.set_static_friction(friction)
+            material.set_dynamic_friction(friction)
+        if config.randomize_cube_color:
+            colors = np.concatenate([rng.uniform(low=0, high=1, size=(3,)), np.ones((len(env_idx), 1))], axis=-1).tolist()
+            for i, color in zip(env_idx, colors):
+                for material in self._cube_render_materials[i]:
+                    material.set_base_color(color)
+        if config.randomize_lighting:
+            ambient_colors = rng.uniform(0.2, 0.5, size=(3,))
+            for i, ambient_color in zip(env_idx, ambient_colors):
+                self.scene.sub_scenes[i].render_system.ambient_light = ambient_color
+
+    def _sample_camera_noise(self, n: int):
+        noise = torch.empty((n, 7), device=self.device)
+        noise[:, :3].uniform_(-0.5, 0.5)
+        noise[:, 3:].normal_()
+        return noise
+
+    def _camera_poses(self, noise: torch.Tensor):
+        """turns camera noise into camera poses. The eyes are placed in a box around the base camera position and look at a noised
+        target, then are rotated about the view axis, as randomization.camera.noised_look_at does"""
+        config = self.domain_randomization_config
+        eyes = self._camera_pos + noise[:, :3] * self._max_camera_offset
+        targets = self._camera_target + noise[:, 3:6] * config.camera_target_noise
+        poses = sapien_utils.look_at(eye=eyes, target=targets, device=self.device)
+        axes = targets - eyes
+        axis_angle = axes / torch.linalg.norm(axes, dim=-1, keepdim=True) * (noise[:, 6:] * config.camera_view_rot_noise)
+        return Pose.create_from_pq(poses.p, q=quaternion_multiply(axis_angle_to_quaternion(axis_angle), poses.q))
 
     def sample_camera_poses(self, n: int):
         # a custom function to sample random camera poses
         # the way this works is we first sample "eyes", which are the camera positions
-        # then we use the noised_look_at function to sample the full camera poses given the sampled eyes
-        # and a target position the camera is pointing at
+        # then we look at a noised target position from them and rotate the camera a little about the direction it looks in
         if self.domain_randomization:
-            # in case these haven't been moved to torch tensors on the environment device
-            self.base_camera_settings["pos"] = common.to_tensor(
-                self.base_camera_settings["pos"], device=self.device
-            )
-            self.base_camera_settings["target"] = common.to_tensor(
-                self.base_camera_settings["target"], device=self.device
-            )
-            self.domain_randomization_config.max_camera_offset = common.to_tensor(
-                self.domain_randomization_config.max_camera_offset, device=self.device
-            )
-
-            eyes = randomization.camera.make_camera_rectangular_prism(
-                n,
-                scale=self.domain_randomization_config.max_camera_offset,
-                center=self.base_camera_settings["pos"],
-                theta=0,
-                device=self.device,
-            )
-            return randomization.camera.noised_look_at(
-                eyes,
-                target=self.base_camera_settings["target"],
-                look_at_noise=self.domain_randomization_config.camera_target_noise,
-                view_axis_rot_noise=self.domain_randomization_config.camera_view_rot_noise,
-                device=self.device,
-            )
+            return self._camera_poses(self._sample_camera_noise(n))
         else:
-            return sapien_utils.look_at(
-                eye=self.base_camera_settings["pos"],
-                target=self.base_camera_settings["target"],
-            )
+            return self._base_camera_pose
+
+    def _step_camera_noise(self):
+        """moves the camera noise of every environment one step of a random walk in place. The position offsets are reflected back into
+        their bounds and the gaussian noises decay towards 0, so the noise keeps the distribution it is sampled from"""
+        step_size = self.domain_randomization_config.camera_random_walk_std
+        self._camera_noise_step.normal_()
+        offsets = self._camera_noise[:, :3]
+        offsets.add_(self._camera_noise_step[:, :3], alpha=step_size)
+        offsets.add_(0.5).remainder_(2).sub_(1).abs_().neg_().add_(0.5)
+        gaussians = self._camera_noise[:, 3:]
+        gaussians.mul_((1 - step_size**2) ** 0.5).add_(self._camera_noise_step[:, 3:], alpha=step_size)
 
     def _initialize_episode(self, env_idx: torch.Tensor, options: dict):
         # we randomize the pose of the cube accordingly so that the policy can learn to pick up the cube from
@@ -406,14 +642,37 @@ class SO100PushCubeEnv(BaseDigitalTwinEnv):
             )
 
             # randomize the camera poses
-            self.camera_mount.set_pose(self.sample_camera_poses(n=b))
+            if self.domain_randomization:
+                self._camera_noise[env_idx] = self._sample_camera_noise(b)
+                self.camera_mount.set_pose(self._camera_poses(self._camera_noise[env_idx]))
+            else:
+                self.camera_mount.set_pose(self._base_camera_pose)
+
+            if self.domain_randomization and self.domain_randomization_config.rerandomize_on_reset:
+                self._rerandomize_episode(env_idx)
+
+            self._physics_snapshot = None
 
     def _before_control_step(self):
         # update the camera poses before agent actions are executed
-        if self.domain_randomization:
-            self.camera_mount.set_pose(self.sample_camera_poses(n=self.num_envs))
-            if self.gpu_sim_enabled:
-                self.scene._gpu_apply_all()
+        if not self.domain_randomization:
+            return
+        mode = self.domain_randomization_config.camera_resample_mode
+        if mode == "episode":
+            return
+        if mode == "interval":
+            self._camera_step += 1
+            if self._camera_step % self.domain_randomization_config.camera_resample_interval != 0:
+                return
+        if mode == "random_walk":
+            self._step_camera_noise()
+        else:
+            self._camera_noise[:, :3].uniform_(-0.5, 0.5)
+            self._camera_noise[:, 3:].normal_()
+        self.camera_mount.set_pose(self._camera_poses(self._camera_noise))
+        # only push the new camera poses to the GPU when they changed
+        if self.gpu_sim_enabled:
+            self.scene._gpu_apply_all()
 
     # ────────────────────────
     # 3. Observations & reward
@@ -425,54 +684,113 @@ class SO100PushCubeEnv(BaseDigitalTwinEnv):
             obs["controller"] = state
         return obs
 
+    # the physics snapshot is dropped whenever the simulation state may have changed: after every simulation step, when episodes are
+    # initialized, when the state is set and when a new info is computed
+    def _after_simulation_step(self):
+        self._physics_snapshot = None
+
+    def set_state_dict(self, state: Dict, env_idx: Optional[torch.Tensor] = None):
+        self._physics_snapshot = None
+        super().set_state_dict(state, env_idx)
+
+    def get_info(self):
+        self._physics_snapshot = None
+        return super().get_info()
+
+    def _get_physics_snapshot(self):
+        """poses of the cube, goal and gripper, queried from the simulation once per step and shared by evaluate, the observations and
+        the rewards"""
+        if self._physics_snapshot is None:
+            cube_pose = self.cube.pose
+            self._physics_snapshot = dict(
+                cube_pose=cube_pose,
+                cube_pos=cube_pose.p,
+                goal_pos=self.goal_region.pose.p,
+                tcp_pos=self.agent.tcp_pos,
+            )
+        return self._physics_snapshot
+
+    def _get_finger_table_contact_forces(self):
+        """contact forces between each finger and the table, shape (2, num_envs, 3), fetched with a single contact query"""
+        fingers = [self.agent.finger1_link, self.agent.finger2_link]
+        if self.gpu_sim_enabled:
+            if self._finger_table_contact_query is None:
+                body_pairs = []
+                for finger in fingers:
+                    body_pairs += list(zip(finger._bodies, self.table_scene.table._bodies))
+                self._finger_table_contact_query = self.scene.px.gpu_create_contact_pair_impulse_query(body_pairs)
+            self.scene.px.gpu_query_contact_pair_impulses(self._finger_table_contact_query)
+            impulses = self._finger_table_contact_query.cuda_impulses.torch().view(len(fingers), self.num_envs, 3)
+        else:
+            contacts = self.scene.px.get_contacts()
+            table = self.table_scene.table._bodies[0].entity
+            impulses = torch.stack([
+                common.to_tensor(sapien_utils.get_pairwise_contact_impulse(contacts, finger._bodies[0].entity, table))[None]
+                for finger in fingers
+            ])
+        return impulses / self.scene.px.timestep
+
     def _get_obs_extra(self, info: Dict):
+        snapshot = self._get_physics_snapshot()
         obs = dict(
-            tcp_pos=self.agent.tcp_pos,
-            tcp_to_obj=self.cube.pose.p - self.agent.tcp_pos,
+            tcp_pos=snapshot["tcp_pos"],
+            tcp_to_obj=snapshot["cube_pos"] - snapshot["tcp_pos"],
         )
         if self.obs_mode_struct.state:
             obs.update(
-                obj_pose=self.cube.pose.raw_pose,
-                goal_pos=self.goal_region.pose.p,
+                obj_pose=snapshot["cube_pose"].raw_pose,
+                goal_pos=snapshot["goal_pos"],
             )
         return obs
 
     def evaluate(self):
-        obj_xy = self.cube.pose.p[..., :2]
-        goal_xy = self.goal_region.pose.p[..., :2]
-        in_region = torch.linalg.norm(obj_xy - goal_xy, dim=1) < self.goal_radius
-        robot_static = torch.linalg.norm(self.agent.robot.get_qvel(), dim=1) < 0.2
-        success = in_region & robot_static
-        
-        # determine if robot is touching the table. for safety reasons we want the robot to avoid hitting the table when grasping the cube
-        l_contact_forces = self.scene.get_pairwise_contact_forces(
-            self.agent.finger1_link, self.table_scene.table
-        )
-        r_contact_forces = self.scene.get_pairwise_contact_forces(
-            self.agent.finger2_link, self.table_scene.table
-        )
-        lforce = torch.linalg.norm(l_contact_forces, axis=1)
-        rforce = torch.linalg.norm(r_contact_forces, axis=1)
-        touching_table = torch.logical_or(
-            lforce >= 1e-2,
-            rforce >= 1e-2,
+        snapshot = self._get_physics_snapshot()
+        # determine if robot is touching the table. for safety reasons we want the robot to avoid hitting the table when grasping the cube.
+        # this is only used by the rewards, so runs without rewards (e.g. on the real robot) skip the contact query and report no contact
+        touching_table = None
+        if self._reward_mode != "none":
+            contact_forces = torch.linalg.norm(self._get_finger_table_contact_forces(), dim=-1)
+            touching_table = (contact_forces >= 1e-2).any(dim=0)
+
+        # success and the dense reward share most of their work, so both are computed here
+        push_cube_reward_and_success(
+            snapshot["cube_pos"],
+            snapshot["goal_pos"],
+            snapshot["tcp_pos"],
+            self.cube_half_sizes,
+            self.agent.robot.get_qvel(),
+            touching_table,
+            self.goal_radius,
+            self._reward_buffers,
         )
-        
-        return {"success": success, "touching_table": touching_table}
+        # the buffers are overwritten next step, callers may keep what is returned for longer
+        info = {"success": self._reward_buffers["success"].clone()}
+        if touching_table is None:
+            touching_table = torch.zeros(self.num_envs, dtype=torch.bool, device=self.device)
+        else:
+            # remember what the reward in the buffers was computed from so compute_dense_reward can reuse it
+            self._buffered_reward_inputs = (snapshot, info["success"], touching_table)
+        info["touching_table"] = touching_table
+        return info
 
     def compute_dense_reward(self, obs: Any, action: torch.Tensor, info: Dict):
-        tcp_target = self.cube.pose.p + torch.stack([-self.cube_half_sizes - 0.01, torch.zeros_like(self.cube_half_sizes), torch.zeros_like(self.cube_half_sizes)], dim=1)
-        reaching = torch.linalg.norm(tcp_target - self.agent.tcp_pos, dim=1)
-        reaching_r = 1 - torch.tanh(5 * reaching)
-
-        obj_dist = torch.linalg.norm(self.cube.pose.p[..., :2] - self.goal_region.pose.p[..., :2], dim=1)
-        place_r = 1 - torch.tanh(5 * obj_dist)
-        reward = reaching_r + place_r * (reaching < 0.02)
-        
-        reward -= 2 * info["touching_table"].float()
-
-        reward[info["success"]] = 3.0
-        return reward
+        snapshot = self._get_physics_snapshot()
+        # evaluate already computed the reward if info is the one it returned for the current state, otherwise compute it for this info
+        inputs = (snapshot, info["success"], info["touching_table"])
+        if self._buffered_reward_inputs is None or any(a is not b for a, b in zip(self._buffered_reward_inputs, inputs)):
+            push_cube_reward_and_success(
+                snapshot["cube_pos"],
+                snapshot["goal_pos"],
+                snapshot["tcp_pos"],
+                self.cube_half_sizes,
+                self.agent.robot.get_qvel(),
+                info["touching_table"],
+                self.goal_radius,
+                self._reward_buffers,
+                success=info["success"],
+            )
+            self._buffered_reward_inputs = None
+        return self._reward_buffers["reward"].clone()
 
     def compute_normalized_dense_reward(self, obs: Any, action: torch.Tensor, info: Dict):
         return self.compute_dense_reward(obs, action, info) / 3.0
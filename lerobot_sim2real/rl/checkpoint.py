@@ -0,0 +1,367 @@
+"""Checkpoints of the PPO trainer.
+
+Checkpoints use a small self-describing format in the spirit of safetensors:
+
+    8 byte magic | 8 byte little endian header size | JSON header | tensor data
+
+The header holds the dtype, shape and byte range of every tensor and a free-form JSON "__metadata__" entry. Tensor data is 64 byte aligned,
+so `load_checkpoint` memory maps the file and creates CPU tensors that only read the parts of the file that are used.
+
+The metadata of checkpoints saved by `ppo_rgb.train` describes the agent's architecture (see `Agent.checkpoint_metadata`) along with the
+env_id and env kwargs it was trained with, so `Agent.from_checkpoint` can build the agent without creating an env. Training checkpoints
+also store the optimizer, grad scaler, iteration counters and RNG states used by `--resume`. Nested state like optimizer state dicts is
+stored with `pack`, which moves the tensors and arrays into the tensor data and keeps the rest in the metadata.
+
+Old checkpoints saved with torch.save(agent.state_dict()) can be converted with
+
+python -m lerobot_sim2real.rl.checkpoint convert runs/my_run/ckpt_26.pt runs/my_run/ckpt_26.ckpt
+python -m lerobot_sim2real.rl.checkpoint info runs/my_run/ckpt_26.ckpt
+"""
+from dataclasses import dataclass
+import json
+import mmap
+import os
+import queue
+import random
+import struct
+import threading
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+import torch
+import tyro
+
+MAGIC = b"LSRCKPT1"
+ALIGNMENT = 64
+FORMAT_VERSION = 1
+
+
+def _align(n: int):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def is_checkpoint(path: str):
+    """returns True if path is a checkpoint in this format, as opposed to e.g. a torch.save file"""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{f.name} is not a checkpoint file, old torch.save checkpoints can be converted with `python -m lerobot_sim2real.rl.checkpoint convert`")
+    (header_size,) = struct.unpack("<Q", f.read(8))
+    return json.loads(f.read(header_size)), len(MAGIC) + 8 + header_size
+
+
+def save_checkpoint(path: str, tensors: Dict[str, torch.Tensor], metadata: dict):
+    """writes CPU tensors and JSON serializable metadata to path. The file is written next to path and renamed, so path is never partially written"""
+    header = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = dict(dtype=str(tensor.dtype)[len("torch."):], shape=list(tensor.shape), offsets=[offset, offset + nbytes])
+        offset = _align(offset + nbytes)
+    header["__metadata__"] = metadata
+    header_bytes = json.dumps(header).encode()
+    # pad the header with spaces so the tensor data starts aligned
+    header_bytes += b" " * (_align(len(MAGIC) + 8 + len(header_bytes)) - len(MAGIC) - 8 - len(header_bytes))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        data_start = f.tell()
+        for name, tensor in tensors.items():
+            start, end = header[name]["offsets"]
+            if end > start:
+                f.seek(data_start + start)
+                f.write(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().data)
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_metadata(path: str):
+    """reads only the metadata of a checkpoint"""
+    with open(path, "rb") as f:
+        header, _ = _read_header(f)
+    return header["__metadata__"]
+
+
+def load_checkpoint(path: str, use_mmap: bool = True) -> Tuple[Dict[str, torch.Tensor], dict]:
+    """returns the tensors and the metadata of a checkpoint. With use_mmap the tensors are backed by a private (copy on write) memory
+    map of the file, otherwise the file is read into memory"""
+    with open(path, "rb") as f:
+        header, data_start = _read_header(f)
+        if use_mmap:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            f.seek(0)
+            buffer = bytearray(f.read())
+    metadata = header.pop("__metadata__")
+    tensors = {}
+    for name, info in header.items():
+        dtype = getattr(torch, info["dtype"])
+        start, end = info["offsets"]
+        if end == start:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+        else:
+            data = torch.frombuffer(buffer, dtype=torch.uint8, count=end - start, offset=data_start + start)
+            tensors[name] = data.view(dtype).reshape(info["shape"])
+    return tensors, metadata
+
+
+def pack(obj, tensors: Dict[str, torch.Tensor], prefix: str):
+    """Returns a JSON serializable version of obj, a nest of dicts, lists, tuples, tensors, numpy arrays and JSON types. Tensors and arrays
+    are added to `tensors` under names starting with prefix and replaced by references, see `unpack`"""
+    if isinstance(obj, torch.Tensor):
+        tensors[prefix] = obj
+        return {"__tensor__": prefix}
+    if isinstance(obj, np.ndarray):
+        tensors[prefix] = torch.from_numpy(np.ascontiguousarray(obj).reshape(-1).view(np.uint8))
+        return {"__ndarray__": prefix, "dtype": obj.dtype.str, "shape": list(obj.shape)}
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return {k: pack(v, tensors, f"{prefix}/{k}") for k, v in obj.items()}
+        # e.g. optimizer state, which is keyed by parameter index
+        return {"__items__": [[k, pack(v, tensors, f"{prefix}/{k}")] for k, v in obj.items()]}
+    if isinstance(obj, tuple):
+        return {"__tuple__": [pack(v, tensors, f"{prefix}/{i}") for i, v in enumerate(obj)]}
+    if isinstance(obj, list):
+        return [pack(v, tensors, f"{prefix}/{i}") for i, v in enumerate(obj)]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def unpack(obj, tensors: Dict[str, torch.Tensor]):
+    """inverse of `pack`"""
+    if isinstance(obj, dict):
+        if "__tensor__" in obj:
+            return tensors[obj["__tensor__"]]
+        if "__ndarray__" in obj:
+            return tensors[obj["__ndarray__"]].numpy().view(np.dtype(obj["dtype"])).reshape(obj["shape"]).copy()
+        if "__items__" in obj:
+            return {k: unpack(v, tensors) for k, v in obj["__items__"]}
+        if "__tuple__" in obj:
+            return tuple(unpack(v, tensors) for v in obj["__tuple__"])
+        return {k: unpack(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [unpack(v, tensors) for v in obj]
+    return obj
+
+
+def get_rng_state():
+    state = dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_agent_state_dict(path: str):
+    """loads the agent weights of a checkpoint in this format or of a torch.save(agent.state_dict()) file"""
+    if not is_checkpoint(path):
+        return torch.load(path, map_location="cpu")
+    tensors, _ = load_checkpoint(path)
+    return {k[len("agent/"):]: v for k, v in tensors.items() if k.startswith("agent/")}
+
+
+def nature_cnn_flatten_size(image_size: Tuple[int, int]):
+    """size of the flattened output of NatureCNN's conv stack for an image of the given height and width"""
+    height, width = [((size - 8) // 4 + 1 - 4) // 2 + 1 - 2 for size in image_size]
+    return 64 * height * width
+
+
+def infer_agent_metadata(state_dict: Dict[str, torch.Tensor], image_size: Optional[Tuple[int, int]] = None):
+    """Infers `Agent.checkpoint_metadata` from the weights of an agent. The image size only determines the input size of the layer after
+    the convs, several sizes can give the same input size, so if image_size is not given the square size that fits and is divisible by the
+    largest power of two is used"""
+    conv_weight = state_dict["feature_net.extractors.rgb.0.0.weight"]
+    n_flatten = state_dict["feature_net.extractors.rgb.1.0.weight"].shape[1]
+    if image_size is None:
+        sizes = [size for size in range(36, 4096) if nature_cnn_flatten_size((size, size)) == n_flatten]
+        if len(sizes) == 0:
+            raise ValueError(f"no square image size fits the conv output size {n_flatten}, pass the image size explicitly")
+        # camera resolutions are usually divisible by a large power of two
+        size = max(sizes, key=lambda size: (size & -size, -size))
+        image_size = (size, size)
+        print(f"inferred image size {image_size}, pass the image size explicitly if it differs")
+    elif nature_cnn_flatten_size(image_size) != n_flatten:
+        raise ValueError(f"an image size of {image_size} does not match the conv output size {n_flatten} of the checkpoint")
+    obs_shapes = dict(rgb=[*image_size, conv_weight.shape[1]])
+    obs_dtypes = dict(rgb="uint8")
+    if "feature_net.extractors.state.weight" in state_dict:
+        obs_shapes["state"] = [state_dict["feature_net.extractors.state.weight"].shape[1]]
+        obs_dtypes["state"] = "float32"
+    return dict(
+        obs_shapes=obs_shapes,
+        obs_dtypes=obs_dtypes,
+        action_dim=state_dict["actor_logstd"].shape[1],
+        feature_size=sum(v.shape[0] for k, v in state_dict.items() if k in ("feature_net.extractors.rgb.1.0.bias", "feature_net.extractors.state.bias")),
+    )
+
+
+def convert_pt_checkpoint(pt_path: str, path: str, image_size: Optional[Tuple[int, int]] = None, env_id: Optional[str] = None, env_kwargs: Optional[dict] = None):
+    """converts a torch.save(agent.state_dict()) file into a checkpoint in this format"""
+    state_dict = torch.load(pt_path, map_location="cpu")
+    metadata = dict(
+        format_version=FORMAT_VERSION,
+        agent=infer_agent_metadata(state_dict, image_size),
+        env_id=env_id,
+        env_kwargs=env_kwargs or dict(),
+        converted_from=os.path.basename(pt_path),
+    )
+    save_checkpoint(path, {f"agent/{k}": v for k, v in state_dict.items()}, metadata)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints from a background thread and applies a retention policy.
+
+    `save` copies the tensors to host memory (pinned, and non-blocking for GPU tensors) and returns, the file is written by the background
+    thread. Of the checkpoints saved with `save`, the last `keep_last` (all if None) are kept, along with the `keep_best` ones with the
+    highest score, given when saving or later with `set_score` (e.g. when an asynchronous evaluation finishes). Checkpoints saved with
+    score_pending=True are not deleted before their score is set, so that a late score can still make them one of the best. Checkpoints
+    saved with protected=True are never deleted.
+
+    If writing or deleting a checkpoint fails, the exception is raised again by the next call of `save`, `set_score` or `close`.
+    """
+    def __init__(self, keep_last: Optional[int] = None, keep_best: int = 0):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self._checkpoints = []
+        self._scores = dict()
+        self._pending = set()
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+    def save(
+        self, path: str, tensors: Dict[str, torch.Tensor], metadata: dict, score: Optional[float] = None, protected: bool = False,
+        score_pending: bool = False,
+    ):
+        self._raise_error()
+        host_tensors = {}
+        event = None
+        for name, tensor in tensors.items():
+            tensor = tensor.detach()
+            if tensor.is_cuda:
+                host_tensors[name] = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                host_tensors[name].copy_(tensor, non_blocking=True)
+            else:
+                host_tensors[name] = tensor.clone()
+        if any(tensor.is_cuda for tensor in tensors.values()):
+            event = torch.cuda.Event()
+            event.record()
+        self._queue.put(("save", path, host_tensors, metadata, event, score, protected, score_pending))
+    def set_score(self, path: str, score: Optional[float]):
+        """sets the score of a checkpoint saved earlier. A score of None says the checkpoint will not get a score, e.g. because its
+        evaluation was dropped, which leaves it to the keep_last policy"""
+        self._raise_error()
+        self._queue.put(("score", path, score))
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("writing checkpoints failed") from self._error
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    # scores that never arrived will not arrive anymore
+                    self._pending.clear()
+                    self._apply_retention()
+                else:
+                    self._process(item)
+            except Exception as e:
+                # keep going so later checkpoints are still written, the error is raised in the training thread
+                if self._error is None:
+                    self._error = e
+            if item is None:
+                break
+    def _process(self, item):
+        if item[0] == "save":
+            _, path, tensors, metadata, event, score, protected, score_pending = item
+            if event is not None:
+                event.synchronize()
+            save_checkpoint(path, tensors, metadata)
+            if protected:
+                return
+            self._checkpoints.append(path)
+            if score_pending and score is None:
+                self._pending.add(path)
+        else:
+            _, path, score = item
+            self._pending.discard(path)
+        if score is not None and path in self._checkpoints:
+            self._scores[path] = score
+        self._apply_retention()
+    def _apply_retention(self):
+        keep = set(self._checkpoints if self.keep_last is None else self._checkpoints[len(self._checkpoints) - self.keep_last:])
+        keep.update(sorted(self._scores, key=self._scores.get, reverse=True)[:self.keep_best])
+        keep.update(self._pending)
+        for path in [path for path in self._checkpoints if path not in keep]:
+            if os.path.exists(path):
+                os.remove(path)
+            self._checkpoints.remove(path)
+            self._scores.pop(path, None)
+    def close(self):
+        """waits for all checkpoints to be written"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+
+def latest_checkpoint(run_dir: str):
+    """returns the path of the ckpt_{iteration}.ckpt file with the highest iteration in run_dir"""
+    checkpoints = [name for name in os.listdir(run_dir) if name.startswith("ckpt_") and name.endswith(".ckpt")]
+    if len(checkpoints) == 0:
+        raise FileNotFoundError(f"no checkpoints found in {run_dir}")
+    return os.path.join(run_dir, max(checkpoints, key=lambda name: int(name[len("ckpt_"):-len(".ckpt")])))
+
+
+@dataclass
+class Convert:
+    """Converts a torch.save(agent.state_dict()) checkpoint into the self-describing checkpoint format"""
+    pt_path: tyro.conf.Positional[str]
+    path: tyro.conf.Positional[str]
+    image_size: Optional[Tuple[int, int]] = None
+    """height and width of the rgb observations. If None it is inferred from the weights, assuming a square image"""
+    env_id: Optional[str] = None
+    """the environment id the agent was trained on, stored in the metadata"""
+    env_kwargs_json_path: Optional[str] = None
+    """path to a json file with the env kwargs the agent was trained with, stored in the metadata"""
+
+
+@dataclass
+class Info:
+    """Prints the metadata and tensors of a checkpoint"""
+    path: tyro.conf.Positional[str]
+
+
+def main(args: Union[Convert, Info]):
+    if isinstance(args, Convert):
+        env_kwargs = None
+        if args.env_kwargs_json_path is not None:
+            with open(args.env_kwargs_json_path, "r") as f:
+                env_kwargs = json.load(f)
+        convert_pt_checkpoint(args.pt_path, args.path, args.image_size, args.env_id, env_kwargs)
+        print(f"converted {args.pt_path} to {args.path}")
+    else:
+        tensors, metadata = load_checkpoint(args.path)
+        print(json.dumps({k: v for k, v in metadata.items() if k != "training"}, indent=2))
+        for name, tensor in tensors.items():
+            print(f"{name}: {str(tensor.dtype)[len('torch.'):]} {list(tensor.shape)}")
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Union[Convert, Info])
+    main(args)
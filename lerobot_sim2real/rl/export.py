@@ -0,0 +1,142 @@
+"""Exports the deterministic action path of a trained agent (the uint8 image input stem, the feature extractors and the actor head) to a frozen
+TorchScript and/or ONNX graph that `lerobot_sim2real.rl.policy_runtime.ExportedPolicy` runs with only torch or onnxruntime installed.
+
+python -m lerobot_sim2real.rl.export runs/my_run/final_ckpt.ckpt --formats torchscript onnx
+
+After exporting, every file is loaded with `ExportedPolicy` and checked against the eager `Agent.get_action(obs, deterministic=True)` on
+random observations, and the per-step latency at batch size 1 of the eager agent and the exported policies is printed.
+"""
+from dataclasses import dataclass, field
+import json
+import os
+import time
+from typing import List, Literal, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+import tyro
+
+from lerobot_sim2real.rl.policy_runtime import ExportedPolicy
+from lerobot_sim2real.rl.ppo_rgb import Agent
+
+
+@dataclass
+class Args:
+    checkpoint: tyro.conf.Positional[str]
+    """path to the checkpoint to export, see Agent.from_checkpoint"""
+    output: Optional[str] = None
+    """output path without extension. Defaults to the checkpoint path without its extension"""
+    formats: List[Literal["torchscript", "onnx"]] = field(default_factory=lambda: ["torchscript"])
+    """formats to export to, torchscript files are saved as .ts and onnx files as .onnx"""
+    opset_version: int = 17
+    """the ONNX opset version"""
+    check: bool = True
+    """if toggled, the exported policies are checked against the eager agent"""
+    atol: float = 1e-4
+    """largest absolute difference to the eager agent's actions the check accepts"""
+    benchmark_steps: int = 200
+    """number of batch size 1 inference steps timed per policy, 0 disables the latency benchmark"""
+    device: str = "cpu"
+    """device the check and latency benchmark run on"""
+
+
+class DeterministicPolicy(nn.Module):
+    """the deterministic action path of an Agent, taking the observations as separate tensors in the order of obs_keys"""
+    def __init__(self, agent: Agent):
+        super().__init__()
+        self.obs_keys = list(agent.feature_net.extractors.keys())
+        self.feature_net = agent.feature_net
+        self.actor_mean = agent.actor_mean
+
+    def forward(self, *obs):
+        return self.actor_mean(self.feature_net(dict(zip(self.obs_keys, obs))))
+
+
+def sample_obs(agent: Agent, batch_size: int, device: torch.device):
+    obs = {}
+    for k, shape in agent.obs_shapes.items():
+        dtype = getattr(torch, agent.obs_dtypes[k])
+        if dtype == torch.uint8:
+            obs[k] = torch.randint(0, 256, (batch_size, *shape), dtype=dtype, device=device)
+        else:
+            obs[k] = torch.randn((batch_size, *shape), dtype=dtype, device=device)
+    return obs
+
+
+def export_torchscript(policy: DeterministicPolicy, example_obs: dict, path: str):
+    with torch.no_grad():
+        traced = torch.jit.trace(policy, tuple(example_obs[k] for k in policy.obs_keys))
+    # freezing inlines the weights as constants and folds the 1/255 input scaling into the first conv's weights
+    frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, path, _extra_files={"policy.json": json.dumps(dict(obs_keys=policy.obs_keys))})
+
+
+def export_onnx(policy: DeterministicPolicy, example_obs: dict, path: str, opset_version: int):
+    torch.onnx.export(
+        policy,
+        tuple(example_obs[k] for k in policy.obs_keys),
+        path,
+        input_names=policy.obs_keys,
+        output_names=["action"],
+        dynamic_axes={k: {0: "batch"} for k in policy.obs_keys + ["action"]},
+        opset_version=opset_version,
+        dynamo=False,
+    )
+
+
+def latency(get_action, obs, steps: int):
+    """returns the median and 99th percentile latency in ms of get_action(obs)"""
+    times = []
+    for _ in range(steps + 10):
+        stime = time.perf_counter()
+        action = get_action(obs)
+        if isinstance(action, torch.Tensor) and action.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - stime)
+    times = np.array(times[10:]) * 1e3
+    return np.median(times), np.percentile(times, 99)
+
+
+def main(args: Args):
+    device = torch.device(args.device)
+    agent = Agent.from_checkpoint(args.checkpoint).eval()
+    policy = DeterministicPolicy(agent).eval()
+    output = args.output if args.output is not None else os.path.splitext(args.checkpoint)[0]
+    example_obs = sample_obs(agent, 1, "cpu")
+
+    paths = []
+    if "torchscript" in args.formats:
+        paths.append(f"{output}.ts")
+        export_torchscript(policy, example_obs, paths[-1])
+    if "onnx" in args.formats:
+        paths.append(f"{output}.onnx")
+        export_onnx(policy, example_obs, paths[-1], args.opset_version)
+    for path in paths:
+        print(f"exported {args.checkpoint} to {path}")
+
+    agent.to(device)
+    get_eager_action = lambda obs: agent.get_action(obs, deterministic=True)
+    runtimes = [(path, ExportedPolicy(path, device=args.device)) for path in paths]
+    if args.check:
+        for batch_size in [1, 16]:
+            obs = sample_obs(agent, batch_size, device)
+            with torch.no_grad():
+                expected = get_eager_action(obs)
+            for path, runtime in runtimes:
+                max_err = (runtime.get_action(obs) - expected).abs().max().item()
+                assert max_err <= args.atol, f"{path} differs from the eager agent by {max_err} at batch size {batch_size}"
+                print(f"{path} matches the eager agent at batch size {batch_size}, max_abs_err={max_err:.2e}")
+    if args.benchmark_steps > 0:
+        obs = sample_obs(agent, 1, device)
+        with torch.no_grad():
+            p50, p99 = latency(get_eager_action, obs, args.benchmark_steps)
+        print(f"eager agent: p50={p50:.3f}ms p99={p99:.3f}ms")
+        for path, runtime in runtimes:
+            p50, p99 = latency(runtime.get_action, obs, args.benchmark_steps)
+            print(f"{path}: p50={p50:.3f}ms p99={p99:.3f}ms")
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    main(args)
@@ -0,0 +1,164 @@
+"""Generalized Advantage Estimation (GAE) for the PPO trainer.
+
+`compute_gae` is a batched implementation of the advantage computation done in `ppo_rgb.train`. Rather than stepping through
+the rollout one timestep at a time in Python, every GAE term is written as a discounted cumulative sum over time with episode boundaries
+masked out, y_t = x_t + discount * next_not_done_t * y_{t+1}, which is evaluated with a handful of cumsum/cummin kernels over a whole
+chunk of timesteps at once.
+
+`compute_gae_loop` is the original per-timestep loop and is kept as the reference implementation for benchmarking and equivalence checks.
+"""
+import math
+from typing import Optional
+
+import torch
+
+
+def segment_ends(next_not_done: torch.Tensor):
+    """For a (M, T) tensor of next_not_done flags with time as the last dimension, returns a (M, T) int32 tensor whose entry t is
+    one past the index of the first episode boundary at or after t, or T + 1 if the episode continues past the rollout."""
+    num_steps = next_not_done.shape[-1]
+    # int32 as cummin on int64 is several times slower on CPU
+    steps = torch.arange(1, num_steps + 1, dtype=torch.int32, device=next_not_done.device)
+    boundary_idx = torch.where(next_not_done < 0.5, steps, num_steps + 1)
+    return torch.flip(torch.cummin(torch.flip(boundary_idx, [-1]), -1).values, [-1])
+
+
+def discounted_cumsum(
+    x: torch.Tensor,
+    discount: float,
+    next_not_done: torch.Tensor,
+    chunk_size: Optional[int] = None,
+    segment_end: Optional[torch.Tensor] = None,
+):
+    """Computes y_t = x_t + discount * next_not_done_t * y_{t+1} along the last (time) dimension, with y_T = 0. Time is kept last
+    (and contiguous) as cumulative ops along it are much faster on CPU.
+
+    Within a chunk of timesteps this is a reverse cumulative sum of discount^k * x_k, cut at the first episode boundary at or after t
+    and rescaled by discount^-t. Chunks are processed from last to first, carrying y at the start of each chunk into the previous one.
+
+    Args:
+        x: tensor of shape (M, T) to accumulate
+        discount: scalar discount factor
+        next_not_done: tensor of the same shape as x which is 0 where the episode ends after step t and 1 otherwise
+        chunk_size: number of timesteps handled per batched step. If None (or too large), the largest chunk for which
+            discount^chunk_size stays well inside the float range is used
+        segment_end: the output of `segment_ends(next_not_done)`, can be passed in to share it between several calls
+    """
+    if discount <= 0:
+        return x.clone()
+    num_steps = x.shape[-1]
+    if segment_end is None:
+        segment_end = segment_ends(next_not_done)
+    # discount^chunk_size must not underflow, as values are rescaled by discount^-t within a chunk
+    max_chunk_size = num_steps if discount >= 1 else int(math.log(1e-12) / math.log(discount))
+    chunk_size = max(1, min(chunk_size or max_chunk_size, max_chunk_size, num_steps))
+
+    chunks = []
+    carry = None
+    for end in range(num_steps, 0, -chunk_size):
+        start = max(0, end - chunk_size)
+        length = end - start
+        powers = torch.pow(torch.tensor(discount, dtype=x.dtype, device=x.device), torch.arange(length + 1, device=x.device))
+        # reverse cumulative sum of discount^k * x_k, with a trailing zero column
+        scaled = torch.flip(torch.cumsum(torch.flip(x[:, start:end] * powers[:length], [-1]), -1), [-1])
+        scaled = torch.cat([scaled, torch.zeros_like(scaled[:, :1])], dim=-1)
+        chunk_segment_end = segment_end[:, start:end]
+        segment_sum = scaled[:, :length] - torch.gather(scaled, -1, (chunk_segment_end.clamp(max=end) - start).long())
+        out = segment_sum / powers[:length]
+        if carry is not None:
+            # episodes that continue past this chunk also get the discounted value carried over from the start of the next chunk
+            continues = chunk_segment_end > end
+            out += continues * (powers[length] / powers[:length]) * carry[:, None]
+        chunks.append(out)
+        carry = out[:, 0]
+    return chunks[0] if len(chunks) == 1 else torch.cat(chunks[::-1], dim=-1)
+
+
+def compute_gae(
+    rewards: torch.Tensor,
+    values: torch.Tensor,
+    dones: torch.Tensor,
+    final_values: torch.Tensor,
+    next_value: torch.Tensor,
+    next_done: torch.Tensor,
+    gamma: float,
+    gae_lambda: float,
+    finite_horizon_gae: bool = False,
+    chunk_size: Optional[int] = None,
+):
+    """Computes GAE advantages for a rollout. All rollout tensors are of shape (num_steps, num_envs), next_value and
+    next_done are the value estimate and done flag of the observation after the last step. Returns the advantages."""
+    # work with time as the last dimension, see discounted_cumsum
+    rewards, values, dones, final_values = rewards.T, values.T, dones.T, final_values.T
+    next_not_done = 1.0 - torch.cat([dones[:, 1:], next_done.reshape(-1, 1)], dim=-1)
+    next_values = torch.cat([values[:, 1:], next_value.reshape(-1, 1)], dim=-1)
+    # next_not_done means nextvalues is computed from the correct next_obs
+    # if next_not_done is 1, final_values is always 0
+    # if next_not_done is 0, then use final_values, which is computed according to bootstrap_at_done
+    real_next_values = next_not_done * next_values + final_values
+    segment_end = segment_ends(next_not_done)
+    if finite_horizon_gae:
+        # see compute_gae_loop for the recursive definitions of these three sums
+        lam_coef_sum = discounted_cumsum(torch.ones_like(next_not_done), gae_lambda, next_not_done, chunk_size, segment_end)
+        reward_term_sum = discounted_cumsum(lam_coef_sum * rewards, gae_lambda * gamma, next_not_done, chunk_size, segment_end)
+        value_term_sum = discounted_cumsum(gamma * real_next_values, gae_lambda * gamma, next_not_done, chunk_size, segment_end)
+        advantages = (reward_term_sum + value_term_sum) / lam_coef_sum - values
+    else:
+        deltas = rewards + gamma * real_next_values - values
+        advantages = discounted_cumsum(deltas, gamma * gae_lambda, next_not_done, chunk_size, segment_end)
+    return advantages.T.contiguous()
+
+
+def compute_gae_loop(
+    rewards: torch.Tensor,
+    values: torch.Tensor,
+    dones: torch.Tensor,
+    final_values: torch.Tensor,
+    next_value: torch.Tensor,
+    next_done: torch.Tensor,
+    gamma: float,
+    gae_lambda: float,
+    finite_horizon_gae: bool = False,
+):
+    """Reference per-timestep implementation of `compute_gae`"""
+    num_steps = rewards.shape[0]
+    next_value = next_value.reshape(1, -1)
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = 0
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            next_not_done = 1.0 - next_done
+            nextvalues = next_value
+        else:
+            next_not_done = 1.0 - dones[t + 1]
+            nextvalues = values[t + 1]
+        real_next_values = next_not_done * nextvalues + final_values[t] # t instead of t+1
+        # next_not_done means nextvalues is computed from the correct next_obs
+        # if next_not_done is 1, final_values is always 0
+        # if next_not_done is 0, then use final_values, which is computed according to bootstrap_at_done
+        if finite_horizon_gae:
+            """
+            See GAE paper equation(16) line 1, we will compute the GAE based on this line only
+            1             *(  -V(s_t)  + r_t                                                               + gamma * V(s_{t+1})   )
+            lambda        *(  -V(s_t)  + r_t + gamma * r_{t+1}                                             + gamma^2 * V(s_{t+2}) )
+            lambda^2      *(  -V(s_t)  + r_t + gamma * r_{t+1} + gamma^2 * r_{t+2}                         + ...                  )
+            lambda^3      *(  -V(s_t)  + r_t + gamma * r_{t+1} + gamma^2 * r_{t+2} + gamma^3 * r_{t+3}
+            We then normalize it by the sum of the lambda^i (instead of 1-lambda)
+            """
+            if t == num_steps - 1: # initialize
+                lam_coef_sum = 0.
+                reward_term_sum = 0. # the sum of the second term
+                value_term_sum = 0. # the sum of the third term
+            lam_coef_sum = lam_coef_sum * next_not_done
+            reward_term_sum = reward_term_sum * next_not_done
+            value_term_sum = value_term_sum * next_not_done
+
+            lam_coef_sum = 1 + gae_lambda * lam_coef_sum
+            reward_term_sum = gae_lambda * gamma * reward_term_sum + lam_coef_sum * rewards[t]
+            value_term_sum = gae_lambda * gamma * value_term_sum + gamma * real_next_values
+
+            advantages[t] = (reward_term_sum + value_term_sum) / lam_coef_sum - values[t]
+        else:
+            delta = rewards[t] + gamma * real_next_values - values[t]
+            advantages[t] = lastgaelam = delta + gamma * gae_lambda * next_not_done * lastgaelam # Here actually we should use next_not_terminated, but we don't have lastgamlam if terminated
+    return advantages
@@ -0,0 +1,60 @@
+"""Minimal runtime for policies exported with `python -m lerobot_sim2real.rl.export`.
+
+`ExportedPolicy` runs the deterministic action path of a trained agent from a frozen TorchScript (.ts) or ONNX (.onnx) file. It only needs
+torch for TorchScript files or onnxruntime for ONNX files, and none of mani_skill, gymnasium or tensorboard, which makes it suitable for the
+machine driving the real robot.
+"""
+import json
+import zipfile
+from typing import Optional
+
+
+def _is_torch_tensor(x):
+    return type(x).__module__.startswith("torch")
+
+
+class ExportedPolicy:
+    """
+    Args:
+        path: path to an exported .ts or .onnx policy
+        device: device to run a TorchScript policy on. ONNX policies use the CUDA execution provider if onnxruntime has it and device is
+            not "cpu"
+    """
+    def __init__(self, path: str, device: Optional[str] = None):
+        self.path = path
+        if path.endswith(".onnx"):
+            import onnxruntime
+            providers = onnxruntime.get_available_providers()
+            if str(device) == "cpu":
+                providers = ["CPUExecutionProvider"]
+            self.session = onnxruntime.InferenceSession(path, providers=providers)
+            self.obs_keys = [model_input.name for model_input in self.session.get_inputs()]
+            self.module = None
+        else:
+            import torch
+            with zipfile.ZipFile(path) as f:
+                info = json.loads(f.read(next(name for name in f.namelist() if name.endswith("extra/policy.json"))))
+            if "quantized_engine" in info:
+                # int8 weights are packed for the quantized engine when the module is loaded
+                torch.backends.quantized.engine = info["quantized_engine"]
+            self.module = torch.jit.load(path, map_location=device)
+            self.obs_keys = info["obs_keys"]
+            self.device = device
+            self.session = None
+
+    def get_action(self, obs):
+        """returns the deterministic action for a dict of batched observations. Observations can be torch tensors or numpy arrays and
+        the action is returned as the same type"""
+        as_torch = _is_torch_tensor(next(iter(obs.values())))
+        if self.session is not None:
+            inputs = {k: obs[k].cpu().numpy() if as_torch else obs[k] for k in self.obs_keys}
+            action = self.session.run(None, inputs)[0]
+            if as_torch:
+                import torch
+                return torch.from_numpy(action).to(next(iter(obs.values())).device)
+            return action
+        import torch
+        inputs = [obs[k] if as_torch else torch.from_numpy(obs[k]) for k in self.obs_keys]
+        with torch.inference_mode():
+            action = self.module(*[x.to(self.device) if self.device is not None else x for x in inputs])
+        return action if as_torch else action.cpu().numpy()
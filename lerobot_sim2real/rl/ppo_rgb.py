@@ -3,12 +3,16 @@
 Only modification is Args is renamed to PPOArgs, the main function is put inside a train function for cross-module use, and we provide support to modify env kwargs
 """
 from collections import defaultdict
+from contextlib import nullcontext
+import copy
 import json
 import os
+import queue
 import random
+import threading
 import time
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Literal, Optional, Tuple
 
 import gymnasium as gym
 import numpy as np
@@ -21,11 +25,19 @@ from torch.utils.tensorboard import SummaryWriter
 
 # ManiSkill specific imports
 import mani_skill.envs
+import lerobot_sim2real.envs.null_physics
 from mani_skill.utils import gym_utils
 from mani_skill.utils.wrappers.flatten import FlattenActionSpaceWrapper, FlattenRGBDObservationWrapper
 from mani_skill.utils.wrappers.record import RecordEpisode
 from mani_skill.vector.wrappers.gymnasium import ManiSkillVectorEnv
 
+from lerobot_sim2real.rl.checkpoint import (
+    FORMAT_VERSION, CheckpointWriter, get_rng_state, infer_agent_metadata, is_checkpoint, latest_checkpoint, load_agent_state_dict,
+    load_checkpoint, pack, set_rng_state, unpack,
+)
+from lerobot_sim2real.rl.gae import compute_gae
+from lerobot_sim2real.rl.profiling import PhaseTimer, TraceWindow
+
 @dataclass
 class PPOArgs:
     exp_name: Optional[str] = None
@@ -52,6 +64,12 @@ class PPOArgs:
     """if toggled, only runs evaluation with the given model checkpoint and saves the evaluation trajectories"""
     checkpoint: Optional[str] = None
     """path to a pretrained checkpoint file to start evaluation/training from"""
+    resume: Optional[str] = None
+    """path to a checkpoint saved by a previous run, or the run directory to use its latest checkpoint. Training continues in that run directory from the iteration of the checkpoint with its agent, optimizer, grad scaler, counters and RNG states. The envs are reset rather than restored and the rollout in progress is lost, so a resumed run does not exactly reproduce an uninterrupted one"""
+    keep_last_checkpoints: Optional[int] = None
+    """if set, only this many of the most recent ckpt_{iteration} checkpoints of the run are kept, plus those kept by `keep_best_checkpoints`. Checkpoints saved before a resume are left alone"""
+    keep_best_checkpoints: int = 0
+    """the number of checkpoints with the highest eval success_once to keep in addition to the most recent ones"""
     render_mode: str = "all"
     """the environment rendering mode"""
 
@@ -115,6 +133,34 @@ class PPOArgs:
     save_train_video_freq: Optional[int] = None
     """frequency to save training videos in terms of iterations"""
     finite_horizon_gae: bool = False
+    gae_chunk_size: Optional[int] = None
+    """the number of timesteps GAE processes per batched step. If None it is picked automatically from gamma and gae_lambda"""
+    sync_free_update: bool = False
+    """if toggled, the update loop keeps clipfrac and the target KL check on device and only synchronizes with the host once per epoch. Training then stops at the end of the epoch in which approx_kl first exceeded target_kl instead of right before the offending minibatch"""
+    buffered_logging: bool = False
+    """if toggled, logged scalars are buffered and reduced on device, then written out every `log_flush_interval` iterations from a background thread"""
+    log_flush_interval: int = 1
+    """how many iterations of logged scalars the buffered logger averages before writing them out"""
+    profile: bool = False
+    """if toggled, the phases of each iteration (env step, policy inference, GAE, backward etc.) are timed and logged under phase/"""
+    profile_sync: bool = False
+    """if toggled, phase timing synchronizes the device at the start and end of each phase so GPU time is attributed to the phase that launched it"""
+    profile_trace_iterations: Optional[Tuple[int, int]] = None
+    """if set to N M, iterations N..M are profiled with torch.profiler and a Chrome trace is saved to runs/{run_name}/traces"""
+    deferred_final_values: bool = False
+    """if toggled, final observations of finished episodes are stored during the rollout and their values are computed in one batched forward pass before GAE, instead of one forward pass per step"""
+    permuted_minibatches: bool = False
+    """if toggled, the flattened rollout is gathered into minibatch order once per epoch so that every minibatch is a contiguous slice, instead of fancy indexing every tensor for every minibatch. This needs a second copy of the rollout in memory"""
+    reuse_staging_buffer: bool = True
+    """if toggled, the staging buffer used by `permuted_minibatches` is allocated once and reused by every iteration instead of being allocated each iteration"""
+    amp_dtype: Optional[Literal["bfloat16", "float16"]] = None
+    """if set, the agent's forward passes during rollouts, evaluation and updates run under torch.autocast with this dtype. float16 also enables a grad scaler and is meant for GPUs. The action distribution, log-probs, values and losses are always computed in float32. bfloat16 also works on CPU"""
+    async_eval: bool = False
+    """if toggled, evaluation runs in a background thread that owns the eval envs (and their video recording) while training continues. The two threads take turns stepping the simulator, so the overlap is with the policy inference and updates. Every `eval_freq` iterations a snapshot of the agent's weights is handed to it, and eval/* metrics are logged at the global_step of the snapshot"""
+    async_eval_queue_size: int = 1
+    """the number of weight snapshots that can wait for the async evaluator. When it falls behind, the oldest waiting snapshot is dropped"""
+    channels_last: bool = False
+    """if toggled, the conv weights use the channels_last memory format so that the NHWC images from the env are used by the convs without a layout conversion"""
 
     # to be filled in runtime
     batch_size: int = 0
@@ -179,6 +225,65 @@ class DictArray(object):
         new_buffer_shape = next(iter(new_dict.values())).shape[:len(shape)]
         return DictArray(new_buffer_shape, None, data_dict=new_dict)
 
+class FinalObservationBuffer(object):
+    """Preallocated storage for the final observations of episodes that finish during a rollout, along with the step and env index
+    they finished at. This lets the values used for bootstrapping be computed in a single batched forward pass after the rollout."""
+    def __init__(self, capacity, element_space, device=None):
+        self.capacity = capacity
+        self.obs = DictArray((capacity,), element_space, device=device)
+        self.step_inds = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.env_inds = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.size = 0
+
+    def add(self, step, env_inds, final_obs):
+        end = self.size + len(env_inds)
+        self.obs[self.size:end] = {k: v[env_inds] for k, v in final_obs.items()}
+        self.step_inds[self.size:end] = step
+        self.env_inds[self.size:end] = env_inds
+        self.size = end
+
+    def compute_values(self, agent, final_values):
+        """writes the values of all stored final observations into final_values[step, env] and empties the buffer"""
+        if self.size > 0:
+            with torch.no_grad():
+                values = agent.get_value(self.obs[:self.size]).view(-1)
+            final_values[self.step_inds[:self.size], self.env_inds[:self.size]] = values
+        self.size = 0
+
+def _empty_like(x):
+    if isinstance(x, DictArray):
+        return DictArray(x.shape, None, data_dict={k: _empty_like(v) for k, v in x.data.items()})
+    return torch.empty_like(x)
+
+def _index_select(src, index, out):
+    if isinstance(src, DictArray):
+        for k, v in src.data.items():
+            _index_select(v, index, out.data[k])
+    else:
+        torch.index_select(src, 0, index, out=out)
+
+class MinibatchStagingBuffer(object):
+    """Contiguous storage for a flattened rollout (DictArrays and tensors sharing the batch dimension) gathered in minibatch order.
+    Gathering the whole batch once per epoch turns every minibatch into a slice view, instead of a separate gather of every tensor for
+    every minibatch."""
+    def __init__(self, batch):
+        self.buffers = [_empty_like(x) for x in batch]
+
+    def gather(self, index, batch):
+        """writes batch[i][index] into the staging buffers and returns them"""
+        for src, out in zip(batch, self.buffers):
+            _index_select(src, index, out)
+        return self.buffers
+
+class ImageStem(nn.Conv2d):
+    """The first conv layer of NatureCNN, which takes the uint8 NHWC frames from the env directly. The NHWC to NCHW permute is a view
+    (a channels_last input to the conv) and the 1/255 normalization is folded into the weights, so the only pass over the frames is the
+    cast to the compute dtype. The weights are stored unscaled, so the state dict is the same as that of the nn.Conv2d it replaces."""
+    def forward(self, x):
+        dtype = torch.get_autocast_dtype(x.device.type) if torch.is_autocast_enabled(x.device.type) else self.weight.dtype
+        x = x.permute(0, 3, 1, 2).to(dtype)
+        return self._conv_forward(x, self.weight / 255, self.bias)
+
 class NatureCNN(nn.Module):
     def __init__(self, sample_obs):
         super().__init__()
@@ -193,7 +298,7 @@ class NatureCNN(nn.Module):
 
         # here we use a NatureCNN architecture to process images, but any architecture is permissble here
         cnn = nn.Sequential(
-            nn.Conv2d(
+            ImageStem(
                 in_channels=in_channels,
                 out_channels=32,
                 kernel_size=8,
@@ -214,7 +319,7 @@ class NatureCNN(nn.Module):
 
         # to easily figure out the dimensions after flattening, we pass a test tensor
         with torch.no_grad():
-            n_flatten = cnn(sample_obs["rgb"].float().permute(0,3,1,2).cpu()).shape[1]
+            n_flatten = cnn(sample_obs["rgb"].cpu()).shape[1]
             fc = nn.Sequential(nn.Linear(n_flatten, feature_size), nn.ReLU())
         extractors["rgb"] = nn.Sequential(cnn, fc)
         self.out_features += feature_size
@@ -231,17 +336,20 @@ class NatureCNN(nn.Module):
         encoded_tensor_list = []
         # self.extractors contain nn.Modules that do all the processing.
         for key, extractor in self.extractors.items():
+            # rgb frames are normalized by the ImageStem
             obs = observations[key]
-            if key == "rgb":
-                obs = obs.float().permute(0,3,1,2)
-                obs = obs / 255
             encoded_tensor_list.append(extractor(obs))
         return torch.cat(encoded_tensor_list, dim=1)
 
 class Agent(nn.Module):
-    def __init__(self, envs, sample_obs):
+    def __init__(self, envs, sample_obs, action_dim=None):
         super().__init__()
+        if action_dim is None:
+            action_dim = int(np.prod(envs.unwrapped.single_action_space.shape))
+        self.action_dim = action_dim
         self.feature_net = NatureCNN(sample_obs=sample_obs)
+        self.obs_shapes = {k: list(sample_obs[k].shape[1:]) for k in self.feature_net.extractors}
+        self.obs_dtypes = {k: str(sample_obs[k].dtype)[len("torch."):] for k in self.feature_net.extractors}
         # latent_size = np.array(envs.unwrapped.single_observation_space.shape).prod()
         latent_size = self.feature_net.out_features
         self.critic = nn.Sequential(
@@ -252,17 +360,38 @@ class Agent(nn.Module):
         self.actor_mean = nn.Sequential(
             layer_init(nn.Linear(latent_size, 512)),
             nn.ReLU(inplace=True),
-            layer_init(nn.Linear(512, np.prod(envs.unwrapped.single_action_space.shape)), std=0.01*np.sqrt(2)),
+            layer_init(nn.Linear(512, action_dim), std=0.01*np.sqrt(2)),
         )
-        self.actor_logstd = nn.Parameter(torch.ones(1, np.prod(envs.unwrapped.single_action_space.shape)) * -0.5)
+        self.actor_logstd = nn.Parameter(torch.ones(1, action_dim) * -0.5)
+    def checkpoint_metadata(self):
+        """the architecture of the agent, stored in checkpoints so that `from_checkpoint` can build the agent without an env"""
+        return dict(obs_shapes=self.obs_shapes, obs_dtypes=self.obs_dtypes, action_dim=self.action_dim, feature_size=self.feature_net.out_features)
+    @classmethod
+    def from_checkpoint(cls, path, device=None):
+        """Builds an agent from the architecture stored in a checkpoint and loads its weights. Old torch.save(agent.state_dict()) files
+        are also accepted, with the architecture inferred from the weights (see checkpoint.infer_agent_metadata)"""
+        if is_checkpoint(path):
+            tensors, metadata = load_checkpoint(path)
+            state_dict = {k[len("agent/"):]: v for k, v in tensors.items() if k.startswith("agent/")}
+            metadata = metadata["agent"]
+        else:
+            state_dict = torch.load(path, map_location="cpu")
+            metadata = infer_agent_metadata(state_dict)
+        sample_obs = {k: torch.zeros((1, *shape), dtype=getattr(torch, metadata["obs_dtypes"][k])) for k, shape in metadata["obs_shapes"].items()}
+        agent = cls(None, sample_obs=sample_obs, action_dim=metadata["action_dim"])
+        if agent.feature_net.out_features != metadata["feature_size"]:
+            raise ValueError(f"the checkpoint's feature size {metadata['feature_size']} does not match the agent architecture")
+        agent.load_state_dict(state_dict)
+        return agent.to(device)
     def get_features(self, x):
         return self.feature_net(x)
+    # the heads' outputs are cast to float32 so that the action distribution and the losses stay in float32 under autocast
     def get_value(self, x):
         x = self.feature_net(x)
-        return self.critic(x)
+        return self.critic(x).float()
     def get_action(self, x, deterministic=False):
         x = self.feature_net(x)
-        action_mean = self.actor_mean(x)
+        action_mean = self.actor_mean(x).float()
         if deterministic:
             return action_mean
         action_logstd = self.actor_logstd.expand_as(action_mean)
@@ -271,13 +400,13 @@ class Agent(nn.Module):
         return probs.sample()
     def get_action_and_value(self, x, action=None):
         x = self.feature_net(x)
-        action_mean = self.actor_mean(x)
+        action_mean = self.actor_mean(x).float()
         action_logstd = self.actor_logstd.expand_as(action_mean)
         action_std = torch.exp(action_logstd)
         probs = Normal(action_mean, action_std)
         if action is None:
             action = probs.sample()
-        return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(x)
+        return action, probs.log_prob(action).sum(1), probs.entropy().sum(1), self.critic(x).float()
 
 class Logger:
     def __init__(self, log_wandb=False, tensorboard: SummaryWriter = None) -> None:
@@ -288,9 +417,375 @@ class Logger:
             import wandb
             wandb.log({tag: scalar_value}, step=step)
         self.writer.add_scalar(tag, scalar_value, step)
+    def add_masked_mean(self, tag, values, mask, step):
+        self.add_scalar(tag, values[mask].float().mean(), step)
+    def add_histogram(self, tag, values, step):
+        if self.log_wandb:
+            import wandb
+            wandb.log({tag: wandb.Histogram(values)}, step=step)
+        self.writer.add_histogram(tag, values, step)
+    def add_snapshot_scalars(self, scalars, snapshot_step, step):
+        """writes scalars that belong to an earlier step, e.g. the results of an evaluation of a snapshot of the agent that finished later.
+        tensorboard gets them at snapshot_step. wandb only accepts increasing steps, so they are logged at step along with snapshot_step
+        under "eval/global_step", which train() makes the x axis of eval/* charts"""
+        if self.log_wandb:
+            import wandb
+            wandb.log({**scalars, "eval/global_step": snapshot_step}, step=step)
+        for tag, value in scalars.items():
+            self.writer.add_scalar(tag, value, snapshot_step)
+    def flush(self, step):
+        """called once at the end of every training iteration"""
+        pass
     def close(self):
         self.writer.close()
 
+class BufferedLogger(Logger):
+    """Logger that buffers scalars, which can be device tensors, and writes them out in batches from a background thread.
+
+    Scalars logged to the same tag between two flushes are averaged (masked means are weighted by the number of masked elements)
+    and written at the step given to the flush. Nothing is copied off the device until then, and the copy of all buffered tensors is
+    a single non-blocking transfer that the background thread waits on, so logging never stalls the training loop. If writing fails,
+    the exception is raised again by the next call of `flush` or `close`.
+    """
+    def __init__(self, log_wandb=False, tensorboard: SummaryWriter = None, flush_interval: int = 1) -> None:
+        super().__init__(log_wandb=log_wandb, tensorboard=tensorboard)
+        self.flush_interval = flush_interval
+        self._sums = dict()
+        self._counts = dict()
+        self._histograms = defaultdict(list)
+        self._num_flush_calls = 0
+        self._last_step = 0
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+    def _accumulate(self, tag, value, count, step):
+        if tag in self._sums:
+            self._sums[tag] = self._sums[tag] + value
+            self._counts[tag] = self._counts[tag] + count
+        else:
+            self._sums[tag] = value
+            self._counts[tag] = count
+        self._last_step = step
+    def add_scalar(self, tag, scalar_value, step):
+        self._accumulate(tag, scalar_value, 1, step)
+    def add_masked_mean(self, tag, values, mask, step):
+        self._accumulate(tag, (values.float() * mask).sum(), mask.sum(), step)
+    def add_histogram(self, tag, values, step):
+        """values is a numpy array. Histograms logged to the same tag between flushes are concatenated"""
+        self._histograms[tag].append(values)
+        self._last_step = step
+    def flush(self, step, force=False):
+        self._raise_error()
+        self._num_flush_calls += 1
+        if (len(self._sums) == 0 and len(self._histograms) == 0) or (not force and self._num_flush_calls % self.flush_interval != 0):
+            return
+        scalars = dict()
+        device_means = defaultdict(dict)
+        for tag, value in self._sums.items():
+            mean = value / self._counts[tag]
+            if isinstance(mean, torch.Tensor):
+                device_means[mean.device][tag] = mean.float()
+            else:
+                scalars[tag] = mean
+        transfers = []
+        for device, means in device_means.items():
+            stacked = torch.stack(list(means.values()))
+            event = None
+            if stacked.is_cuda:
+                host = torch.empty(stacked.shape, dtype=stacked.dtype, pin_memory=True)
+                host.copy_(stacked, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                stacked = host
+            transfers.append((list(means.keys()), stacked, event))
+        histograms = {tag: np.concatenate(values) for tag, values in self._histograms.items()}
+        self._queue.put((step, scalars, transfers, histograms))
+        self._sums.clear()
+        self._counts.clear()
+        self._histograms.clear()
+    def add_snapshot_scalars(self, scalars, snapshot_step, step):
+        # written from the background thread, in order with the buffered scalars
+        self._queue.put(lambda: Logger.add_snapshot_scalars(self, scalars, snapshot_step, step))
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("writing logs failed") from self._error
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                # the error is raised in the training thread, the rest is dropped
+                continue
+            try:
+                self._write(item)
+            except Exception as e:
+                self._error = e
+    def _write(self, item):
+        if callable(item):
+            item()
+            return
+        step, scalars, transfers, histograms = item
+        for tags, values, event in transfers:
+            if event is not None:
+                event.synchronize()
+            scalars.update(zip(tags, values.tolist()))
+        if self.log_wandb:
+            import wandb
+            wandb.log({**scalars, **{tag: wandb.Histogram(values) for tag, values in histograms.items()}}, step=step)
+        for tag, value in scalars.items():
+            self.writer.add_scalar(tag, value, step)
+        for tag, values in histograms.items():
+            self.writer.add_histogram(tag, values, step)
+    def close(self):
+        if self._error is None:
+            self.flush(self._last_step, force=True)
+        self._queue.put(None)
+        self._thread.join()
+        super().close()
+        self._raise_error()
+
+def evaluate(agent, eval_envs, num_eval_steps, autocast=nullcontext, sim_lock=None):
+    """steps eval_envs with the deterministic policy for num_eval_steps, returns the mean of every episode metric and the number of episodes.
+    If given, sim_lock is held while eval_envs are reset or stepped"""
+    sim_lock = nullcontext() if sim_lock is None else sim_lock
+    with sim_lock:
+        eval_obs, _ = eval_envs.reset()
+    eval_metrics = defaultdict(list)
+    num_episodes = 0
+    for _ in range(num_eval_steps):
+        with torch.no_grad():
+            with autocast():
+                eval_action = agent.get_action(eval_obs, deterministic=True)
+            with sim_lock:
+                eval_obs, eval_rew, eval_terminations, eval_truncations, eval_infos = eval_envs.step(eval_action)
+            if "final_info" in eval_infos:
+                mask = eval_infos["_final_info"]
+                num_episodes += mask.sum()
+                for k, v in eval_infos["final_info"]["episode"].items():
+                    eval_metrics[k].append(v)
+    return {k: torch.stack(v).float().mean() for k, v in eval_metrics.items()}, num_episodes
+
+class AsyncEvaluator(object):
+    """Evaluates snapshots of the agent in a background thread that owns the eval envs, so training does not wait for evaluation.
+
+    `submit` copies the agent's weights along with the global_step they were trained to. At most `max_pending` snapshots wait to be
+    evaluated and when evaluation falls behind the oldest one is dropped. `results` returns the evaluations finished since the last call.
+
+    The eval envs and the training envs share the simulator and GPU, which must not be stepped from two threads at once. The thread holds
+    `sim_lock` whenever it resets or steps the eval envs, so the training loop must hold it whenever it resets or steps its own envs.
+
+    If an evaluation raises, the thread stops and the exception is raised again by the next call of `submit`, `results` or `close`.
+    """
+    def __init__(self, eval_envs, agent, num_eval_steps, max_pending=1, autocast=nullcontext):
+        self.eval_envs = eval_envs
+        self.agent = copy.deepcopy(agent).eval()
+        self.num_eval_steps = num_eval_steps
+        self.autocast = autocast
+        self.num_dropped = 0
+        self.sim_lock = threading.Lock()
+        self._snapshots = queue.Queue(maxsize=max_pending)
+        self._results = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._eval_loop, daemon=True)
+        self._thread.start()
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("the async evaluator failed") from self._error
+    def submit(self, agent, global_step):
+        self._raise_error()
+        snapshot = (global_step, {k: v.detach().clone() for k, v in agent.state_dict().items()})
+        while True:
+            try:
+                self._snapshots.put_nowait(snapshot)
+                return
+            except queue.Full:
+                try:
+                    self._snapshots.get_nowait()
+                    self.num_dropped += 1
+                except queue.Empty:
+                    pass
+    def results(self):
+        """returns a list of (global_step, metrics, num_episodes, eval_time) of the evaluations finished since the last call. If the thread
+        failed, the evaluations it finished before are returned first and the exception is raised once there are none left"""
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                break
+        if len(results) == 0:
+            self._raise_error()
+        return results
+    def _eval_loop(self):
+        try:
+            while True:
+                snapshot = self._snapshots.get()
+                if snapshot is None:
+                    break
+                global_step, state_dict = snapshot
+                self.agent.load_state_dict(state_dict)
+                stime = time.perf_counter()
+                metrics, num_episodes = evaluate(self.agent, self.eval_envs, self.num_eval_steps, self.autocast, self.sim_lock)
+                metrics = {k: v.item() for k, v in metrics.items()}
+                self._results.put((global_step, metrics, int(num_episodes), time.perf_counter() - stime))
+        except BaseException as e:
+            self._error = e
+    def close(self):
+        """waits for the snapshots already submitted to be evaluated and stops the thread"""
+        # a thread that failed no longer takes snapshots off the queue, so do not wait for room in it
+        while self._thread.is_alive():
+            try:
+                self._snapshots.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._thread.join()
+        self._raise_error()
+
+def training_checkpoint(agent, optimizer, scaler, iteration, global_step, cumulative_times, args, env_kwargs):
+    """returns the tensors and metadata of a checkpoint that training can be resumed from at the start of `iteration`"""
+    tensors = {f"agent/{k}": v for k, v in agent.state_dict().items()}
+    training = dict(
+        optimizer=optimizer.state_dict(),
+        scaler=scaler.state_dict(),
+        iteration=iteration,
+        global_step=global_step,
+        cumulative_times=dict(cumulative_times),
+        rng=get_rng_state(),
+    )
+    metadata = dict(
+        format_version=FORMAT_VERSION,
+        agent=agent.checkpoint_metadata(),
+        env_id=args.env_id,
+        # anything that is not JSON serializable is stored as a string
+        env_kwargs=json.loads(json.dumps(env_kwargs, default=str)),
+        args=json.loads(json.dumps(vars(args), default=str)),
+        training=pack(training, tensors, "training"),
+    )
+    return tensors, metadata
+
+def update(agent, optimizer, scaler, args: PPOArgs, rollout_batch, staging_buffer=None, timer=None, autocast=nullcontext):
+    """Runs the PPO update epochs of one iteration on a flattened rollout, rollout_batch = (b_obs, b_logprobs, b_actions, b_advantages,
+    b_returns, b_values). Returns the loss statistics of the update as floats, the number of host-device synchronizations it did and the
+    staging buffer of `permuted_minibatches`, which can be passed to the next update to be reused"""
+    timer = PhaseTimer() if timer is None else timer
+    agent.train()
+    b_obs, b_logprobs, b_actions, b_advantages, b_returns, b_values = rollout_batch
+    device = b_returns.device
+    b_inds = np.arange(args.batch_size)
+    if args.permuted_minibatches:
+        if staging_buffer is None or not args.reuse_staging_buffer:
+            staging_buffer = MinibatchStagingBuffer(rollout_batch)
+    clipfracs = []
+    num_syncs = 0 # number of host-device synchronizations done by the update and its logging
+    if args.sync_free_update:
+        kl_exceeded = torch.zeros((), dtype=torch.bool, device=device)
+    for epoch in range(args.update_epochs):
+        if args.sync_free_update:
+            b_inds = torch.randperm(args.batch_size, device=device)
+        else:
+            np.random.shuffle(b_inds)
+        if args.permuted_minibatches:
+            with timer.scope("minibatch_gather"):
+                b_obs, b_logprobs, b_actions, b_advantages, b_returns, b_values = staging_buffer.gather(
+                    torch.as_tensor(b_inds, device=device), rollout_batch
+                )
+        for start in range(0, args.batch_size, args.minibatch_size):
+            end = start + args.minibatch_size
+            # the staged batch is already in minibatch order
+            mb_inds = slice(start, end) if args.permuted_minibatches else b_inds[start:end]
+
+            with timer.scope("minibatch_gather"):
+                mb_obs, mb_actions = b_obs[mb_inds], b_actions[mb_inds]
+            with timer.scope("forward"), autocast():
+                _, newlogprob, entropy, newvalue = agent.get_action_and_value(mb_obs, mb_actions)
+            logratio = newlogprob - b_logprobs[mb_inds]
+            ratio = logratio.exp()
+
+            with torch.no_grad():
+                # calculate approx_kl http://joschu.net/blog/kl-approx.html
+                old_approx_kl = (-logratio).mean()
+                approx_kl = ((ratio - 1) - logratio).mean()
+                clipfrac = ((ratio - 1.0).abs() > args.clip_coef).float().mean()
+                if args.sync_free_update:
+                    clipfracs.append(clipfrac)
+                    if args.target_kl is not None:
+                        kl_exceeded |= approx_kl > args.target_kl
+                else:
+                    clipfracs += [clipfrac.item()]
+                    num_syncs += 1
+
+            if not args.sync_free_update and args.target_kl is not None:
+                num_syncs += 1
+                if approx_kl > args.target_kl:
+                    break
+
+            mb_advantages = b_advantages[mb_inds]
+            if args.norm_adv:
+                mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
+
+            # Policy loss
+            pg_loss1 = -mb_advantages * ratio
+            pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
+            pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+
+            # Value loss
+            newvalue = newvalue.view(-1)
+            if args.clip_vloss:
+                v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
+                v_clipped = b_values[mb_inds] + torch.clamp(
+                    newvalue - b_values[mb_inds],
+                    -args.clip_coef,
+                    args.clip_coef,
+                )
+                v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
+                v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+                v_loss = 0.5 * v_loss_max.mean()
+            else:
+                v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
+
+            entropy_loss = entropy.mean()
+            loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
+
+            with timer.scope("backward"):
+                optimizer.zero_grad()
+                scaler.scale(loss).backward()
+                scaler.unscale_(optimizer)
+                nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
+            with timer.scope("optimizer_step"):
+                scaler.step(optimizer)
+                scaler.update()
+
+        if args.target_kl is not None:
+            num_syncs += 1
+            stop = kl_exceeded.item() if args.sync_free_update else approx_kl > args.target_kl
+            if stop:
+                break
+    if args.sync_free_update:
+        # reduce everything on device and copy it to the host at once
+        var_y = b_returns.var(unbiased=False)
+        explained_var = torch.where(var_y == 0, torch.nan, 1 - (b_returns - b_values).var(unbiased=False) / var_y)
+        clipfrac = torch.stack(clipfracs).mean()
+        v_loss, pg_loss, entropy_loss, old_approx_kl, approx_kl, clipfrac, explained_var = torch.stack(
+            [v_loss, pg_loss, entropy_loss, old_approx_kl, approx_kl, clipfrac, explained_var]
+        ).tolist()
+        num_syncs += 1
+    else:
+        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
+        var_y = np.var(y_true)
+        explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
+        clipfrac = np.mean(clipfracs)
+        v_loss, pg_loss, entropy_loss, old_approx_kl, approx_kl = v_loss.item(), pg_loss.item(), entropy_loss.item(), old_approx_kl.item(), approx_kl.item()
+        num_syncs += 7
+
+    stats = dict(
+        value_loss=v_loss, policy_loss=pg_loss, entropy=entropy_loss, old_approx_kl=old_approx_kl, approx_kl=approx_kl, clipfrac=clipfrac,
+        explained_variance=explained_var,
+    )
+    return stats, num_syncs, staging_buffer
+
 def train(args: PPOArgs):
     args.batch_size = int(args.num_envs * args.num_steps)
     args.minibatch_size = int(args.batch_size // args.num_minibatches)
@@ -300,6 +795,9 @@ def train(args: PPOArgs):
         run_name = f"{args.env_id}__{args.exp_name}__{args.seed}__{int(time.time())}"
     else:
         run_name = args.exp_name
+    if args.resume is not None:
+        resume_path = latest_checkpoint(args.resume) if os.path.isdir(args.resume) else args.resume
+        run_name = os.path.relpath(os.path.dirname(os.path.abspath(resume_path)), os.path.abspath("runs"))
 
     # TRY NOT TO MODIFY: seeding
     random.seed(args.seed)
@@ -317,30 +815,35 @@ def train(args: PPOArgs):
         env_kwargs["control_mode"] = args.control_mode
     env_kwargs.update(args.env_kwargs)
 
-    eval_envs = gym.make(args.env_id, num_envs=args.num_eval_envs, reconfiguration_freq=args.eval_reconfiguration_freq, **env_kwargs)
-    envs = gym.make(args.env_id, num_envs=args.num_envs if not args.evaluate else 1, reconfiguration_freq=args.reconfiguration_freq, **env_kwargs)
-
-    # rgbd obs mode returns a dict of data, we flatten it so there is just a rgbd key and state key
-    envs = FlattenRGBDObservationWrapper(envs, rgb=True, depth=False, state=args.include_state)
-    eval_envs = FlattenRGBDObservationWrapper(eval_envs, rgb=True, depth=False, state=args.include_state)
-
-    if isinstance(envs.action_space, gym.spaces.Dict):
-        envs = FlattenActionSpaceWrapper(envs)
-        eval_envs = FlattenActionSpaceWrapper(eval_envs)
-    if args.capture_video:
-        eval_output_dir = f"runs/{run_name}/videos"
-        if args.evaluate:
-            eval_output_dir = f"{os.path.dirname(args.checkpoint)}/test_videos"
-        print(f"Saving eval videos to {eval_output_dir}")
-        if args.save_train_video_freq is not None:
-            save_video_trigger = lambda x : (x // args.num_steps) % args.save_train_video_freq == 0
-            envs = RecordEpisode(envs, output_dir=f"runs/{run_name}/train_videos", save_trajectory=False, save_video_trigger=save_video_trigger, max_steps_per_video=args.num_steps, video_fps=eval_envs.unwrapped.control_freq)
-        eval_envs = RecordEpisode(eval_envs, output_dir=eval_output_dir, save_trajectory=args.evaluate, trajectory_name="trajectory", max_steps_per_video=args.num_eval_steps, video_fps=eval_envs.unwrapped.control_freq, info_on_video=True)
-    envs = ManiSkillVectorEnv(envs, args.num_envs, ignore_terminations=not args.partial_reset, record_metrics=True)
-    eval_envs = ManiSkillVectorEnv(eval_envs, args.num_eval_envs, ignore_terminations=not args.eval_partial_reset, record_metrics=True)
-    assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
+    if gym.spec(args.env_id).vector_entry_point is not None:
+        # stand-in vector envs like SO100PushCubeNullPhysics-v1 already return flattened observations and auto reset like ManiSkillVectorEnv
+        envs = gym.make_vec(args.env_id, num_envs=args.num_envs if not args.evaluate else 1, vectorization_mode="vector_entry_point", ignore_terminations=not args.partial_reset, device=device, **args.env_kwargs)
+        eval_envs = gym.make_vec(args.env_id, num_envs=args.num_eval_envs, vectorization_mode="vector_entry_point", ignore_terminations=not args.eval_partial_reset, device=device, **args.env_kwargs)
+        max_episode_steps = envs.max_episode_steps
+    else:
+        eval_envs = gym.make(args.env_id, num_envs=args.num_eval_envs, reconfiguration_freq=args.eval_reconfiguration_freq, **env_kwargs)
+        envs = gym.make(args.env_id, num_envs=args.num_envs if not args.evaluate else 1, reconfiguration_freq=args.reconfiguration_freq, **env_kwargs)
 
-    max_episode_steps = gym_utils.find_max_episode_steps_value(envs._env)
+        # rgbd obs mode returns a dict of data, we flatten it so there is just a rgbd key and state key
+        envs = FlattenRGBDObservationWrapper(envs, rgb=True, depth=False, state=args.include_state)
+        eval_envs = FlattenRGBDObservationWrapper(eval_envs, rgb=True, depth=False, state=args.include_state)
+
+        if isinstance(envs.action_space, gym.spaces.Dict):
+            envs = FlattenActionSpaceWrapper(envs)
+            eval_envs = FlattenActionSpaceWrapper(eval_envs)
+        if args.capture_video:
+            eval_output_dir = f"runs/{run_name}/videos"
+            if args.evaluate:
+                eval_output_dir = f"{os.path.dirname(args.checkpoint)}/test_videos"
+            print(f"Saving eval videos to {eval_output_dir}")
+            if args.save_train_video_freq is not None:
+                save_video_trigger = lambda x : (x // args.num_steps) % args.save_train_video_freq == 0
+                envs = RecordEpisode(envs, output_dir=f"runs/{run_name}/train_videos", save_trajectory=False, save_video_trigger=save_video_trigger, max_steps_per_video=args.num_steps, video_fps=eval_envs.unwrapped.control_freq)
+            eval_envs = RecordEpisode(eval_envs, output_dir=eval_output_dir, save_trajectory=args.evaluate, trajectory_name="trajectory", max_steps_per_video=args.num_eval_steps, video_fps=eval_envs.unwrapped.control_freq, info_on_video=True)
+        envs = ManiSkillVectorEnv(envs, args.num_envs, ignore_terminations=not args.partial_reset, record_metrics=True)
+        eval_envs = ManiSkillVectorEnv(eval_envs, args.num_eval_envs, ignore_terminations=not args.eval_partial_reset, record_metrics=True)
+        max_episode_steps = gym_utils.find_max_episode_steps_value(envs._env)
+    assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
     logger = None
     if not args.evaluate:
         print("Running training")
@@ -364,7 +867,10 @@ def train(args: PPOArgs):
             "hyperparameters",
             "|param|value|\n|-|-|\n%s" % ("\n".join([f"|{key}|{value}|" for key, value in vars(args).items()])),
         )
-        logger = Logger(log_wandb=args.track, tensorboard=writer)
+        if args.buffered_logging:
+            logger = BufferedLogger(log_wandb=args.track, tensorboard=writer, flush_interval=args.log_flush_interval)
+        else:
+            logger = Logger(log_wandb=args.track, tensorboard=writer)
     else:
         print("Running evaluation")
 
@@ -375,6 +881,11 @@ def train(args: PPOArgs):
     rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
     dones = torch.zeros((args.num_steps, args.num_envs)).to(device)
     values = torch.zeros((args.num_steps, args.num_envs)).to(device)
+    if args.deferred_final_values:
+        # enough room for every env to finish an episode of max_episode_steps as often as it can within a rollout. If episodes end early
+        # and the buffer fills up, the stored values are computed early to make room
+        max_episodes_per_rollout = 1 if max_episode_steps is None else -(-args.num_steps // max_episode_steps)
+        final_obs_buffer = FinalObservationBuffer(args.num_envs * max_episodes_per_rollout, envs.single_observation_space, device=device)
 
     # TRY NOT TO MODIFY: start the game
     global_step = 0
@@ -387,34 +898,85 @@ def train(args: PPOArgs):
     print(f"args.minibatch_size={args.minibatch_size} args.batch_size={args.batch_size} args.update_epochs={args.update_epochs}")
     print(f"####")
     agent = Agent(envs, sample_obs=next_obs).to(device)
+    if args.channels_last:
+        agent = agent.to(memory_format=torch.channels_last)
     optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
+    amp_dtype = None if args.amp_dtype is None else getattr(torch, args.amp_dtype)
+    autocast = lambda: torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
+    # loss scaling is only needed for float16, the scaler is a no-op otherwise
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp_dtype == "float16")
 
     if args.checkpoint:
-        agent.load_state_dict(torch.load(args.checkpoint))
+        agent.load_state_dict(load_agent_state_dict(args.checkpoint))
+
+    async_evaluator = None
+    if args.async_eval and not args.evaluate:
+        async_evaluator = AsyncEvaluator(eval_envs, agent, args.num_eval_steps, max_pending=args.async_eval_queue_size, autocast=autocast)
+        if args.track:
+            wandb.define_metric("eval/*", step_metric="eval/global_step")
+    # the training envs are only stepped while holding the lock the async evaluator steps the eval envs with
+    sim_lock = async_evaluator.sim_lock if async_evaluator is not None else nullcontext()
+
+    def log_async_eval_results(step):
+        for snapshot_step, eval_metrics, num_episodes, eval_time in async_evaluator.results():
+            print(f"Evaluated the agent at global_step={snapshot_step} over {args.num_eval_steps * args.num_eval_envs} steps resulting in {num_episodes} episodes")
+            for k, mean in eval_metrics.items():
+                print(f"eval_{k}_mean={mean}")
+            logger.add_snapshot_scalars(
+                {**{f"eval/{k}": mean for k, mean in eval_metrics.items()}, "time/eval_time": eval_time, "eval/dropped_snapshots": async_evaluator.num_dropped},
+                snapshot_step, step,
+            )
+            # snapshots are evaluated in order, so checkpoints of older snapshots still waiting for a score were dropped
+            for dropped_step in [s for s in snapshot_checkpoints if s < snapshot_step]:
+                checkpoint_writer.set_score(snapshot_checkpoints.pop(dropped_step), None)
+            if snapshot_step in snapshot_checkpoints:
+                checkpoint_writer.set_score(snapshot_checkpoints.pop(snapshot_step), eval_metrics.get("success_once"))
 
     cumulative_times = defaultdict(float)
+    staging_buffer = None
+    timer = PhaseTimer(enabled=args.profile or args.profile_trace_iterations is not None, synchronize=args.profile_sync, device=device)
+    trace_window = None
+    if args.profile_trace_iterations is not None:
+        trace_window = TraceWindow(*args.profile_trace_iterations, output_dir=f"runs/{run_name}/traces")
+
+    checkpoint_writer = None
+    if args.save_model and not args.evaluate:
+        checkpoint_writer = CheckpointWriter(keep_last=args.keep_last_checkpoints, keep_best=args.keep_best_checkpoints)
+    snapshot_checkpoints = dict() # global_step -> checkpoint path of snapshots being evaluated asynchronously
 
-    for iteration in range(1, args.num_iterations + 1):
+    start_iteration = 1
+    if args.resume is not None:
+        tensors, metadata = load_checkpoint(resume_path)
+        training = unpack(metadata["training"], tensors)
+        agent.load_state_dict({k[len("agent/"):]: v for k, v in tensors.items() if k.startswith("agent/")})
+        optimizer.load_state_dict(training["optimizer"])
+        scaler.load_state_dict(training["scaler"])
+        start_iteration, global_step = training["iteration"], training["global_step"]
+        cumulative_times.update(training["cumulative_times"])
+        # restored last, as everything above may consume random numbers
+        set_rng_state(training["rng"])
+        print(f"Resuming {run_name} from {resume_path} at iteration {start_iteration}, global_step={global_step}")
+    # steps per second only count the steps taken by this process, not the ones restored from the checkpoint
+    start_global_step = global_step
+
+    for iteration in range(start_iteration, args.num_iterations + 1):
+        if trace_window is not None:
+            trace_window.step(iteration)
         print(f"Epoch: {iteration}, global_step={global_step}")
         final_values = torch.zeros((args.num_steps, args.num_envs), device=device)
         agent.eval()
-        if iteration % args.eval_freq == 1:
+        # a checkpoint is saved right after the evaluation of its iteration, so a resumed run skips both
+        eval_iteration = iteration % args.eval_freq == 1 and not (args.resume is not None and iteration == start_iteration)
+        if async_evaluator is not None:
+            log_async_eval_results(global_step)
+            if eval_iteration:
+                async_evaluator.submit(agent, global_step)
+        elif eval_iteration:
             print("Evaluating")
             stime = time.perf_counter()
-            eval_obs, _ = eval_envs.reset()
-            eval_metrics = defaultdict(list)
-            num_episodes = 0
-            for _ in range(args.num_eval_steps):
-                with torch.no_grad():
-                    eval_obs, eval_rew, eval_terminations, eval_truncations, eval_infos = eval_envs.step(agent.get_action(eval_obs, deterministic=True))
-                    if "final_info" in eval_infos:
-                        mask = eval_infos["_final_info"]
-                        num_episodes += mask.sum()
-                        for k, v in eval_infos["final_info"]["episode"].items():
-                            eval_metrics[k].append(v)
+            eval_metrics, num_episodes = evaluate(agent, eval_envs, args.num_eval_steps, autocast)
             print(f"Evaluated {args.num_eval_steps * args.num_eval_envs} steps resulting in {num_episodes} episodes")
-            for k, v in eval_metrics.items():
-                mean = torch.stack(v).float().mean()
+            for k, mean in eval_metrics.items():
                 if logger is not None:
                     logger.add_scalar(f"eval/{k}", mean, global_step)
                 print(f"eval_{k}_mean={mean}")
@@ -424,10 +986,18 @@ def train(args: PPOArgs):
                 logger.add_scalar("time/eval_time", eval_time, global_step)
             if args.evaluate:
                 break
-        if args.save_model and iteration % args.eval_freq == 1:
-            model_path = f"runs/{run_name}/ckpt_{iteration}.pt"
-            torch.save(agent.state_dict(), model_path)
-            print(f"model saved to {model_path}")
+        if args.save_model and eval_iteration:
+            model_path = f"runs/{run_name}/ckpt_{iteration}.ckpt"
+            score = None
+            if async_evaluator is not None:
+                snapshot_checkpoints[global_step] = model_path
+            elif "success_once" in eval_metrics:
+                score = eval_metrics["success_once"].item()
+            checkpoint_writer.save(
+                model_path, *training_checkpoint(agent, optimizer, scaler, iteration, global_step, cumulative_times, args, env_kwargs), score=score,
+                score_pending=async_evaluator is not None,
+            )
+            print(f"saving model to {model_path}")
         # Annealing the rate if instructed to do so.
         if args.anneal_lr:
             frac = 1.0 - (iteration - 1.0) / args.num_iterations
@@ -440,70 +1010,50 @@ def train(args: PPOArgs):
             dones[step] = next_done
 
             # ALGO LOGIC: action logic
-            with torch.no_grad():
+            with torch.no_grad(), timer.scope("policy_inference"), autocast():
                 action, logprob, _, value = agent.get_action_and_value(next_obs)
                 values[step] = value.flatten()
             actions[step] = action
             logprobs[step] = logprob
 
             # TRY NOT TO MODIFY: execute the game and log data.
-            next_obs, reward, terminations, truncations, infos = envs.step(action)
+            with timer.scope("env_step"), sim_lock:
+                next_obs, reward, terminations, truncations, infos = envs.step(action)
             next_done = torch.logical_or(terminations, truncations).to(torch.float32)
             rewards[step] = reward.view(-1) * args.reward_scale
 
             if "final_info" in infos:
                 final_info = infos["final_info"]
                 done_mask = infos["_final_info"]
-                for k, v in final_info["episode"].items():
-                    logger.add_scalar(f"train/{k}", v[done_mask].float().mean(), global_step)
+                with timer.scope("logging"):
+                    for k, v in final_info["episode"].items():
+                        logger.add_masked_mean(f"train/{k}", v, done_mask, global_step)
 
-                for k in infos["final_observation"]:
-                    infos["final_observation"][k] = infos["final_observation"][k][done_mask]
-                with torch.no_grad():
-                    final_values[step, torch.arange(args.num_envs, device=device)[done_mask]] = agent.get_value(infos["final_observation"]).view(-1)
+                with timer.scope("final_values"):
+                    if args.deferred_final_values:
+                        done_env_inds = torch.arange(args.num_envs, device=device)[done_mask]
+                        if final_obs_buffer.size + len(done_env_inds) > final_obs_buffer.capacity:
+                            with autocast():
+                                final_obs_buffer.compute_values(agent, final_values)
+                        final_obs_buffer.add(step, done_env_inds, infos["final_observation"])
+                    else:
+                        for k in infos["final_observation"]:
+                            infos["final_observation"][k] = infos["final_observation"][k][done_mask]
+                        with torch.no_grad(), autocast():
+                            final_values[step, torch.arange(args.num_envs, device=device)[done_mask]] = agent.get_value(infos["final_observation"]).view(-1)
+        if args.deferred_final_values:
+            with timer.scope("final_values"), autocast():
+                final_obs_buffer.compute_values(agent, final_values)
         rollout_time = time.perf_counter() - rollout_time
         cumulative_times["rollout_time"] += rollout_time
         # bootstrap value according to termination and truncation
-        with torch.no_grad():
-            next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    next_not_done = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    next_not_done = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                real_next_values = next_not_done * nextvalues + final_values[t] # t instead of t+1
-                # next_not_done means nextvalues is computed from the correct next_obs
-                # if next_not_done is 1, final_values is always 0
-                # if next_not_done is 0, then use final_values, which is computed according to bootstrap_at_done
-                if args.finite_horizon_gae:
-                    """
-                    See GAE paper equation(16) line 1, we will compute the GAE based on this line only
-                    1             *(  -V(s_t)  + r_t                                                               + gamma * V(s_{t+1})   )
-                    lambda        *(  -V(s_t)  + r_t + gamma * r_{t+1}                                             + gamma^2 * V(s_{t+2}) )
-                    lambda^2      *(  -V(s_t)  + r_t + gamma * r_{t+1} + gamma^2 * r_{t+2}                         + ...                  )
-                    lambda^3      *(  -V(s_t)  + r_t + gamma * r_{t+1} + gamma^2 * r_{t+2} + gamma^3 * r_{t+3}
-                    We then normalize it by the sum of the lambda^i (instead of 1-lambda)
-                    """
-                    if t == args.num_steps - 1: # initialize
-                        lam_coef_sum = 0.
-                        reward_term_sum = 0. # the sum of the second term
-                        value_term_sum = 0. # the sum of the third term
-                    lam_coef_sum = lam_coef_sum * next_not_done
-                    reward_term_sum = reward_term_sum * next_not_done
-                    value_term_sum = value_term_sum * next_not_done
-
-                    lam_coef_sum = 1 + args.gae_lambda * lam_coef_sum
-                    reward_term_sum = args.gae_lambda * args.gamma * reward_term_sum + lam_coef_sum * rewards[t]
-                    value_term_sum = args.gae_lambda * args.gamma * value_term_sum + args.gamma * real_next_values
-
-                    advantages[t] = (reward_term_sum + value_term_sum) / lam_coef_sum - values[t]
-                else:
-                    delta = rewards[t] + args.gamma * real_next_values - values[t]
-                    advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * next_not_done * lastgaelam # Here actually we should use next_not_terminated, but we don't have lastgamlam if terminated
+        with torch.no_grad(), timer.scope("gae"):
+            with autocast():
+                next_value = agent.get_value(next_obs).reshape(1, -1)
+            advantages = compute_gae(
+                rewards, values, dones, final_values, next_value, next_done,
+                gamma=args.gamma, gae_lambda=args.gae_lambda, finite_horizon_gae=args.finite_horizon_gae, chunk_size=args.gae_chunk_size,
+            )
             returns = advantages + values
 
         # flatten the batch
@@ -515,89 +1065,41 @@ def train(args: PPOArgs):
         b_values = values.reshape(-1)
 
         # Optimizing the policy and value network
-        agent.train()
-        b_inds = np.arange(args.batch_size)
-        clipfracs = []
         update_time = time.perf_counter()
-        for epoch in range(args.update_epochs):
-            np.random.shuffle(b_inds)
-            for start in range(0, args.batch_size, args.minibatch_size):
-                end = start + args.minibatch_size
-                mb_inds = b_inds[start:end]
-
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions[mb_inds])
-                logratio = newlogprob - b_logprobs[mb_inds]
-                ratio = logratio.exp()
-
-                with torch.no_grad():
-                    # calculate approx_kl http://joschu.net/blog/kl-approx.html
-                    old_approx_kl = (-logratio).mean()
-                    approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs += [((ratio - 1.0).abs() > args.clip_coef).float().mean().item()]
-
-                if args.target_kl is not None and approx_kl > args.target_kl:
-                    break
-
-                mb_advantages = b_advantages[mb_inds]
-                if args.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                # Value loss
-                newvalue = newvalue.view(-1)
-                if args.clip_vloss:
-                    v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                    v_clipped = b_values[mb_inds] + torch.clamp(
-                        newvalue - b_values[mb_inds],
-                        -args.clip_coef,
-                        args.clip_coef,
-                    )
-                    v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
-
-                entropy_loss = entropy.mean()
-                loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
-
-                optimizer.zero_grad()
-                loss.backward()
-                nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
-                optimizer.step()
-
-            if args.target_kl is not None and approx_kl > args.target_kl:
-                break
+        update_stats, num_syncs, staging_buffer = update(
+            agent, optimizer, scaler, args, (b_obs, b_logprobs, b_actions, b_advantages, b_returns, b_values), staging_buffer, timer, autocast
+        )
         update_time = time.perf_counter() - update_time
         cumulative_times["update_time"] += update_time
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
 
-        logger.add_scalar("charts/learning_rate", optimizer.param_groups[0]["lr"], global_step)
-        logger.add_scalar("losses/value_loss", v_loss.item(), global_step)
-        logger.add_scalar("losses/policy_loss", pg_loss.item(), global_step)
-        logger.add_scalar("losses/entropy", entropy_loss.item(), global_step)
-        logger.add_scalar("losses/old_approx_kl", old_approx_kl.item(), global_step)
-        logger.add_scalar("losses/approx_kl", approx_kl.item(), global_step)
-        logger.add_scalar("losses/clipfrac", np.mean(clipfracs), global_step)
-        logger.add_scalar("losses/explained_variance", explained_var, global_step)
-        print("SPS:", int(global_step / (time.time() - start_time)))
-        logger.add_scalar("charts/SPS", int(global_step / (time.time() - start_time)), global_step)
-        logger.add_scalar("time/step", global_step, global_step)
-        logger.add_scalar("time/update_time", update_time, global_step)
-        logger.add_scalar("time/rollout_time", rollout_time, global_step)
-        logger.add_scalar("time/rollout_fps", args.num_envs * args.num_steps / rollout_time, global_step)
-        for k, v in cumulative_times.items():
-            logger.add_scalar(f"time/total_{k}", v, global_step)
-        logger.add_scalar("time/total_rollout+update_time", cumulative_times["rollout_time"] + cumulative_times["update_time"], global_step)
+        with timer.scope("logging"):
+            logger.add_scalar("charts/learning_rate", optimizer.param_groups[0]["lr"], global_step)
+            logger.add_scalar("charts/update_syncs", num_syncs, global_step)
+            for k, v in update_stats.items():
+                logger.add_scalar(f"losses/{k}", v, global_step)
+            sps = int((global_step - start_global_step) / (time.time() - start_time))
+            print("SPS:", sps)
+            logger.add_scalar("charts/SPS", sps, global_step)
+            logger.add_scalar("time/step", global_step, global_step)
+            logger.add_scalar("time/update_time", update_time, global_step)
+            logger.add_scalar("time/rollout_time", rollout_time, global_step)
+            logger.add_scalar("time/rollout_fps", args.num_envs * args.num_steps / rollout_time, global_step)
+            for k, v in cumulative_times.items():
+                logger.add_scalar(f"time/total_{k}", v, global_step)
+            logger.add_scalar("time/total_rollout+update_time", cumulative_times["rollout_time"] + cumulative_times["update_time"], global_step)
+        timer.log(logger, global_step)
+        logger.flush(global_step)
+    if trace_window is not None:
+        trace_window.close()
+    if async_evaluator is not None:
+        async_evaluator.close()
+        log_async_eval_results(global_step)
     if args.save_model and not args.evaluate:
-        model_path = f"runs/{run_name}/final_ckpt.pt"
-        torch.save(agent.state_dict(), model_path)
+        model_path = f"runs/{run_name}/final_ckpt.ckpt"
+        checkpoint_writer.save(
+            model_path, *training_checkpoint(agent, optimizer, scaler, args.num_iterations + 1, global_step, cumulative_times, args, env_kwargs), protected=True
+        )
+        checkpoint_writer.close()
         print(f"model saved to {model_path}")
 
     envs.close()
@@ -0,0 +1,90 @@
+"""Instrumentation for the PPO training loop.
+
+`PhaseTimer` provides named timing scopes for the phases of a training iteration (env step, policy inference, GAE, backward etc.), which
+also show up as named ranges in torch.profiler traces. `TraceWindow` runs torch.profiler over a window of iterations and writes a Chrome trace
+that can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import os
+import time
+from typing import Optional
+
+import numpy as np
+import torch
+
+_NULL_SCOPE = nullcontext()
+
+
+class PhaseTimer:
+    """Records the wall time of named scopes within an iteration.
+
+    Args:
+        enabled: if False, `scope` returns a no-op context manager
+        synchronize: if True, the device is synchronized when entering and leaving a scope so that asynchronous GPU work is attributed to
+            the phase that launched it. This adds syncs to the training loop and so should only be used when tuning
+        device: the device to synchronize
+    """
+    def __init__(self, enabled: bool = False, synchronize: bool = False, device: Optional[torch.device] = None):
+        self.enabled = enabled
+        self.synchronize = synchronize and device is not None and device.type == "cuda"
+        self.device = device
+        self.times = defaultdict(list)
+
+    def scope(self, name: str):
+        if not self.enabled:
+            return _NULL_SCOPE
+        return self._timed_scope(name)
+
+    @contextmanager
+    def _timed_scope(self, name: str):
+        with torch.profiler.record_function(name):
+            if self.synchronize:
+                torch.cuda.synchronize(self.device)
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.synchronize:
+                    torch.cuda.synchronize(self.device)
+                self.times[name].append(time.perf_counter() - start)
+
+    def log(self, logger, step):
+        """logs the total time and a histogram of the per-call times of every phase recorded since the last call, then resets"""
+        for name, times in self.times.items():
+            logger.add_scalar(f"phase/{name}_time", sum(times), step)
+            logger.add_histogram(f"phase/{name}_hist", np.array(times), step)
+        self.times.clear()
+
+
+class TraceWindow:
+    """Profiles iterations start..end (inclusive) with torch.profiler and writes a Chrome trace to output_dir.
+
+    Call `step(iteration)` at the start of every iteration and `close()` after the training loop.
+    """
+    def __init__(self, start: int, end: int, output_dir: str):
+        assert start <= end, "the trace window must start before it ends"
+        self.start = start
+        self.end = end
+        self.output_dir = output_dir
+        self.profiler = None
+
+    def step(self, iteration: int):
+        if iteration == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.start()
+        elif iteration == self.end + 1:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"trace_{self.start}_{self.end}.json")
+        self.profiler.export_chrome_trace(path)
+        print(f"Chrome trace of iterations {self.start}..{self.end} saved to {path}")
+        self.profiler = None
@@ -0,0 +1,222 @@
+"""Post-training static int8 quantization of a trained agent's deterministic policy, for robot laptops that run it on CPU.
+
+python -m lerobot_sim2real.rl.quantize runs/my_run/final_ckpt.ckpt --frames real_obs.npz
+python -m lerobot_sim2real.rl.quantize runs/my_run/final_ckpt.ckpt --sim-steps 50
+
+The convs and linear layers of the encoder and actor head are quantized to int8 with per-channel weights. Activation ranges are calibrated on
+recorded frames (.npz files with one array per observation key, e.g. saved by eval_ppo_rgb.py --record-obs-path) and/or frames collected
+by rolling out the agent in the env it was trained in. The camera frames are quantized with the fixed scale 1/255 and zero point 0, which
+maps every uint8 pixel back to its own value, so the input of the first conv loses nothing to quantization.
+
+A held out part of the frames is used for an accuracy report comparing the int8 and fp32 actions, which is printed and saved next to the
+policy, followed by a latency benchmark at batch size 1. The quantized policy is saved as TorchScript with an .int8.ts extension next to the
+checkpoint, where eval_ppo_rgb.py --quantized looks for it, and can be loaded with `policy_runtime.ExportedPolicy`.
+"""
+from collections import defaultdict
+import copy
+from dataclasses import dataclass, field
+import json
+import os
+from typing import List, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+import tyro
+from torch.ao.nn.quantized import FloatFunctional
+from torch.ao.quantization import DeQuantStub, FixedQParamsObserver, QConfig, QuantStub, convert, fuse_modules, get_default_qconfig, prepare
+
+from lerobot_sim2real.rl.export import latency
+from lerobot_sim2real.rl.policy_runtime import ExportedPolicy
+from lerobot_sim2real.rl.ppo_rgb import Agent
+
+
+@dataclass
+class Args:
+    checkpoint: tyro.conf.Positional[str]
+    """path to the checkpoint to quantize, see Agent.from_checkpoint"""
+    frames: List[str] = field(default_factory=list)
+    """.npz files of recorded observations to calibrate on and evaluate with"""
+    sim_steps: int = 0
+    """if > 0, observations of this many steps of the agent in the env it was trained in are added to the frames"""
+    sim_num_envs: int = 16
+    """number of parallel envs used to collect sim frames"""
+    holdout_fraction: float = 0.2
+    """fraction of the frames held out of calibration for the accuracy report"""
+    max_calibration_frames: int = 2048
+    """at most this many frames are used for calibration"""
+    engine: Optional[str] = None
+    """the quantized engine, e.g. x86 or qnnpack (ARM). Defaults to x86 if it is supported and qnnpack otherwise"""
+    output: Optional[str] = None
+    """path to save the quantized policy to. Defaults to the checkpoint path with an .int8.ts extension"""
+    benchmark_steps: int = 200
+    """number of batch size 1 steps timed for the fp32 and int8 policies, 0 disables the latency benchmark"""
+    seed: int = 0
+
+
+class QuantizablePolicy(nn.Module):
+    """A copy of an agent's deterministic action path laid out for eager mode static quantization, with conv/linear + relu pairs that
+    can be fused, QuantStubs for the frame and the state, a FloatFunctional for the concatenation of the features and a DeQuantStub for the action"""
+    def __init__(self, agent: Agent):
+        super().__init__()
+        self.obs_keys = list(agent.feature_net.extractors.keys())
+        cnn, fc = agent.feature_net.extractors["rgb"]
+        stem = cnn[0]
+        # a plain conv in place of the ImageStem, the 1/255 scale is the scale of the quantized input
+        first_conv = nn.Conv2d(stem.in_channels, stem.out_channels, stem.kernel_size, stem.stride, stem.padding)
+        first_conv.load_state_dict(stem.state_dict())
+        self.rgb_quant = QuantStub()
+        self.rgb = nn.Sequential(first_conv, nn.ReLU(), copy.deepcopy(cnn[2]), nn.ReLU(), copy.deepcopy(cnn[4]), nn.ReLU())
+        self.rgb_fc = copy.deepcopy(fc)
+        if "state" in self.obs_keys:
+            self.state_quant = QuantStub()
+            self.state = copy.deepcopy(agent.feature_net.extractors["state"])
+        self.actor = copy.deepcopy(agent.actor_mean)
+        self.cat = FloatFunctional()
+        self.dequant = DeQuantStub()
+
+    def fuse(self):
+        fuse_modules(self, [["rgb.0", "rgb.1"], ["rgb.2", "rgb.3"], ["rgb.4", "rgb.5"], ["rgb_fc.0", "rgb_fc.1"], ["actor.0", "actor.1"]], inplace=True)
+
+    def forward(self, *obs):
+        obs = dict(zip(self.obs_keys, obs))
+        rgb = obs["rgb"].permute(0, 3, 1, 2)
+        x = self.rgb_quant(rgb.float() / 255)
+        features = [self.rgb_fc(self.rgb(x).contiguous().flatten(1))]
+        if "state" in obs:
+            features.append(self.state(self.state_quant(obs["state"])))
+        return self.dequant(self.actor(self.cat.cat(features, dim=1) if len(features) > 1 else features[0]))
+
+
+def quantize(agent: Agent, calibration_frames: dict, engine: str, batch_size: int = 64):
+    torch.backends.quantized.engine = engine
+    policy = QuantizablePolicy(agent).eval()
+    policy.fuse()
+    policy.qconfig = get_default_qconfig(engine)
+    # the frames are normalized uint8 pixels, quantizing them with scale 1/255 and zero point 0 gives back the pixels exactly
+    policy.rgb_quant.qconfig = QConfig(
+        activation=FixedQParamsObserver.with_args(scale=1 / 255, zero_point=0, dtype=torch.quint8, quant_min=0, quant_max=255),
+        weight=policy.qconfig.weight,
+    )
+    prepare(policy, inplace=True)
+    num_frames = len(next(iter(calibration_frames.values())))
+    with torch.no_grad():
+        for start in range(0, num_frames, batch_size):
+            policy(*[calibration_frames[k][start:start + batch_size] for k in policy.obs_keys])
+    convert(policy, inplace=True)
+    return policy
+
+
+def save_quantized_policy(policy: QuantizablePolicy, example_obs: dict, path: str, engine: str):
+    with torch.no_grad():
+        traced = torch.jit.trace(policy, tuple(example_obs[k] for k in policy.obs_keys))
+    torch.jit.save(traced, path, _extra_files={"policy.json": json.dumps(dict(obs_keys=policy.obs_keys, quantized_engine=engine))})
+
+
+def load_frames(paths: List[str], obs_keys: List[str]):
+    frames = defaultdict(list)
+    for path in paths:
+        data = np.load(path)
+        for k in obs_keys:
+            frames[k].append(torch.from_numpy(data[k]))
+    return {k: torch.cat(v) for k, v in frames.items()}
+
+
+def collect_sim_frames(agent: Agent, checkpoint: str, num_envs: int, num_steps: int, seed: int):
+    """rolls out the (stochastic) agent in the env stored in the checkpoint's metadata and returns the observations"""
+    import gymnasium as gym
+    import mani_skill.envs
+    import lerobot_sim2real.envs.push_cube
+    from mani_skill.utils.wrappers.flatten import FlattenActionSpaceWrapper, FlattenRGBDObservationWrapper
+    from mani_skill.vector.wrappers.gymnasium import ManiSkillVectorEnv
+    from lerobot_sim2real.rl.checkpoint import read_metadata
+
+    metadata = read_metadata(checkpoint)
+    if metadata.get("env_id") is None:
+        raise ValueError(f"{checkpoint} does not say which env it was trained in, calibrate it with --frames instead")
+    vectorized = gym.spec(metadata["env_id"]).vector_entry_point is not None
+    # like ppo_rgb.train, vectorized envs only get the --env-kwargs given to training, ManiSkill envs all the env kwargs it built
+    env_kwargs = metadata.get("args", {}).get("env_kwargs") if vectorized else metadata.get("env_kwargs")
+    if env_kwargs is None:
+        raise ValueError(f"{checkpoint} does not store the env kwargs it was trained with, calibrate it with --frames instead")
+    if vectorized:
+        envs = gym.make_vec(metadata["env_id"], num_envs=num_envs, vectorization_mode="vector_entry_point", **env_kwargs)
+    else:
+        envs = gym.make(metadata["env_id"], num_envs=num_envs, **env_kwargs)
+        envs = FlattenRGBDObservationWrapper(envs, rgb=True, depth=False, state="state" in agent.obs_shapes)
+        if isinstance(envs.action_space, gym.spaces.Dict):
+            envs = FlattenActionSpaceWrapper(envs)
+        envs = ManiSkillVectorEnv(envs, num_envs, ignore_terminations=False, record_metrics=False)
+    obs, _ = envs.reset(seed=seed)
+    frames = defaultdict(list)
+    for _ in range(num_steps):
+        for k in agent.obs_shapes:
+            frames[k].append(obs[k].cpu())
+        with torch.no_grad():
+            obs, _, _, _, _ = envs.step(agent.get_action({k: v.cpu() for k, v in obs.items()}))
+    envs.close()
+    return {k: torch.cat(v) for k, v in frames.items()}
+
+
+def accuracy_report(fp32_actions: torch.Tensor, int8_actions: torch.Tensor):
+    err = (int8_actions - fp32_actions).abs()
+    return dict(
+        num_frames=len(err),
+        mean_abs_err=err.mean().item(),
+        p99_abs_err=err.flatten().quantile(0.99).item(),
+        max_abs_err=err.max().item(),
+        # relative to how much the fp32 actions vary over the frames
+        mean_abs_err_over_action_std=(err.mean(0) / fp32_actions.std(0).clamp(min=1e-8)).mean().item(),
+        per_dim_mean_abs_err=err.mean(0).tolist(),
+    )
+
+
+def main(args: Args):
+    torch.manual_seed(args.seed)
+    engine = args.engine
+    if engine is None:
+        engine = "x86" if "x86" in torch.backends.quantized.supported_engines else "qnnpack"
+    agent = Agent.from_checkpoint(args.checkpoint).eval()
+    obs_keys = list(agent.obs_shapes.keys())
+
+    frames = [load_frames(args.frames, obs_keys)] if len(args.frames) > 0 else []
+    if args.sim_steps > 0:
+        frames.append(collect_sim_frames(agent, args.checkpoint, args.sim_num_envs, args.sim_steps, args.seed))
+    if len(frames) == 0:
+        raise ValueError("no frames to calibrate with, pass recorded frames with --frames and/or collect sim frames with --sim-steps")
+    frames = {k: torch.cat([f[k] for f in frames]) for k in obs_keys}
+    num_frames = len(frames["rgb"])
+    perm = torch.randperm(num_frames)
+    num_holdout = max(1, int(num_frames * args.holdout_fraction))
+    holdout = {k: v[perm[:num_holdout]] for k, v in frames.items()}
+    calibration = {k: v[perm[num_holdout:][:args.max_calibration_frames]] for k, v in frames.items()}
+    print(f"calibrating on {len(calibration['rgb'])} frames, {num_holdout} frames held out")
+
+    policy = quantize(agent, calibration, engine)
+    output = args.output if args.output is not None else f"{os.path.splitext(args.checkpoint)[0]}.int8.ts"
+    save_quantized_policy(policy, {k: v[:1] for k, v in holdout.items()}, output, engine)
+    print(f"saved the int8 policy to {output}")
+
+    quantized = ExportedPolicy(output)
+    with torch.no_grad():
+        fp32_actions = agent.get_action(holdout, deterministic=True)
+    report = accuracy_report(fp32_actions, quantized.get_action(holdout))
+    report_path = f"{os.path.splitext(output)[0]}.report.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"accuracy on held out frames (saved to {report_path}):")
+    for k, v in report.items():
+        print(f"  {k}: {v}")
+
+    if args.benchmark_steps > 0:
+        obs = {k: v[:1] for k, v in holdout.items()}
+        with torch.no_grad():
+            p50, p99 = latency(lambda obs: agent.get_action(obs, deterministic=True), obs, args.benchmark_steps)
+        print(f"fp32 agent: p50={p50:.3f}ms p99={p99:.3f}ms")
+        p50, p99 = latency(quantized.get_action, obs, args.benchmark_steps)
+        print(f"int8 policy: p50={p50:.3f}ms p99={p99:.3f}ms")
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    main(args)
@@ -0,0 +1,82 @@
+"""
+Benchmarks the per step cost of an environment at several numbers of parallel environments. Besides the time of a whole env.step, it times
+the parts of a step that run outside the physics simulation on their own: computing the info (evaluate), the observations and the rewards.
+
+python lerobot_sim2real/scripts/benchmark_env_step.py --env-id="SO100PushCube-v1" --num-envs 16 256 1024 4096
+"""
+from dataclasses import dataclass, field
+import time
+from typing import List
+
+import gymnasium as gym
+import numpy as np
+import torch
+import tyro
+
+import lerobot_sim2real.envs.push_cube
+
+
+@dataclass
+class Args:
+    env_id: str = "SO100PushCube-v1"
+    """The environment id to benchmark"""
+    num_envs: List[int] = field(default_factory=lambda: [16, 256, 1024, 4096])
+    """numbers of parallel environments to benchmark at"""
+    num_steps: int = 200
+    """number of timed steps at every number of parallel environments"""
+    warmup_steps: int = 20
+    """number of untimed steps before the timed ones"""
+    obs_mode: str = "state"
+    """observation mode of the environment. State observations keep rendering out of the measurements"""
+    reward_mode: str = "normalized_dense"
+    """reward mode of the environment, "none" leaves out the parts only needed for rewards"""
+    seed: int = 0
+
+
+def benchmark(args: Args, num_envs: int):
+    env = gym.make(args.env_id, num_envs=num_envs, obs_mode=args.obs_mode, reward_mode=args.reward_mode, render_mode=None)
+    base_env = env.unwrapped
+    env.reset(seed=args.seed)
+    # the env runs on the gpu if there is one, timings need to wait for its work to finish
+    sync = torch.cuda.synchronize if base_env.device.type == "cuda" else lambda: None
+    times = dict(step=[], info=[], obs=[], reward=[])
+    for i in range(args.warmup_steps + args.num_steps):
+        action = torch.from_numpy(env.action_space.sample()).to(base_env.device)
+        sync()
+        start = time.perf_counter()
+        env.step(action)
+        sync()
+        step_end = time.perf_counter()
+        # repeat the non-physics parts of the step the same way env.step runs them
+        info = base_env.get_info()
+        sync()
+        info_end = time.perf_counter()
+        obs = base_env.get_obs(info)
+        sync()
+        obs_end = time.perf_counter()
+        base_env.get_reward(obs, action, info)
+        sync()
+        reward_end = time.perf_counter()
+        if i >= args.warmup_steps:
+            times["step"].append(step_end - start)
+            times["info"].append(info_end - step_end)
+            times["obs"].append(obs_end - info_end)
+            times["reward"].append(reward_end - obs_end)
+    env.close()
+    return {k: 1000 * np.median(v) for k, v in times.items()}
+
+
+def main(args: Args):
+    print(f"{args.env_id}, obs_mode={args.obs_mode}, reward_mode={args.reward_mode}, median milliseconds per step")
+    print(f"{'num_envs':>9} {'step':>9} {'info':>9} {'obs':>9} {'reward':>9} {'env steps/s':>12}")
+    for num_envs in args.num_envs:
+        t = benchmark(args, num_envs)
+        print(
+            f"{num_envs:>9} {t['step']:>9.3f} {t['info']:>9.3f} {t['obs']:>9.3f} {t['reward']:>9.3f} "
+            f"{num_envs / t['step'] * 1000:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    main(args)
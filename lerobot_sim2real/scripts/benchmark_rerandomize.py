@@ -0,0 +1,74 @@
+"""
+Benchmarks the cost of sampling new cube frictions, cube colors and lighting for every parallel environment, either in place on reset
+(rerandomize_on_reset=True, which sets them one environment at a time) or by rebuilding the scene (a reset with reconfigure=True). It
+also times the in place re-randomization on its own, without the rest of the reset.
+
+python lerobot_sim2real/scripts/benchmark_rerandomize.py --env-id="SO100PushCube-v1" --num-envs 16 256 1024
+"""
+from dataclasses import dataclass, field
+import time
+from typing import List
+
+import gymnasium as gym
+import numpy as np
+import torch
+import tyro
+
+import lerobot_sim2real.envs.push_cube
+
+
+@dataclass
+class Args:
+    env_id: str = "SO100PushCube-v1"
+    """The environment id to benchmark"""
+    num_envs: List[int] = field(default_factory=lambda: [16, 256, 1024])
+    """numbers of parallel environments to benchmark at"""
+    num_resets: int = 20
+    """number of timed in place resets at every number of parallel environments"""
+    num_reconfigurations: int = 3
+    """number of timed resets that rebuild the scene at every number of parallel environments"""
+    obs_mode: str = "rgb+segmentation"
+    """observation mode of the environment"""
+    seed: int = 0
+
+
+def timed(fn, sync, num_iters: int):
+    times = []
+    for _ in range(num_iters):
+        sync()
+        start = time.perf_counter()
+        fn()
+        sync()
+        times.append(time.perf_counter() - start)
+    return 1000 * np.median(times)
+
+
+def benchmark(args: Args, num_envs: int):
+    env = gym.make(
+        args.env_id, num_envs=num_envs, obs_mode=args.obs_mode, render_mode=None,
+        domain_randomization_config=dict(rerandomize_on_reset=True),
+    )
+    base_env = env.unwrapped
+    env.reset(seed=args.seed)
+    sync = torch.cuda.synchronize if base_env.device.type == "cuda" else lambda: None
+    env_idx = torch.arange(num_envs, device=base_env.device)
+    times = dict(
+        rerandomize=timed(lambda: base_env._rerandomize_episode(env_idx), sync, args.num_resets),
+        reset=timed(lambda: env.reset(), sync, args.num_resets),
+        reconfigure=timed(lambda: env.reset(options=dict(reconfigure=True)), sync, args.num_reconfigurations),
+    )
+    env.close()
+    return times
+
+
+def main(args: Args):
+    print(f"{args.env_id}, obs_mode={args.obs_mode}, median milliseconds to re-randomize every parallel environment")
+    print(f"{'num_envs':>9} {'rerandomize':>12} {'reset':>9} {'reconfigure':>12}")
+    for num_envs in args.num_envs:
+        t = benchmark(args, num_envs)
+        print(f"{num_envs:>9} {t['rerandomize']:>12.3f} {t['reset']:>9.3f} {t['reconfigure']:>12.3f}")
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    main(args)
@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of the push cube success and dense reward computation on random states, comparing the fused in place version used by
+SO100PushCubeEnv with the straightforward out of place version it replaced. That both give identical results is tested in
+tests/test_push_cube_reward.py.
+
+python lerobot_sim2real/scripts/benchmark_reward.py --num-envs 4096
+"""
+from dataclasses import dataclass
+import time
+from typing import Optional
+
+import torch
+import tyro
+
+from lerobot_sim2real.envs.push_cube import SO100PushCubeEnv, make_reward_buffers, push_cube_reward_and_success
+
+
+@dataclass
+class Args:
+    num_envs: int = 4096
+    """number of parallel environments to compute rewards for"""
+    num_iters: int = 1000
+    """number of timed calls of each version"""
+    device: Optional[str] = None
+    """device to run on. Defaults to cuda if available"""
+    seed: int = 0
+
+
+def reference_reward_and_success(cube_pos, goal_pos, tcp_pos, cube_half_sizes, qvel, touching_table, goal_radius):
+    obj_xy = cube_pos[..., :2]
+    goal_xy = goal_pos[..., :2]
+    in_region = torch.linalg.norm(obj_xy - goal_xy, dim=1) < goal_radius
+    robot_static = torch.linalg.norm(qvel, dim=1) < 0.2
+    success = in_region & robot_static
+
+    tcp_target = cube_pos + torch.stack([-cube_half_sizes - 0.01, torch.zeros_like(cube_half_sizes), torch.zeros_like(cube_half_sizes)], dim=1)
+    reaching = torch.linalg.norm(tcp_target - tcp_pos, dim=1)
+    reaching_r = 1 - torch.tanh(5 * reaching)
+    obj_dist = torch.linalg.norm(cube_pos[..., :2] - goal_pos[..., :2], dim=1)
+    place_r = 1 - torch.tanh(5 * obj_dist)
+    reward = reaching_r + place_r * (reaching < 0.02)
+    reward -= 2 * touching_table.float()
+    reward[success] = 3.0
+    return reward, success
+
+
+def time_per_call(fn, num_iters: int, device: torch.device):
+    sync = torch.cuda.synchronize if device.type == "cuda" else lambda: None
+    for _ in range(10):
+        fn()
+    sync()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    sync()
+    return (time.perf_counter() - start) / num_iters * 1e6
+
+
+def main(args: Args):
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    generator = torch.Generator(device=device).manual_seed(args.seed)
+    n = args.num_envs
+    # states around the cube so that all branches of the reward are hit
+    cube_pos = torch.rand((n, 3), generator=generator, device=device) * 0.2
+    goal_pos = cube_pos + torch.randn((n, 3), generator=generator, device=device) * 0.01
+    tcp_pos = cube_pos + torch.randn((n, 3), generator=generator, device=device) * 0.02
+    cube_half_sizes = 0.011 + torch.rand(n, generator=generator, device=device) * 0.003
+    qvel = torch.randn((n, 6), generator=generator, device=device) * 0.1
+    touching_table = torch.rand(n, generator=generator, device=device) < 0.2
+    goal_radius = SO100PushCubeEnv.goal_radius
+    buffers = make_reward_buffers(n, device)
+
+    inputs = (cube_pos, goal_pos, tcp_pos, cube_half_sizes, qvel, touching_table, goal_radius)
+    print(f"{n} envs on {device}")
+
+    reference_us = time_per_call(lambda: reference_reward_and_success(*inputs), args.num_iters, device)
+    fused_us = time_per_call(lambda: push_cube_reward_and_success(*inputs, buffers), args.num_iters, device)
+    print(f"reference: {reference_us:.1f}us per call")
+    print(f"fused: {fused_us:.1f}us per call ({reference_us / fused_us:.2f}x)")
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    main(args)
@@ -0,0 +1,273 @@
+"""
+Automatically calibrates the simulation camera's position, target and field of view against the real camera, instead of nudging it by hand
+with camera_alignment.py, and writes the result into the env config json.
+
+Real frames are captured with the robot at a few different joint positions (or loaded from a previous run with --frames-path). The robot
+is then put at the same joint positions in simulation and hundreds of candidate cameras are rendered at once, one per parallel environment,
+and scored by how well the simulated robot lines up with the real one. If a background image of the scene without the robot is available
+(by default the greenscreen image from the env config) the score is the IoU of the simulated robot's segmentation mask with the real robot's,
+found by differencing the real frame with the background image. Otherwise it is the mean distance of the simulated robot's silhouette to the
+nearest edge in the real frame. The candidates are searched with the cross-entropy method, sampling around the best cameras found so far
+with a search radius that shrinks as they agree.
+
+The real camera should already be placed roughly where the simulation camera is (see step 1.2 of the tutorial) and there should be no cube
+in the workspace.
+
+python lerobot_sim2real/scripts/calibrate_camera.py --env-id="SO100GraspCube-v1" --env-kwargs-json-path=env_config.json
+"""
+from dataclasses import dataclass
+import json
+from typing import Literal, Optional
+
+import cv2
+import gymnasium as gym
+import numpy as np
+import torch
+import torch.nn.functional as F
+import tyro
+
+from mani_skill.utils import common, sapien_utils
+from mani_skill.utils.structs.pose import Pose
+from lerobot_sim2real.utils.real_runner import center_crop_resize
+
+import lerobot_sim2real.envs.push_cube
+
+
+@dataclass
+class Args:
+    env_id: str = "SO100GraspCube-v1"
+    """The environment id to calibrate the camera of"""
+    env_kwargs_json_path: Optional[str] = None
+    """path to a json file containing additional environment kwargs. Its base_camera_settings are where the search starts from"""
+    output_json_path: Optional[str] = None
+    """path to write the env config with the calibrated base_camera_settings to. Defaults to env_kwargs_json_path"""
+    frames_path: Optional[str] = None
+    """path to an .npz file with real frames ("rgb", N x H x W x 3) and the robot joint positions they were taken at ("qpos", N x D), e.g.
+    saved by a previous run with --save-frames-path. If None, frames are captured from the real robot"""
+    save_frames_path: Optional[str] = None
+    """path to save the captured real frames and joint positions to, so the calibration can be repeated without the robot"""
+    num_poses: int = 3
+    """number of robot joint positions to capture frames at. The first is the rest pose and the others are random perturbations of it"""
+    pose_noise: float = 0.3
+    """largest perturbation in radians of each arm joint from the rest pose when capturing frames"""
+    score: Literal["auto", "mask", "edges"] = "auto"
+    """how candidate cameras are scored. "mask" needs a background image, "auto" uses "mask" if there is one and "edges" otherwise"""
+    background_path: Optional[str] = None
+    """path to an image of the scene without the robot taken by the real camera. Defaults to the greenscreen_overlay_path of the env config"""
+    background_threshold: int = 40
+    """smallest difference to the background image of any color channel for a real pixel to count as part of the robot"""
+    num_envs: int = 256
+    """number of candidate cameras rendered in parallel per iteration"""
+    iterations: int = 20
+    """number of search iterations"""
+    num_elites: int = 16
+    """number of best candidates the next iteration samples around"""
+    pos_std: float = 0.05
+    """initial standard deviation in meters of the camera position samples"""
+    target_std: float = 0.05
+    """initial standard deviation in meters of the camera target samples"""
+    fov_std: float = np.deg2rad(4)
+    """initial standard deviation in radians of the camera fov samples"""
+    resolution: int = 128
+    """width and height of the images the candidates are compared at"""
+    preview_path: Optional[str] = "camera_calibration.png"
+    """path to save an image of the real frames with the silhouette of the simulated robot seen from the calibrated camera drawn on top"""
+    seed: int = 0
+
+
+def capture_real_frames(sim_env, num_poses: int, pose_noise: float, seed: int):
+    """moves the real robot to num_poses joint positions around its rest pose and captures a camera frame at each"""
+    from lerobot_sim2real.config.real_robot import create_real_robot
+    from mani_skill.agents.robots.lerobot.manipulator import LeRobotRealAgent
+    from lerobot_sim2real.utils.safety import setup_safe_exit
+
+    real_robot = create_real_robot(uid="so100")
+    real_robot.connect()
+    real_agent = LeRobotRealAgent(real_robot)
+    setup_safe_exit(sim_env, None, real_agent)
+    rng = np.random.default_rng(seed)
+    rest_qpos = sim_env.unwrapped.agent.keyframes["rest"].qpos
+    frames, qposes = [], []
+    input(f"The robot will move to {num_poses} poses around its rest pose. Clear the workspace and press enter to start")
+    for i in range(num_poses):
+        qpos = rest_qpos.copy()
+        if i > 0:
+            # the gripper joint is kept as is
+            qpos[:-1] += rng.uniform(-pose_noise, pose_noise, size=len(qpos) - 1)
+        real_agent.reset(qpos)
+        real_agent.capture_sensor_data(["base_camera"])
+        frames.append(real_agent.get_sensor_data(["base_camera"])["base_camera"]["rgb"][0].cpu().numpy())
+        qposes.append(real_agent.qpos[0].cpu().numpy())
+    real_agent.reset(rest_qpos)
+    real_agent.stop()
+    return np.stack(frames), np.stack(qposes)
+
+
+def real_robot_masks(frames: np.ndarray, background: np.ndarray, threshold: int):
+    """segments the robot in the real frames as the pixels that differ from the background image"""
+    masks = []
+    for frame in frames:
+        mask = (np.abs(frame.astype(np.int16) - background).max(axis=-1) > threshold).astype(np.uint8)
+        # removes specks of camera noise
+        masks.append(cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8)) > 0)
+    return np.stack(masks)
+
+
+def real_edge_distances(frames: np.ndarray, max_distance: float = 20):
+    """returns for every pixel of every frame the distance in pixels to the nearest edge in the frame, capped at max_distance"""
+    distances = []
+    for frame in frames:
+        edges = cv2.Canny(cv2.GaussianBlur(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), (5, 5), 0), 50, 150)
+        distances.append(np.minimum(cv2.distanceTransform((edges == 0).astype(np.uint8), cv2.DIST_L2, 3), max_distance))
+    return np.stack(distances)
+
+
+def silhouette(mask: torch.Tensor):
+    """returns the pixels of the (N, H, W) boolean masks that border a pixel outside the mask"""
+    outside = F.max_pool2d((~mask).float()[:, None], kernel_size=3, stride=1, padding=1)[:, 0] > 0
+    return mask & outside
+
+
+class CandidateRenderer:
+    """renders the robot segmentation masks seen by a batch of candidate cameras, one per parallel environment"""
+    def __init__(self, env):
+        self.env = env.unwrapped
+        self.robot_ids = torch.unique(torch.cat([link.per_scene_id for link in self.env.agent.robot.get_links()]))
+        self.camera = self.env._sensors["base_camera"].camera
+        # the real workspace is empty, move the task objects out of view so they do not hide parts of the robot
+        for name in ["cube", "goal_region"]:
+            if hasattr(self.env, name):
+                getattr(self.env, name).set_pose(Pose.create_from_pq(p=[0, 0, -10]))
+
+    def render(self, qpos: np.ndarray, params: torch.Tensor):
+        """params is a (num_envs, 7) tensor of camera positions, targets and fovs"""
+        env = self.env
+        env.agent.robot.set_qpos(common.to_tensor(qpos, device=env.device).float().expand(env.num_envs, -1))
+        env.camera_mount.set_pose(sapien_utils.look_at(params[:, :3], params[:, 3:6], device=env.device))
+        for render_camera, fov in zip(self.camera._render_cameras, params[:, 6].tolist()):
+            render_camera.set_fovy(fov, True)
+        if env.gpu_sim_enabled:
+            env.scene._gpu_apply_all()
+            env.scene.px.gpu_update_articulation_kinematics()
+            env.scene._gpu_fetch_all()
+        segmentation = env._get_obs_sensor_data()["base_camera"]["segmentation"][..., 0]
+        return torch.isin(segmentation, self.robot_ids.to(segmentation.device))
+
+
+def make_cost_function(renderer: CandidateRenderer, qposes: np.ndarray, targets: torch.Tensor, score: str):
+    def cost(params: torch.Tensor):
+        total = torch.zeros(len(params), device=params.device)
+        for qpos, target in zip(qposes, targets):
+            sim_masks = renderer.render(qpos, params)
+            if score == "mask":
+                intersection = (sim_masks & target).flatten(1).sum(-1)
+                union = (sim_masks | target).flatten(1).sum(-1).clamp(min=1)
+                total += 1 - intersection / union
+            else:
+                edges = silhouette(sim_masks).float()
+                num_edges = edges.flatten(1).sum(-1)
+                mean_distance = (edges * target).flatten(1).sum(-1) / num_edges.clamp(min=1)
+                # cameras that do not see the robot at all get the largest distance
+                total += torch.where(num_edges > 0, mean_distance, target.max())
+        return total / len(qposes)
+    return cost
+
+
+def cross_entropy_search(cost, mean: torch.Tensor, std: torch.Tensor, num_samples: int, num_elites: int, iterations: int, generator: torch.Generator):
+    """minimizes cost by repeatedly sampling num_samples candidates from a normal distribution and refitting it to the num_elites best. The
+    best candidate so far is always kept in the next batch of samples"""
+    best, best_cost = mean.clone(), cost(mean[None].expand(num_samples, -1))[0].item()
+    min_std = std * 1e-3
+    for iteration in range(iterations):
+        samples = mean + std * torch.randn((num_samples, len(mean)), generator=generator, device=mean.device)
+        samples[0] = best
+        costs = cost(samples)
+        order = torch.argsort(costs)
+        if costs[order[0]] < best_cost:
+            best, best_cost = samples[order[0]].clone(), costs[order[0]].item()
+        elites = samples[order[:num_elites]]
+        mean, std = elites.mean(0), torch.maximum(elites.std(0), min_std)
+        print(f"iteration {iteration}: best cost {best_cost:.4f}, search std pos={std[:3].norm():.4f}m fov={np.rad2deg(std[6].item()):.2f}deg")
+    return best, best_cost
+
+
+def main(args: Args):
+    env_config = dict()
+    if args.env_kwargs_json_path is not None:
+        with open(args.env_kwargs_json_path, "r") as f:
+            env_config = json.load(f)
+    env_kwargs = dict(env_config)
+    # the greenscreen would paint over the robot's surroundings which the scores do not need
+    env_kwargs.pop("greenscreen_overlay_path", None)
+    env = gym.make(
+        args.env_id,
+        num_envs=args.num_envs,
+        obs_mode="rgb+segmentation",
+        render_mode="sensors",
+        domain_randomization=False,
+        reward_mode="none",
+        sensor_configs=dict(width=args.resolution, height=args.resolution),
+        **env_kwargs,
+    )
+    env.reset(seed=args.seed)
+    base_camera_settings = env.unwrapped.base_camera_settings
+    initial = torch.tensor(
+        [*common.to_numpy(base_camera_settings["pos"]), *common.to_numpy(base_camera_settings["target"]), float(base_camera_settings["fov"])],
+        dtype=torch.float32,
+        device=env.unwrapped.device,
+    )
+
+    if args.frames_path is not None:
+        data = np.load(args.frames_path)
+        raw_frames, qposes = data["rgb"], data["qpos"]
+    else:
+        raw_frames, qposes = capture_real_frames(env, args.num_poses, args.pose_noise, args.seed)
+        if args.save_frames_path is not None:
+            np.savez(args.save_frames_path, rgb=raw_frames, qpos=qposes)
+            print(f"Saved the real frames to {args.save_frames_path}")
+    frames = np.stack([center_crop_resize(frame, np.empty((args.resolution, args.resolution, 3), np.uint8)) for frame in raw_frames])
+
+    background_path = args.background_path or env_config.get("greenscreen_overlay_path")
+    score = args.score
+    if score == "auto":
+        score = "mask" if background_path is not None else "edges"
+    if score == "mask":
+        assert background_path is not None, "scoring with masks needs a background image, pass --background-path"
+        background = cv2.cvtColor(cv2.imread(background_path), cv2.COLOR_BGR2RGB)
+        background = center_crop_resize(background, np.empty((args.resolution, args.resolution, 3), np.uint8)).astype(np.int16)
+        targets = torch.from_numpy(real_robot_masks(frames, background, args.background_threshold))
+    else:
+        targets = torch.from_numpy(real_edge_distances(frames))
+    targets = targets.to(env.unwrapped.device)
+    print(f"Calibrating the camera on {len(frames)} real frames by {score} score with {args.num_envs} candidates per iteration")
+
+    renderer = CandidateRenderer(env)
+    cost = make_cost_function(renderer, qposes, targets, score)
+    std = torch.tensor([args.pos_std] * 3 + [args.target_std] * 3 + [args.fov_std], device=initial.device)
+    generator = torch.Generator(device=initial.device).manual_seed(args.seed)
+    initial_cost = cost(initial[None].expand(args.num_envs, -1))[0].item()
+    best, best_cost = cross_entropy_search(cost, initial, std, args.num_envs, args.num_elites, args.iterations, generator)
+    best = best.tolist()
+    print(f"cost of the initial camera: {initial_cost:.4f}, calibrated camera: {best_cost:.4f}")
+
+    calibrated = dict(pos=[round(x, 4) for x in best[:3]], target=[round(x, 4) for x in best[3:6]], fov=round(best[6], 4))
+    print(f"calibrated base_camera_settings: {calibrated}")
+    if args.preview_path is not None:
+        masks = renderer.render(qposes[0], torch.tensor(best, device=initial.device)[None].expand(args.num_envs, -1))
+        edges = silhouette(masks[:1]).cpu().numpy()[0]
+        preview = frames[0].copy()
+        preview[edges] = [0, 255, 0]
+        cv2.imwrite(args.preview_path, cv2.cvtColor(preview, cv2.COLOR_RGB2BGR))
+        print(f"Saved a preview of the calibrated camera to {args.preview_path}")
+    output_json_path = args.output_json_path or args.env_kwargs_json_path
+    if output_json_path is not None:
+        env_config["base_camera_settings"] = calibrated
+        with open(output_json_path, "w") as f:
+            json.dump(env_config, f, indent=4)
+        print(f"Wrote the calibrated camera settings to {output_json_path}")
+    env.close()
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    main(args)
@@ -12,7 +12,7 @@ import cv2
 import numpy as np
 import tyro
 from mani_skill.utils.visualization.misc import tile_images
-from mani_skill.utils import sapien_utils
+from mani_skill.utils import common, sapien_utils
 from dataclasses import dataclass
 import matplotlib.pyplot as plt
 
@@ -23,26 +23,37 @@ class Args:
     env_kwargs_json_path: Optional[str] = None
     """Path to a json file containing additional environment kwargs to use."""
 
-def overlay_envs(sim_env, real_env):
+def render_sim_images(sim_env):
     """
-    Overlays sim_env observtions onto real_env observations
+    Renders the sim_env cameras and returns their images as float arrays already scaled by 0.5 / 255, so that blending them with
+    real images only takes adding the scaled real image. This only needs to be redone when the sim camera changes
+    """
+    sensor_data = sim_env.unwrapped._get_obs_sensor_data()
+    return {name: data["rgb"][0].cpu().numpy().astype(np.float32) * np.float32(0.5 / 255) for name, data in sensor_data.items()}
+
+
+def overlay_envs(sim_images, real_env, blend_buffers):
+    """
+    Overlays the rendered sim_images onto the current real_env camera images
     Requires matching ids between the two environments' sensors
     e.g. id=phone_camera sensor in real_env / real_robot config, must have identical id in sim_env
     """
-    real_obs = real_env.get_obs()["sensor_data"]
-    sim_obs = sim_env.get_obs()["sensor_data"]
+    # only the camera images are needed, a full observation would also read the joint positions from the robot
+    real_obs = real_env._get_obs_sensor_data()
     assert sorted(real_obs.keys()) == sorted(
-        sim_obs.keys()
-    ), f"real camera names {real_obs.keys()} and sim camera names {sim_obs.keys()} differ"
+        sim_images.keys()
+    ), f"real camera names {real_obs.keys()} and sim camera names {sim_images.keys()} differ"
 
-    overlaid_dict = sim_env.get_obs()["sensor_data"]
     overlaid_imgs = []
-    for name in overlaid_dict:
-        real_imgs = real_obs[name]["rgb"][0] / 255
-        sim_imgs = overlaid_dict[name]["rgb"][0].cpu() / 255
-        overlaid_imgs.append(0.5 * real_imgs + 0.5 * sim_imgs)
+    for name, sim_img in sim_images.items():
+        if name not in blend_buffers:
+            blend_buffers[name] = np.empty_like(sim_img)
+        overlaid = blend_buffers[name]
+        np.multiply(real_obs[name]["rgb"][0].numpy(), np.float32(0.5 / 255), out=overlaid)
+        overlaid += sim_img
+        overlaid_imgs.append(overlaid)
 
-    return tile_images(overlaid_imgs)
+    return overlaid_imgs[0] if len(overlaid_imgs) == 1 else tile_images(overlaid_imgs)
 
 
 def update_camera(sim_env):
@@ -51,6 +62,12 @@ def update_camera(sim_env):
     delta_time = current_time - last_frame_time
     last_frame_time = current_time
 
+    # only the keys below change the camera, so nothing needs to be re-rendered without them
+    if len(active_keys & CAMERA_KEYS) == 0:
+        if not help_message_printed:
+            print_help_message()
+        return False
+
     # Reset camera position and FOV on backspace
     if "backspace" in active_keys:
         camera_offset = torch.zeros(3, dtype=torch.float32)
@@ -77,30 +94,35 @@ def update_camera(sim_env):
         fov_offset += FOV_CHANGE_SPEED * delta_time
 
     # update camera position and fov
-    pos = sim_env.unwrapped.base_camera_settings["pos"] + camera_offset
-    pose = sapien_utils.look_at(pos, sim_env.unwrapped.base_camera_settings["target"])
+    # the settings may be lists as given in the env config, or tensors on the env device
+    base_pos = common.to_tensor(sim_env.unwrapped.base_camera_settings["pos"], device=camera_offset.device)
+    target = common.to_tensor(sim_env.unwrapped.base_camera_settings["target"], device=camera_offset.device)
+    pos = base_pos + camera_offset
+    pose = sapien_utils.look_at(pos, target)
     sim_env.unwrapped.camera_mount.set_pose(pose)
     sim_env.unwrapped._sensors["base_camera"].camera.set_fovy(
         sim_env.unwrapped.base_camera_settings["fov"] + fov_offset
     )
 
-    if len(active_keys) > 0:
-        print("current_camera_position", pose.p)
-        print(
-            "current_camera_fov",
-            sim_env.unwrapped.base_camera_settings["fov"] + fov_offset,
-        )
-        help_message_printed = False  # Reset the flag when there's movement
-    elif (
-        not help_message_printed
-    ):  # Only print help message if it hasn't been printed yet
-        print("=== Commands for controlling sim camera ===")
-        print(
-            "press: (w), (a) to move in x, (s), (d) to move in y, (up), (down) to move in z, (left), (right) to change fov of simulation camera"
-        )
-        print("press: (backspace) to reset, close figure to exit")
-        print()
-        help_message_printed = True
+    print("current_camera_position", pose.p)
+    print(
+        "current_camera_fov",
+        sim_env.unwrapped.base_camera_settings["fov"] + fov_offset,
+    )
+    help_message_printed = False  # Reset the flag when there's movement
+    return True
+
+
+def print_help_message():
+    global help_message_printed
+    print("=== Commands for controlling sim camera ===")
+    print(
+        "press: (w), (a) to move in x, (s), (d) to move in y, (up), (down) to move in z, (left), (right) to change fov of simulation camera"
+    )
+    print("press: (backspace) to reset, close figure to exit")
+    print()
+    help_message_printed = True
+
 
 camera_offset = torch.zeros(3, dtype=torch.float32)
 fov_offset = 0.0
@@ -109,6 +131,7 @@ last_frame_time = time.time()
 MOVEMENT_SPEED = 0.1  # units per second
 FOV_CHANGE_SPEED = 0.1  # radians per second
 help_message_printed = False  # Flag to track if we've printed the help message
+CAMERA_KEYS = {"w", "a", "s", "d", "up", "down", "left", "right", "backspace"}
 
 
 def on_key_press(event):
@@ -155,25 +178,39 @@ def main(args: Args):
     fig.canvas.mpl_disconnect(fig.canvas.manager.key_press_handler_id)
     fig.canvas.manager.key_press_handler_id = None
 
-    # initialize the plot
-    im = ax.imshow(overlay_envs(sim_env, real_env))
+    # initialize the plot. The sim images are only re-rendered when the sim camera is moved
+    sim_images = render_sim_images(sim_env)
+    blend_buffers = dict()
+    im = ax.imshow(overlay_envs(sim_images, real_env, blend_buffers), animated=True)
 
     fig.canvas.mpl_connect("key_press_event", on_key_press)
     fig.canvas.mpl_connect("key_release_event", on_key_release)
 
+    # blitting only redraws the image on top of a saved background instead of the whole figure. The background is saved again whenever
+    # the figure is fully redrawn, e.g. after it is resized
+    background = None
+    def on_draw(event):
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(fig.bbox)
+        ax.draw_artist(im)
+    fig.canvas.mpl_connect("draw_event", on_draw)
+    plt.show(block=False)
+    fig.canvas.draw()
+
     print("Camera alignment: Move real camera to align with the sim camera, close figure to exit")
     while True:
-        overlaid_imgs = overlay_envs(sim_env, real_env)
-        im.set_data(overlaid_imgs)
-        # Update camera position based on active keys
-        update_camera(sim_env)
-        # Redraw the plot
-        fig.canvas.draw()
-        fig.show()
-        fig.canvas.flush_events()
         if not plt.fignum_exists(fig.number):
             print("The figure has been closed.")
             break
+        # Update camera position based on active keys
+        if update_camera(sim_env):
+            sim_images = render_sim_images(sim_env)
+        im.set_data(overlay_envs(sim_images, real_env, blend_buffers))
+        # Redraw the image
+        fig.canvas.restore_region(background)
+        ax.draw_artist(im)
+        fig.canvas.blit(fig.bbox)
+        fig.canvas.flush_events()
 
 if __name__ == "__main__":
     args = tyro.cli(Args)
@@ -2,35 +2,42 @@
 This script is used to evaluate a random or RL trained agent on a real robot using the LeRobot system.
 """
 
+from collections import defaultdict
 from dataclasses import dataclass
 import json
+import os
 import random
-from typing import Optional
+from typing import Literal, Optional
 import gymnasium as gym
 import numpy as np
 import torch
 import tyro
 from lerobot_sim2real.config.real_robot import create_real_robot
+from lerobot_sim2real.rl.policy_runtime import ExportedPolicy
 from lerobot_sim2real.rl.ppo_rgb import Agent
 
+from lerobot_sim2real.utils.debug_viewer import DebugViewer
+from lerobot_sim2real.utils.real_runner import AsyncSim2RealEnv, StageTimings
 from lerobot_sim2real.utils.safety import setup_safe_exit
 from mani_skill.agents.robots.lerobot.manipulator import LeRobotRealAgent
 from mani_skill.envs.sim2real_env import Sim2RealEnv
 from mani_skill.utils.wrappers.flatten import FlattenRGBDObservationWrapper
 from mani_skill.utils.wrappers.record import RecordEpisode
 from tqdm import tqdm
-from mani_skill.utils.visualization import tile_images
-import matplotlib.pyplot as plt
 
 import lerobot_sim2real.envs.push_cube
 @dataclass
 class Args:
     checkpoint: Optional[str] = None
-    """path to a pretrained checkpoint file to load agent weights from for evaluation. If None then a random agent will be used"""
+    """path to a pretrained checkpoint file to load agent weights from for evaluation. If None then a random agent will be used. Policies exported with `python -m lerobot_sim2real.rl.export` (.ts or .onnx files) are run with the standalone runtime and act deterministically"""
+    quantized: bool = False
+    """if toggled, runs the int8 policy made from the checkpoint with `python -m lerobot_sim2real.rl.quantize` (the checkpoint path with an .int8.ts extension) on the CPU instead"""
+    record_obs_path: Optional[str] = None
+    """path to an .npz file the observations fed to the agent are saved to at the end of every episode, e.g. to calibrate a quantized policy on real frames"""
     env_kwargs_json_path: Optional[str] = None
     """path to a json file containing additional environment kwargs to use. For real world evaluation this is not needed but if you want to turn on debug mode which visualizes the sim and real envs side by side you will need this"""
     debug: bool = False
-    """if toggled, the sim and real envs will be visualized side by side"""
+    """if toggled, the sim and real envs will be visualized side by side. The sim images are rendered and shown by a separate process with its own copy of the sim env that drops frames when it falls behind, so this barely affects the control loop"""
     continuous_eval: bool = True
     """If toggled, the evaluation will run until episode ends without user input. If false, at each timestep the user will be prompted to press enter to let the robot continue"""
     max_episode_steps: int = 100
@@ -46,33 +53,34 @@ class Args:
     """Directory to save recordings of the camera captured images. If none no recordings are saved"""
     control_freq: Optional[int] = 15
     """The control frequency of the real robot. For safety reasons we recommend setting this to 15Hz or lower as we permit the RL agent to take larger actions to move faster. If this is none, it will use the same control frequency the sim env uses."""
-
-def overlay_envs(sim_env, real_env):
-    """
-    Overlays sim_env observtions onto real_env observations
-    Requires matching ids between the two environments' sensors
-    e.g. id=phone_camera sensor in real_env / real_robot config, must have identical id in sim_env
-    """
-    real_obs = real_env.get_obs()["sensor_data"]
-    sim_obs = sim_env.get_obs()["sensor_data"]
-    assert sorted(real_obs.keys()) == sorted(
-        sim_obs.keys()
-    ), f"real camera names {real_obs.keys()} and sim camera names {sim_obs.keys()} differ"
-
-    overlaid_dict = sim_env.get_obs()["sensor_data"]
-    overlaid_imgs = []
-    for name in overlaid_dict:
-        real_imgs = real_obs[name]["rgb"][0] / 255
-        sim_imgs = overlaid_dict[name]["rgb"][0].cpu() / 255
-        overlaid_imgs.append(0.5 * real_imgs + 0.5 * sim_imgs)
-
-    return tile_images(overlaid_imgs), real_imgs, sim_imgs
+    async_capture: bool = False
+    """if toggled, camera frames are captured and preprocessed in a background thread and actions are sent to the robot as soon as the policy computes them, which lowers the latency from observation to action. Per-stage timings are printed after every episode. Off by default until it has been validated on more hardware"""
+    control_deadline_ms: Optional[float] = None
+    """with --async-capture, the time after an observation's control tick its action has to be sent by. Defaults to the control period. Deadline misses, control loop jitter and a latency histogram are printed after every episode"""
+    miss_policy: Literal["send", "hold", "predict", "skip"] = "send"
+    """with --async-capture, what to do with an action computed after its deadline: send it anyway, send the previous action again (hold), send a linear extrapolation of the previous two actions (predict) or send nothing until the next control tick (skip)"""
 
 def main(args: Args):
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
+    ### Load our checkpoint. Checkpoints store the agent architecture so this needs no env ###
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    agent = None
+    if args.quantized:
+        assert args.checkpoint is not None, "--quantized needs the --checkpoint the int8 policy was made from"
+        device = torch.device("cpu")
+        quantized_path = f"{os.path.splitext(args.checkpoint)[0]}.int8.ts"
+        agent = ExportedPolicy(quantized_path, device=device)
+        print(f"Loaded int8 policy from {quantized_path}")
+    elif args.checkpoint and args.checkpoint.endswith((".ts", ".onnx")):
+        agent = ExportedPolicy(args.checkpoint, device=device)
+        print(f"Loaded exported policy from {args.checkpoint}")
+    elif args.checkpoint:
+        agent = Agent.from_checkpoint(args.checkpoint, device=device)
+        print(f"Loaded agent from {args.checkpoint}")
+
     ### Create and connect the real robot, wrap it to make it interfaceable with ManiSkill sim2real environments ###    
     real_robot = create_real_robot(uid="so100")
     real_robot.connect()
@@ -103,7 +111,18 @@ def main(args: Args):
     
     # The Sim2RealEnv class uses the sim_env to help make various checks for sim2real alignment (e.g. observation space is the same, cameras are the similar)
     # and will always try its best to apply all wrappers you used on the sim env to the real env as well.
-    real_env = Sim2RealEnv(sim_env=sim_env, agent=real_agent, control_freq=args.control_freq)
+    timings = StageTimings()
+    if args.async_capture:
+        real_env = AsyncSim2RealEnv(
+            sim_env=sim_env,
+            agent=real_agent,
+            timings=timings,
+            deadline=args.control_deadline_ms / 1000 if args.control_deadline_ms is not None else None,
+            miss_policy=args.miss_policy,
+            control_freq=args.control_freq,
+        )
+    else:
+        real_env = Sim2RealEnv(sim_env=sim_env, agent=real_agent, control_freq=args.control_freq)
     # sim_env.print_sim_details()
     sim_obs, _ = sim_env.reset()
     real_obs, _ = real_env.reset()
@@ -118,60 +137,48 @@ def main(args: Args):
     setup_safe_exit(sim_env, real_env, real_agent)
         
 
-    ### Load our checkpoint ###
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    agent = Agent(sim_env, sample_obs=real_obs)
-    if args.checkpoint:
-        agent.load_state_dict(torch.load(args.checkpoint, map_location=device))
-        print(f"Loaded agent from {args.checkpoint}")
-    else:
+    if agent is None:
         print("No checkpoint provided, using random agent")
-    agent.to(device)
+        agent = Agent(sim_env, sample_obs=real_obs).to(device)
 
     
-    ### Visualization setup for debug modes ###
+    ### Visualization setup for debug modes. The viewer runs and renders the sim images in its own process so it does not hold up the control loop ###
     if args.debug:
-        fig = plt.figure()
-        ax = fig.add_subplot(3, 1, 1)
-        ax2 = fig.add_subplot(3, 1, 2)
-        ax3 = fig.add_subplot(3, 1, 3)
-
-        # Disable all default key bindings
-        fig.canvas.mpl_disconnect(fig.canvas.manager.key_press_handler_id)
-        fig.canvas.manager.key_press_handler_id = None
-
-
-        # initialize the plot
-        overlaid_imgs, real_imgs, sim_imgs = overlay_envs(sim_env, real_env)
-        im = ax.imshow(overlaid_imgs)
-        im2 = ax2.imshow(sim_imgs)
-        im3 = ax3.imshow(real_imgs)
+        viewer = DebugViewer(real_obs["rgb"].shape[1:], args.env_id, env_kwargs, sim_env.unwrapped.get_state().shape[-1])
 
     ### Main evaluation loop ###
     episode_count = 0
+    recorded_obs = defaultdict(list)
     while args.num_episodes is None or episode_count < args.num_episodes:
         print(f"Evaluation Episode {episode_count}")
         for _ in tqdm(range(args.max_episode_steps)):
             agent_obs = real_obs
 
-            agent_obs = {k: v.to(device) for k, v in agent_obs.items()}
-            action = agent.get_action(agent_obs)
+            if args.record_obs_path is not None:
+                for k, v in agent_obs.items():
+                    recorded_obs[k].append(v.cpu().numpy())
+            with timings.scope("inference"):
+                agent_obs = {k: v.to(device) for k, v in agent_obs.items()}
+                action = agent.get_action(agent_obs).cpu().numpy()
             if not args.continuous_eval:
                 input("Press enter to continue to next timestep")
-            real_obs, _, terminated, truncated, info = real_env.step(action.cpu().numpy())
+                if args.async_capture:
+                    # waiting on the user is not a deadline miss
+                    real_env.scheduler.start()
+            real_obs, _, terminated, truncated, info = real_env.step(action)
             
-            if args.debug:
-                overlaid_imgs, real_imgs, sim_imgs = overlay_envs(sim_env, real_env)
-                im.set_data(overlaid_imgs)
-                im2.set_data(sim_imgs)
-                im3.set_data(real_imgs)
-                # Redraw the plot
-                fig.canvas.draw()
-                fig.show()
-                fig.canvas.flush_events()
+            if args.debug and viewer.wants_frame():
+                viewer.publish(real_obs["rgb"][0].cpu().numpy(), sim_env.unwrapped.get_state()[0].cpu().numpy())
 
         episode_count += 1
+        print(f"Step timings of episode {episode_count - 1}:\n{timings.format_summary()}")
+        if args.async_capture:
+            print(f"Control loop timing of episode {episode_count - 1}:\n{real_env.scheduler.format_summary()}")
+        if args.record_obs_path is not None:
+            np.savez(args.record_obs_path, **{k: np.concatenate(v) for k, v in recorded_obs.items()})
         real_env.reset()
+    if args.debug:
+        viewer.close()
     sim_env.close()
     real_env.close()
 
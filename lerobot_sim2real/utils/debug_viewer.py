@@ -0,0 +1,180 @@
+"""Out of process viewer for the real and sim camera images of a real robot evaluation.
+
+Rendering the sim cameras and drawing matplotlib figures in the control loop blocks the robot for tens of milliseconds every step.
+`DebugViewer` instead starts a separate process that shows the real image, the sim image and their overlay. The process makes its own copy
+of the sim env, so the control loop only hands it the real image and the sim env's state vector through a `SharedFrameRing`, a ring buffer
+in shared memory that is written and read without locks. The viewer sets its env to the newest state, renders the sim cameras and draws at
+its own rate, dropping any frames it falls behind on. The control loop only publishes a new frame once the viewer has taken the previous
+one, so it never waits on the viewer and never renders.
+"""
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+# indices into the header of a SharedFrameRing
+_HEAD, _READ, _CLOSED, _VIEWER_CLOSED, _SLOTS = range(5)
+
+
+class SharedFrameRing:
+    """A ring buffer of uint8 frames in shared memory with one writer and one reader.
+
+    Every slot has a sequence number that is cleared while the slot is being written, so a reader can tell when a frame it copied was
+    overwritten in the meantime and discard it (a seqlock).
+
+    Args:
+        frame_shapes: maps the name of every image in a frame to its shape
+        num_slots: number of frames the ring holds
+        name: name of an existing ring to attach to. If None a new ring is created
+    """
+    def __init__(self, frame_shapes: Dict[str, Tuple[int, ...]], num_slots: int = 4, name: Optional[str] = None):
+        self.frame_shapes = frame_shapes
+        self.num_slots = num_slots
+        self.frame_size = sum(int(np.prod(shape)) for shape in frame_shapes.values())
+        header_size = 8 * (_SLOTS + num_slots)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=header_size + num_slots * self.frame_size)
+        self.header = np.ndarray((_SLOTS + num_slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((num_slots, self.frame_size), dtype=np.uint8, buffer=self.shm.buf, offset=header_size)
+        if self.owner:
+            self.header[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _views(self, slot: int):
+        views, offset = {}, 0
+        for key, shape in self.frame_shapes.items():
+            size = int(np.prod(shape))
+            views[key] = self.data[slot, offset:offset + size].reshape(shape)
+            offset += size
+        return views
+
+    def write(self, frames: Dict[str, np.ndarray]):
+        seq = int(self.header[_HEAD]) + 1
+        slot = seq % self.num_slots
+        self.header[_SLOTS + slot] = -1
+        for key, view in self._views(slot).items():
+            view[...] = frames[key]
+        self.header[_SLOTS + slot] = seq
+        self.header[_HEAD] = seq
+
+    def read_latest(self, out: Dict[str, np.ndarray], last_seq: int = 0):
+        """copies the newest frame into out and returns its sequence number, or returns None if there is no frame newer than last_seq or
+        it was overwritten while being copied"""
+        seq = int(self.header[_HEAD])
+        if seq <= last_seq:
+            return None
+        slot = seq % self.num_slots
+        if self.header[_SLOTS + slot] != seq:
+            return None
+        for key, view in self._views(slot).items():
+            out[key][...] = view
+        if self.header[_SLOTS + slot] != seq:
+            return None
+        self.header[_READ] = seq
+        return seq
+
+    def close(self):
+        del self.header, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def render_sim_rgb(sim_env):
+    """renders the sim camera images, concatenated along the channels in the same order as the flattened observations"""
+    sensor_data = sim_env.unwrapped.get_obs()["sensor_data"]
+    return torch.cat([data["rgb"] for data in sensor_data.values()], dim=-1)[0].cpu().numpy()
+
+
+def _frame_shapes(frame_shape: Tuple[int, int, int], state_size: int):
+    # the float32 sim state is sent as its bytes
+    return dict(real=frame_shape, sim_state=(state_size * 4,))
+
+
+def _run_viewer(
+    ring_name: str, frame_shape: Tuple[int, int, int], state_size: int, num_slots: int, fps: float, env_id: str, env_kwargs: dict
+):
+    import gymnasium as gym
+    import matplotlib.pyplot as plt
+    import mani_skill.envs
+    import lerobot_sim2real.envs.push_cube
+
+    sim_env = gym.make(env_id, **env_kwargs)
+    sim_env.reset(seed=0)
+    ring = SharedFrameRing(_frame_shapes(frame_shape, state_size), num_slots, name=ring_name)
+    frames = {key: np.zeros(shape, dtype=np.uint8) for key, shape in ring.frame_shapes.items()}
+    fig, axes = plt.subplots(3, 1)
+    # keys are meant for the terminal running the robot, not for the figure
+    fig.canvas.mpl_disconnect(fig.canvas.manager.key_press_handler_id)
+    # the images of multiple cameras are concatenated along the channel dimension, show them side by side
+    tile = lambda x: np.concatenate(np.split(x, x.shape[-1] // 3, axis=-1), axis=1)
+    images = [ax.imshow(tile(frames["real"])) for ax in axes]
+    for ax, title in zip(axes, ["overlay", "sim", "real"]):
+        ax.set_title(title)
+        ax.axis("off")
+    last_seq, num_dropped = 0, 0
+    while ring.header[_CLOSED] == 0 and plt.fignum_exists(fig.number):
+        seq = ring.read_latest(frames, last_seq)
+        if seq is not None:
+            num_dropped += seq - last_seq - 1
+            last_seq = seq
+            state = torch.from_numpy(frames["sim_state"].view(np.float32).copy()).to(sim_env.unwrapped.device)
+            sim_env.unwrapped.set_state(state[None])
+            real, sim = tile(frames["real"]), tile(render_sim_rgb(sim_env))
+            overlay = ((real.astype(np.uint16) + sim) // 2).astype(np.uint8)
+            for image, data in zip(images, [overlay, sim, real]):
+                image.set_data(data)
+            fig.suptitle(f"step {seq}, {num_dropped} frames dropped")
+        plt.pause(1 / fps)
+    ring.header[_VIEWER_CLOSED] = 1
+    ring.close()
+    plt.close(fig)
+    sim_env.close()
+
+
+class DebugViewer:
+    """Shows real and sim camera images and their overlay in a separate process, which renders the sim images with its own sim env.
+
+    Args:
+        frame_shape: shape of the real and sim images, (H, W, 3 * number of cameras) with the cameras concatenated along the channels as
+            FlattenRGBDObservationWrapper does
+        env_id: id of the sim env to render
+        env_kwargs: kwargs the sim env is made with, the same ones as the control loop's sim env so the states match
+        state_size: size of the sim env's state vector, see BaseEnv.get_state
+        fps: rate the viewer redraws at
+        num_slots: number of frames the shared ring buffer holds
+    """
+    def __init__(
+        self, frame_shape: Tuple[int, int, int], env_id: str, env_kwargs: dict, state_size: int, fps: float = 30, num_slots: int = 4
+    ):
+        self.frame_shape = tuple(frame_shape)
+        self.ring = SharedFrameRing(_frame_shapes(self.frame_shape, state_size), num_slots)
+        # spawn rather than fork so the viewer does not inherit the robot, the cameras or the simulator
+        self.process = mp.get_context("spawn").Process(
+            target=_run_viewer, args=(self.ring.name, self.frame_shape, state_size, num_slots, fps, env_id, env_kwargs), daemon=True
+        )
+        self.process.start()
+
+    @property
+    def closed(self):
+        return self.ring.header[_VIEWER_CLOSED] != 0 or not self.process.is_alive()
+
+    def wants_frame(self):
+        """whether the viewer has taken the last published frame. Frames only need to be published if so"""
+        return not self.closed and self.ring.header[_READ] == self.ring.header[_HEAD]
+
+    def publish(self, real: np.ndarray, sim_state: np.ndarray):
+        """publishes a real image and the state vector of the sim env the viewer renders the sim image from"""
+        self.ring.write(dict(real=real, sim_state=np.ascontiguousarray(sim_state, dtype=np.float32).view(np.uint8)))
+
+    def close(self):
+        self.ring.header[_CLOSED] = 1
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.ring.close()
@@ -0,0 +1,363 @@
+"""Pipelined real robot runner with asynchronous camera capture.
+
+With the default `Sim2RealEnv`, every step sleeps until the control period has passed, writes the action to the motor bus, then reads a camera
+frame and crops and resizes it before the policy can run, so capture and preprocessing add latency to every action on top of the control period.
+
+`AsyncCameraCapture` runs a thread per camera that waits for every new frame and preprocesses it into a preallocated buffer, always keeping
+the latest preprocessed frame ready. `AsyncSim2RealEnv` takes its observations from there: it writes the action to the bus as soon as it
+is given and sleeps until the next control tick afterwards instead of before, so the latency from an observation to the action computed
+from it is only the age of the camera frame, policy inference and the bus write. `StageTimings` records the time of each of these stages.
+
+The control ticks are kept by a `ControlScheduler`, which corrects for drift, checks every step against a deadline and collects the latency,
+jitter and deadline miss statistics of an episode, so that timing problems on the real robot can be told apart from policy failures.
+"""
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import threading
+import time
+from typing import Dict, Literal, Optional, Tuple
+
+import numpy as np
+import torch
+
+from mani_skill.envs.sim2real_env import Sim2RealEnv
+from mani_skill.utils import common
+
+
+class StageTimings:
+    """Records per-step durations in seconds of named stages of the real robot control loop"""
+    def __init__(self):
+        self.times = defaultdict(list)
+
+    def add(self, name: str, seconds: float):
+        self.times[name].append(seconds)
+
+    @contextmanager
+    def scope(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def summary(self, reset: bool = True):
+        """returns a dict mapping each stage to the mean, median and 99th percentile of its durations in ms"""
+        summary = {}
+        for name, times in self.times.items():
+            times = np.array(times) * 1e3
+            summary[name] = dict(mean=times.mean(), p50=np.median(times), p99=np.percentile(times, 99))
+        if reset:
+            self.times.clear()
+        return summary
+
+    def format_summary(self, reset: bool = True):
+        return "\n".join(
+            f"  {name}: mean={s['mean']:.2f}ms p50={s['p50']:.2f}ms p99={s['p99']:.2f}ms" for name, s in self.summary(reset).items()
+        )
+
+
+def center_crop_resize(img: np.ndarray, out: np.ndarray):
+    """center crops img to the aspect ratio of out and resizes it into out, the same way Sim2RealEnv.preprocess_sensor_data does"""
+    import cv2
+    xy_res = img.shape[:2]
+    cutoff = (np.max(xy_res) - np.min(xy_res)) // 2
+    if xy_res[0] == xy_res[1]:
+        pass
+    elif np.argmax(xy_res) == 0:
+        img = img[cutoff:-cutoff, :, :]
+    else:
+        img = img[:, cutoff:-cutoff, :]
+    cv2.resize(img, (out.shape[1], out.shape[0]), dst=out)
+    return out
+
+
+class _CameraStream:
+    def __init__(self, camera, shape: Tuple[int, int]):
+        self.camera = camera
+        # frames are preprocessed into one buffer while the other holds the latest frame
+        self.buffers = [np.zeros((*shape, 3), dtype=np.uint8) for _ in range(2)]
+        self.latest = None
+        self.seq = 0
+        self.capture_time = None
+        self.preprocess_time = None
+
+
+class AsyncCameraCapture:
+    """Continuously reads and preprocesses the frames of the given cameras in background threads.
+
+    Args:
+        cameras: maps sensor names to LeRobot cameras, whose `async_read` blocks until the camera has a new frame
+        shapes: maps sensor names to the (height, width) the frames are center cropped and resized to
+        read_timeout_ms: timeout of a single camera read
+    """
+    def __init__(self, cameras: Dict[str, object], shapes: Dict[str, Tuple[int, int]], read_timeout_ms: float = 1000):
+        self.streams = {name: _CameraStream(cameras[name], shape) for name, shape in shapes.items()}
+        self.read_timeout_ms = read_timeout_ms
+        self.cond = threading.Condition()
+        self.error = None
+        self.running = True
+        self.threads = [threading.Thread(target=self._capture_loop, args=(stream,), daemon=True) for stream in self.streams.values()]
+        for thread in self.threads:
+            thread.start()
+
+    def _capture_loop(self, stream: _CameraStream):
+        write_index = 0
+        while self.running:
+            try:
+                frame = stream.camera.async_read(timeout_ms=self.read_timeout_ms)
+                capture_time = time.perf_counter()
+                center_crop_resize(np.asarray(frame), stream.buffers[write_index])
+                preprocess_time = time.perf_counter() - capture_time
+            except Exception as e:
+                if not self.running:
+                    break
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                break
+            with self.cond:
+                stream.latest = stream.buffers[write_index]
+                stream.seq += 1
+                stream.capture_time = capture_time
+                stream.preprocess_time = preprocess_time
+                self.cond.notify_all()
+            write_index = 1 - write_index
+
+    def get(self, newer_than: Optional[Dict[str, int]] = None, timeout: float = 1.0):
+        """waits until every camera has a frame newer than the sequence numbers in newer_than (or any frame) and returns a dict mapping
+        sensor names to the frame as a uint8 (1, H, W, 3) tensor, its sequence number, the time it was captured at (time.perf_counter)
+        and the time it took to preprocess"""
+        newer_than = newer_than or {}
+        def ready():
+            return self.error is not None or all(stream.seq > newer_than.get(name, 0) for name, stream in self.streams.items())
+        with self.cond:
+            if not self.cond.wait_for(ready, timeout=timeout):
+                raise TimeoutError(f"no new camera frame within {timeout}s")
+            if self.error is not None:
+                raise RuntimeError("camera capture failed") from self.error
+            # copy out under the lock as the capture thread reuses the buffer two frames later
+            return {
+                name: dict(
+                    rgb=torch.from_numpy(stream.latest.copy()).unsqueeze(0),
+                    seq=stream.seq,
+                    capture_time=stream.capture_time,
+                    preprocess_time=stream.preprocess_time,
+                )
+                for name, stream in self.streams.items()
+            }
+
+    def close(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout=self.read_timeout_ms / 1000 + 1)
+
+
+class ControlScheduler:
+    """Keeps the ticks of a real-time control loop on a fixed schedule and keeps track of how well it is met.
+
+    Ticks are at start + k * period on the monotonic clock rather than a period after the previous wake up, so sleep overshoot and slow
+    steps do not make the loop drift. A step that ends after the next tick moves the schedule to the first tick still ahead, and the
+    ticks in between are counted as skipped. Every step has to send its action within `deadline` seconds of its tick; `deadline_missed`
+    tells whether it is too late.
+
+    Args:
+        period: seconds between ticks
+        deadline: seconds after a tick the step's action has to be sent by. Defaults to the period
+        spin_time: the last spin_time seconds before a tick are busy waited instead of slept, as sleeping can overshoot by a millisecond or more
+    """
+    def __init__(self, period: float, deadline: Optional[float] = None, spin_time: float = 1e-3):
+        self.period = period
+        self.deadline = deadline if deadline is not None else period
+        self.spin_time = spin_time
+        self.start_time = None
+        self.tick = None
+        self.tick_index = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.latencies = []
+        self.wake_jitter = []
+        self.write_times = []
+        self.num_steps = 0
+        self.num_missed = 0
+        self.num_skipped_ticks = 0
+
+    @property
+    def running(self):
+        return self.start_time is not None
+
+    def start(self):
+        """makes now the first tick of the schedule"""
+        self.start_time = time.perf_counter()
+        self.tick = self.start_time
+        self.tick_index = 0
+
+    def stop(self):
+        self.start_time = None
+
+    def deadline_missed(self, now: Optional[float] = None):
+        now = now if now is not None else time.perf_counter()
+        return now > self.tick + self.deadline
+
+    def record_step(self, missed: bool, write_time: Optional[float] = None):
+        """records a step of the current tick, write_time being when its action finished being sent or None if no action was sent"""
+        self.num_steps += 1
+        self.num_missed += int(missed)
+        if write_time is not None:
+            self.latencies.append(write_time - self.tick)
+            self.write_times.append(write_time)
+
+    def wait_for_next_tick(self):
+        self.tick_index += 1
+        next_tick = self.start_time + self.tick_index * self.period
+        now = time.perf_counter()
+        if now > next_tick:
+            skipped = int((now - next_tick) // self.period) + 1
+            self.num_skipped_ticks += skipped
+            self.tick_index += skipped
+            next_tick = self.start_time + self.tick_index * self.period
+        if next_tick - now > self.spin_time:
+            time.sleep(next_tick - now - self.spin_time)
+        while time.perf_counter() < next_tick:
+            pass
+        self.tick = next_tick
+        self.wake_jitter.append(time.perf_counter() - next_tick)
+
+    def summary(self, reset: bool = True):
+        """returns the step, deadline miss and skipped tick counts, the distribution of the latency from tick to sent action and of the
+        time between sent actions in ms, and a histogram of the latency in fractions of the deadline"""
+        latencies = np.array(self.latencies) * 1e3
+        intervals = np.diff(np.array(self.write_times)) * 1e3
+        wake_jitter = np.array(self.wake_jitter) * 1e3
+        def stats(x):
+            if len(x) == 0:
+                return None
+            return dict(mean=x.mean(), std=x.std(), p50=np.median(x), p99=np.percentile(x, 99), max=x.max())
+        edges = self.deadline * 1e3 * np.array([0, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, np.inf])
+        summary = dict(
+            num_steps=self.num_steps,
+            num_missed=self.num_missed,
+            num_skipped_ticks=self.num_skipped_ticks,
+            latency=stats(latencies),
+            action_interval=stats(intervals),
+            wake_jitter=stats(wake_jitter),
+            latency_histogram=(edges, np.histogram(latencies, bins=edges)[0]),
+        )
+        if reset:
+            self.reset_stats()
+        return summary
+
+    def format_summary(self, reset: bool = True):
+        summary = self.summary(reset)
+        lines = [
+            f"  steps: {summary['num_steps']}, deadline misses: {summary['num_missed']}, skipped ticks: {summary['num_skipped_ticks']} "
+            f"(period={self.period * 1e3:.1f}ms, deadline={self.deadline * 1e3:.1f}ms)"
+        ]
+        for name in ["latency", "action_interval", "wake_jitter"]:
+            s = summary[name]
+            if s is not None:
+                lines.append(f"  {name}: mean={s['mean']:.2f}ms std={s['std']:.2f}ms p50={s['p50']:.2f}ms p99={s['p99']:.2f}ms max={s['max']:.2f}ms")
+        edges, counts = summary["latency_histogram"]
+        total = max(counts.sum(), 1)
+        for low, high, count in zip(edges[:-1], edges[1:], counts):
+            lines.append(f"    [{low:6.1f}, {high:6.1f})ms {'#' * int(round(40 * count / total)):<40} {count}")
+        return "\n".join(lines)
+
+
+class AsyncSim2RealEnv(Sim2RealEnv):
+    """A Sim2RealEnv whose camera observations come from an AsyncCameraCapture and that writes an action to the robot as soon as it is
+    given, waiting for the next control tick of a ControlScheduler afterwards.
+
+    Observations wait for camera frames newer than the ones of the previous observation, so inference starts as soon as a new frame is
+    available if the camera is slower than the control loop. An action given after the step's deadline is handled according to
+    miss_policy. It otherwise takes the same arguments as Sim2RealEnv, as well as
+
+    Args:
+        timings: records the capture age, preprocess and bus write times of every step, as well as the latency from the capture of the
+            frame an action was computed from to the end of its bus write. Time policy inference with `timings.scope("inference")`
+        frame_timeout: seconds to wait for a new camera frame before raising a TimeoutError
+        deadline: seconds after the observation's control tick the action has to be given by. Defaults to the control period
+        miss_policy: what to do with an action given after its deadline. "send" sends it anyway, "hold" sends the previous action again,
+            "predict" sends a linear extrapolation of the previous two actions and "skip" sends nothing until the next tick
+    """
+    def __init__(
+        self,
+        sim_env,
+        agent,
+        timings: Optional[StageTimings] = None,
+        frame_timeout: float = 1.0,
+        deadline: Optional[float] = None,
+        miss_policy: Literal["send", "hold", "predict", "skip"] = "send",
+        **kwargs,
+    ):
+        sensor_configs = sim_env.unwrapped._sensor_configs
+        shapes = {name: (sensor_configs[name].height, sensor_configs[name].width) for name in sim_env.unwrapped.scene.sensors.keys()}
+        self.capture = AsyncCameraCapture(agent.real_robot.cameras, shapes)
+        self.timings = timings if timings is not None else StageTimings()
+        self.frame_timeout = frame_timeout
+        self.miss_policy = miss_policy
+        self._frame_seqs = {}
+        self._frame_capture_time = None
+        self._sent_actions = deque(maxlen=2)
+        control_freq = kwargs.get("control_freq") or sim_env.unwrapped.control_freq
+        self.scheduler = ControlScheduler(1 / control_freq, deadline)
+        super().__init__(sim_env, agent, **kwargs)
+
+    def _get_obs_sensor_data(self, apply_texture_transforms: bool = True):
+        frames = self.capture.get(newer_than=self._frame_seqs, timeout=self.frame_timeout)
+        now = time.perf_counter()
+        if not self.scheduler.running:
+            self.scheduler.start()
+        self._frame_seqs = {name: frame["seq"] for name, frame in frames.items()}
+        # with several cameras the oldest frame bounds the latency
+        self._frame_capture_time = min(frame["capture_time"] for frame in frames.values())
+        self.timings.add("capture_age", now - self._frame_capture_time)
+        self.timings.add("preprocess", max(frame["preprocess_time"] for frame in frames.values()))
+        return {name: dict(rgb=frame["rgb"]) for name, frame in frames.items()}
+
+    def _action_on_miss(self, action):
+        if self.miss_policy == "send":
+            return action
+        if self.miss_policy == "skip":
+            return None
+        if len(self._sent_actions) == 0:
+            # nothing sent yet to hold or extrapolate
+            return action
+        if self.miss_policy == "hold" or len(self._sent_actions) == 1:
+            return self._sent_actions[-1]
+        prediction = 2 * self._sent_actions[-1] - self._sent_actions[-2]
+        space = self._orig_single_action_space
+        return prediction.clamp(torch.as_tensor(space.low), torch.as_tensor(space.high))
+
+    def _step_action(self, action):
+        action = common.to_tensor(action)
+        if action.shape == self._orig_single_action_space.shape:
+            action = common.batch(action)
+        missed = self.scheduler.deadline_missed()
+        if missed:
+            action = self._action_on_miss(action)
+        write_time = None
+        if action is not None:
+            self.base_sim_env.agent.set_action(action)
+            sim_articulation = self.agent.controller.articulation
+            with self.timings.scope("bus_write"):
+                if self.agent.controller.sets_target_qpos:
+                    self.agent.set_target_qpos(sim_articulation.drive_targets)
+                if self.agent.controller.sets_target_qvel:
+                    self.agent.set_target_qvel(sim_articulation.drive_velocities)
+            write_time = time.perf_counter()
+            self._sent_actions.append(action)
+            if self._frame_capture_time is not None:
+                self.timings.add("obs_to_action", write_time - self._frame_capture_time)
+        self.scheduler.record_step(missed, write_time)
+        # the next observation is taken at the next control tick, right before the policy runs on it
+        self.scheduler.wait_for_next_tick()
+
+    def reset(self, seed=None, options=None):
+        self.scheduler.stop()
+        self._sent_actions.clear()
+        return super().reset(seed=seed, options=options)
+
+    def close(self):
+        self.capture.close()
+        super().close()
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+import torch
+import torch.nn as nn
+
+from lerobot_sim2real.rl.ppo_rgb import AsyncEvaluator
+
+
+class SharedSim(object):
+    """stands in for the simulator shared by the training and eval envs, records how many threads step it at once"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.num_steps = 0
+    def step(self):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.001)
+        with self._lock:
+            self.active -= 1
+            self.num_steps += 1
+
+
+class FakeEnvs(object):
+    def __init__(self, sim, num_envs=2):
+        self.sim = sim
+        self.num_envs = num_envs
+    def reset(self, seed=None):
+        self.sim.step()
+        return torch.zeros(self.num_envs, 3), dict()
+    def step(self, action):
+        self.sim.step()
+        zeros = torch.zeros(self.num_envs)
+        return torch.zeros(self.num_envs, 3), zeros, zeros.bool(), zeros.bool(), dict()
+
+
+class FakeAgent(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layer = nn.Linear(3, 2)
+    def get_action(self, x, deterministic=False):
+        return self.layer(x)
+
+
+def test_eval_envs_are_not_stepped_concurrently_with_training():
+    sim = SharedSim()
+    agent = FakeAgent()
+    evaluator = AsyncEvaluator(FakeEnvs(sim), agent, num_eval_steps=20, max_pending=3)
+    train_envs = FakeEnvs(sim)
+    for global_step in range(3):
+        evaluator.submit(agent, global_step)
+        for _ in range(20):
+            with evaluator.sim_lock:
+                train_envs.step(None)
+    evaluator.close()
+    assert [result[0] for result in evaluator.results()] == [0, 1, 2]
+    assert sim.num_steps == 3 * 20 + 3 * 21
+    assert sim.max_active == 1
+
+
+class FailingEnvs(FakeEnvs):
+    def step(self, action):
+        raise ValueError("env failed")
+
+
+def test_errors_are_raised_in_the_training_thread():
+    agent = FakeAgent()
+    evaluator = AsyncEvaluator(FailingEnvs(SharedSim()), agent, num_eval_steps=20, max_pending=1)
+    evaluator.submit(agent, 0)
+    evaluator._thread.join(timeout=5)
+    assert not evaluator._thread.is_alive()
+    with pytest.raises(RuntimeError, match="async evaluator failed") as e:
+        evaluator.results()
+    assert isinstance(e.value.__cause__, ValueError)
+    with pytest.raises(RuntimeError):
+        evaluator.submit(agent, 1)
+    # the queue of the dead thread is full, close must still return
+    evaluator._snapshots.put_nowait((1, agent.state_dict()))
+    with pytest.raises(RuntimeError):
+        evaluator.close()
@@ -0,0 +1,49 @@
+import time
+
+import pytest
+import torch
+
+from lerobot_sim2real.rl.ppo_rgb import BufferedLogger
+
+
+class FakeWriter(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.scalars = []
+        self.closed = False
+    def add_scalar(self, tag, value, step):
+        if self.fail:
+            raise OSError("disk full")
+        self.scalars.append((tag, value, step))
+    def close(self):
+        self.closed = True
+
+
+def test_scalars_are_averaged_between_flushes():
+    writer = FakeWriter()
+    logger = BufferedLogger(tensorboard=writer)
+    logger.add_scalar("a", torch.tensor(1.0), 0)
+    logger.add_scalar("a", torch.tensor(3.0), 1)
+    logger.add_masked_mean("b", torch.tensor([1.0, 2.0, 6.0]), torch.tensor([True, False, True]), 1)
+    logger.flush(1)
+    logger.add_scalar("a", 5.0, 2)
+    logger.close()
+    assert writer.scalars == [("a", 2.0, 1), ("b", 3.5, 1), ("a", 5.0, 2)]
+    assert writer.closed
+
+
+def test_write_errors_are_raised_in_the_training_thread():
+    writer = FakeWriter(fail=True)
+    logger = BufferedLogger(tensorboard=writer)
+    logger.add_scalar("a", 1.0, 0)
+    logger.flush(0)
+    deadline = time.time() + 5
+    while logger._error is None and time.time() < deadline:
+        time.sleep(0.01)
+    logger.add_scalar("a", 2.0, 1)
+    with pytest.raises(RuntimeError, match="writing logs failed"):
+        logger.flush(1)
+    with pytest.raises(RuntimeError) as e:
+        logger.close()
+    assert isinstance(e.value.__cause__, OSError)
+    assert writer.closed
@@ -0,0 +1,62 @@
+import os
+import time
+
+import pytest
+
+import torch
+
+from lerobot_sim2real.rl.checkpoint import CheckpointWriter
+
+
+def save(writer, tmp_path, i, **kwargs):
+    path = os.path.join(tmp_path, f"ckpt_{i}.ckpt")
+    writer.save(path, {"w": torch.full((4,), float(i))}, dict(iteration=i), **kwargs)
+    return path
+
+
+def remaining(tmp_path):
+    return sorted(int(name[len("ckpt_"):-len(".ckpt")]) for name in os.listdir(tmp_path) if name.endswith(".ckpt"))
+
+
+def test_keep_last_and_best(tmp_path):
+    writer = CheckpointWriter(keep_last=2, keep_best=1)
+    for i, score in enumerate([0.1, 0.9, 0.2, 0.3, 0.4]):
+        save(writer, tmp_path, i, score=score)
+    writer.close()
+    assert remaining(tmp_path) == [1, 3, 4]
+
+
+def test_late_score_of_a_pending_checkpoint_is_not_lost(tmp_path):
+    writer = CheckpointWriter(keep_last=1, keep_best=1)
+    paths = [save(writer, tmp_path, i, score_pending=True) for i in range(4)]
+    # the evaluation of the first checkpoint finishes after newer ones were saved
+    writer.set_score(paths[0], 0.9)
+    writer.set_score(paths[1], 0.1)
+    writer.set_score(paths[2], None)
+    writer.close()
+    assert remaining(tmp_path) == [0, 3]
+
+
+def test_pending_checkpoints_are_released_on_close(tmp_path):
+    writer = CheckpointWriter(keep_last=1)
+    for i in range(3):
+        save(writer, tmp_path, i, score_pending=True)
+    save(writer, tmp_path, 3, protected=True)
+    writer.close()
+    assert remaining(tmp_path) == [2, 3]
+
+
+def test_write_errors_are_raised_in_the_training_thread(tmp_path):
+    writer = CheckpointWriter(keep_last=1)
+    # the directory does not exist, so writing fails in the background thread
+    save(writer, os.path.join(tmp_path, "missing"), 0)
+    deadline = time.time() + 5
+    while writer._error is None and time.time() < deadline:
+        time.sleep(0.01)
+    with pytest.raises(RuntimeError, match="writing checkpoints failed"):
+        save(writer, tmp_path, 1)
+    with pytest.raises(RuntimeError):
+        writer.set_score(os.path.join(tmp_path, "ckpt_1.ckpt"), 1.0)
+    with pytest.raises(RuntimeError) as e:
+        writer.close()
+    assert isinstance(e.value.__cause__, OSError)
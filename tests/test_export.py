@@ -0,0 +1,47 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from lerobot_sim2real.rl.export import DeterministicPolicy, export_onnx, export_torchscript, sample_obs
+from lerobot_sim2real.rl.policy_runtime import ExportedPolicy
+from lerobot_sim2real.rl.ppo_rgb import Agent
+
+
+def make_agent():
+    torch.manual_seed(0)
+    obs = dict(rgb=torch.zeros((1, 64, 64, 3), dtype=torch.uint8), state=torch.zeros((1, 12)))
+    agent = Agent(None, sample_obs=obs, action_dim=6)
+    # the actor head is initialized close to zero, which would make any two policies match
+    nn.init.normal_(agent.actor_mean[-1].weight, std=0.1)
+    return agent.eval()
+
+
+def export(agent, fmt, path):
+    policy = DeterministicPolicy(agent).eval()
+    example_obs = sample_obs(agent, 1, "cpu")
+    if fmt == "torchscript":
+        export_torchscript(policy, example_obs, path)
+    else:
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+        export_onnx(policy, example_obs, path, opset_version=17)
+
+
+@pytest.mark.parametrize("fmt, ext", [("torchscript", "ts"), ("onnx", "onnx")])
+def test_exported_policy_matches_agent(tmp_path, fmt, ext):
+    agent = make_agent()
+    path = str(tmp_path / f"policy.{ext}")
+    export(agent, fmt, path)
+    runtime = ExportedPolicy(path, device="cpu")
+    torch.manual_seed(1)
+    for batch_size in [1, 4]:
+        obs = sample_obs(agent, batch_size, "cpu")
+        assert obs["rgb"].dtype == torch.uint8
+        with torch.no_grad():
+            expected = agent.get_action(obs, deterministic=True)
+        actual = runtime.get_action(obs)
+        assert actual.shape == (batch_size, 6)
+        torch.testing.assert_close(actual, expected, atol=1e-4, rtol=1e-4)
+        # numpy observations give numpy actions
+        actual = runtime.get_action({k: v.numpy() for k, v in obs.items()})
+        torch.testing.assert_close(torch.from_numpy(actual), expected, atol=1e-4, rtol=1e-4)
@@ -0,0 +1,104 @@
+import pytest
+import torch
+
+from lerobot_sim2real.rl.gae import compute_gae, compute_gae_loop
+
+
+def make_rollout(num_steps: int, num_envs: int, done_prob: float, seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    dones = (torch.rand(num_steps, num_envs, generator=generator) < done_prob).float()
+    next_done = (torch.rand(num_envs, generator=generator) < done_prob).float()
+    # final values are only non zero where an episode ends after the step, see compute_gae_loop
+    final_values = torch.randn(num_steps, num_envs, generator=generator) * torch.cat([dones[1:], next_done[None]])
+    return dict(
+        rewards=torch.randn(num_steps, num_envs, generator=generator),
+        values=torch.randn(num_steps, num_envs, generator=generator),
+        dones=dones,
+        final_values=final_values,
+        next_value=torch.randn(1, num_envs, generator=generator),
+        next_done=next_done,
+    )
+
+
+def assert_matches_loop(rollout, chunk_size=None, **kwargs):
+    expected = compute_gae_loop(**rollout, **kwargs)
+    actual = compute_gae(**rollout, **kwargs, chunk_size=chunk_size)
+    assert actual.shape == expected.shape
+    torch.testing.assert_close(actual, expected, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize("finite_horizon_gae", [False, True])
+@pytest.mark.parametrize("done_prob", [0.0, 0.05, 0.5, 1.0])
+def test_matches_loop(finite_horizon_gae, done_prob):
+    rollout = make_rollout(64, 32, done_prob)
+    assert_matches_loop(rollout, gamma=0.9, gae_lambda=0.95, finite_horizon_gae=finite_horizon_gae)
+
+
+@pytest.mark.parametrize("finite_horizon_gae", [False, True])
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 50, 64, 1000])
+def test_chunk_boundaries(finite_horizon_gae, chunk_size):
+    # chunk sizes that do and do not divide the rollout length, with episodes crossing chunk boundaries
+    rollout = make_rollout(50, 16, 0.1, seed=1)
+    assert_matches_loop(rollout, chunk_size, gamma=0.99, gae_lambda=0.95, finite_horizon_gae=finite_horizon_gae)
+
+
+@pytest.mark.parametrize("finite_horizon_gae", [False, True])
+def test_done_at_chunk_boundaries(finite_horizon_gae):
+    rollout = make_rollout(32, 8, 0.0, seed=2)
+    rollout["dones"][8] = 1.0
+    rollout["dones"][16, ::2] = 1.0
+    rollout["final_values"][7] = torch.randn(8)
+    rollout["final_values"][15, ::2] = torch.randn(4)
+    assert_matches_loop(rollout, 8, gamma=0.9, gae_lambda=0.95, finite_horizon_gae=finite_horizon_gae)
+
+
+@pytest.mark.parametrize("finite_horizon_gae", [False, True])
+@pytest.mark.parametrize("gamma, gae_lambda", [(0.0, 0.95), (0.9, 0.0), (0.0, 0.0), (1.0, 1.0)])
+def test_edge_discounts(finite_horizon_gae, gamma, gae_lambda):
+    rollout = make_rollout(32, 16, 0.1, seed=3)
+    assert_matches_loop(rollout, gamma=gamma, gae_lambda=gae_lambda, finite_horizon_gae=finite_horizon_gae)
+
+
+def test_zero_lambda_is_one_step_td():
+    rollout = make_rollout(16, 8, 0.2, seed=4)
+    gamma = 0.9
+    advantages = compute_gae(**rollout, gamma=gamma, gae_lambda=0.0)
+    next_not_done = 1.0 - torch.cat([rollout["dones"][1:], rollout["next_done"][None]])
+    next_values = torch.cat([rollout["values"][1:], rollout["next_value"]])
+    deltas = rollout["rewards"] + gamma * (next_not_done * next_values + rollout["final_values"]) - rollout["values"]
+    torch.testing.assert_close(advantages, deltas)
+
+
+@pytest.mark.parametrize("next_done", [0.0, 1.0])
+def test_first_and_last_step(next_done):
+    rollout = make_rollout(1, 8, 0.0, seed=5)
+    rollout["next_done"].fill_(next_done)
+    rollout["final_values"][0] = torch.randn(8) * next_done
+    assert_matches_loop(rollout, gamma=0.9, gae_lambda=0.95)
+    # with a single step the advantage is the one step td error, bootstrapped from next_value only if the episode continues
+    advantages = compute_gae(**rollout, gamma=0.9, gae_lambda=0.95)
+    next_values = (1.0 - next_done) * rollout["next_value"][0] + rollout["final_values"][0]
+    torch.testing.assert_close(advantages[0], rollout["rewards"][0] + 0.9 * next_values - rollout["values"][0])
+
+
+def test_last_step_bootstraps_from_next_value():
+    rollout = make_rollout(16, 8, 0.0, seed=6)
+    advantages = compute_gae(**rollout, gamma=0.9, gae_lambda=0.95)
+    rollout["next_value"] += 1.0
+    shifted = compute_gae(**rollout, gamma=0.9, gae_lambda=0.95)
+    # the change in next_value reaches step t discounted by (gamma * lambda)^(T - 1 - t) * gamma
+    discounts = 0.9 * (0.9 * 0.95) ** torch.arange(15, -1, -1, dtype=torch.float32)
+    torch.testing.assert_close(shifted - advantages, discounts[:, None].expand(16, 8))
+
+
+def test_first_step_done_does_not_leak():
+    # a done at step t means a new episode starts at t, so advantages before it must not see rewards from t on
+    rollout = make_rollout(16, 4, 0.0, seed=7)
+    rollout["dones"][8] = 1.0
+    rollout["final_values"][7] = torch.randn(4)
+    advantages = compute_gae(**rollout, gamma=0.9, gae_lambda=0.95)
+    rollout["rewards"][8:] += 10.0
+    rollout["next_value"] += 10.0
+    shifted = compute_gae(**rollout, gamma=0.9, gae_lambda=0.95)
+    torch.testing.assert_close(shifted[:8], advantages[:8])
+    assert torch.all(shifted[8:] > advantages[8:])
@@ -0,0 +1,125 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from lerobot_sim2real.envs.push_cube import SO100PushCubeEnv, make_reward_buffers, push_cube_reward_and_success
+from lerobot_sim2real.scripts.benchmark_reward import reference_reward_and_success
+
+NUM_ENVS = 512
+
+
+def random_states(seed: int, num_envs: int = NUM_ENVS):
+    generator = torch.Generator().manual_seed(seed)
+    # states around the cube so that all branches of the reward are hit
+    cube_pos = torch.rand((num_envs, 3), generator=generator) * 0.2
+    return dict(
+        cube_pos=cube_pos,
+        goal_pos=cube_pos + torch.randn((num_envs, 3), generator=generator) * 0.01,
+        tcp_pos=cube_pos + torch.randn((num_envs, 3), generator=generator) * 0.02,
+        cube_half_sizes=0.011 + torch.rand(num_envs, generator=generator) * 0.003,
+        qvel=torch.randn((num_envs, 6), generator=generator) * 0.1,
+        touching_table=torch.rand(num_envs, generator=generator) < 0.2,
+    )
+
+
+def kernel_args(states, touching_table):
+    return (
+        states["cube_pos"],
+        states["goal_pos"],
+        states["tcp_pos"],
+        states["cube_half_sizes"],
+        states["qvel"],
+        touching_table,
+        SO100PushCubeEnv.goal_radius,
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_kernel_matches_reference(seed):
+    states = random_states(seed)
+    reward, success = reference_reward_and_success(*kernel_args(states, states["touching_table"]))
+    assert 0 < success.sum() < NUM_ENVS
+    buffers = make_reward_buffers(NUM_ENVS, torch.device("cpu"))
+    push_cube_reward_and_success(*kernel_args(states, states["touching_table"]), buffers)
+    assert torch.equal(buffers["success"], success)
+    assert torch.equal(buffers["reward"], reward)
+
+
+def test_kernel_without_touching_table_only_computes_success():
+    states = random_states(0)
+    _, success = reference_reward_and_success(*kernel_args(states, states["touching_table"]))
+    buffers = make_reward_buffers(NUM_ENVS, torch.device("cpu"))
+    buffers["reward"].fill_(-1.0)
+    push_cube_reward_and_success(*kernel_args(states, None), buffers)
+    assert torch.equal(buffers["success"], success)
+    assert torch.all(buffers["reward"] == -1.0)
+
+
+def test_kernel_reuses_buffers():
+    buffers = make_reward_buffers(NUM_ENVS, torch.device("cpu"))
+    for seed in range(3):
+        states = random_states(seed)
+        reward, success = reference_reward_and_success(*kernel_args(states, states["touching_table"]))
+        push_cube_reward_and_success(*kernel_args(states, states["touching_table"]), buffers)
+        assert torch.equal(buffers["success"], success)
+        assert torch.equal(buffers["reward"], reward)
+
+
+def test_kernel_success_override():
+    states = random_states(0)
+    reward, state_success = reference_reward_and_success(*kernel_args(states, states["touching_table"]))
+    success = torch.zeros(NUM_ENVS, dtype=torch.bool)
+    success[::7] = True
+    buffers = make_reward_buffers(NUM_ENVS, torch.device("cpu"))
+    push_cube_reward_and_success(*kernel_args(states, states["touching_table"]), buffers, success=success)
+    # the success computed from the states is still written, but only the given success decides who gets the success reward
+    assert torch.equal(buffers["success"], state_success)
+    assert torch.all(buffers["reward"][success] == 3.0)
+    unchanged = ~success & ~state_success
+    assert torch.equal(buffers["reward"][unchanged], reward[unchanged])
+    assert torch.all(buffers["reward"][state_success & ~success] < 3.0)
+
+
+def make_env(states):
+    """a SO100PushCubeEnv without a scene, with the physics snapshot and contact query replaced by the given states"""
+    env = object.__new__(SO100PushCubeEnv)
+    env.num_envs = NUM_ENVS
+    env.device = torch.device("cpu")
+    env._reward_mode = "dense"
+    env._reward_buffers = make_reward_buffers(NUM_ENVS, env.device)
+    env._buffered_reward_inputs = None
+    env.cube_half_sizes = states["cube_half_sizes"]
+    env.agent = SimpleNamespace(robot=SimpleNamespace(get_qvel=lambda: states["qvel"]))
+    env._physics_snapshot = dict(cube_pos=states["cube_pos"], goal_pos=states["goal_pos"], tcp_pos=states["tcp_pos"])
+    forces = torch.zeros((2, NUM_ENVS, 3))
+    forces[0, states["touching_table"], 2] = 1.0
+    env._get_finger_table_contact_forces = lambda: forces
+    return env
+
+
+def test_env_reward_matches_reference():
+    states = random_states(0)
+    reward, success = reference_reward_and_success(*kernel_args(states, states["touching_table"]))
+    env = make_env(states)
+    info = env.evaluate()
+    assert torch.equal(info["success"], success)
+    assert torch.equal(info["touching_table"], states["touching_table"])
+    assert torch.equal(env.compute_dense_reward(None, None, info), reward)
+
+
+def test_env_reward_uses_the_info_passed_in():
+    states = random_states(0)
+    env = make_env(states)
+    info = env.evaluate()
+    touching_table = ~info["touching_table"]
+    success = torch.zeros_like(info["success"])
+    reward, _ = reference_reward_and_success(*kernel_args(states, touching_table))
+    actual = env.compute_dense_reward(None, None, dict(success=success, touching_table=touching_table))
+    # the reference gives 3 to the envs that succeed in the states, but this info says none did
+    _, state_success = reference_reward_and_success(*kernel_args(states, touching_table))
+    assert torch.equal(actual[~state_success], reward[~state_success])
+    assert torch.all(actual[state_success] < 3.0)
+    # the info evaluate returned still gives its own reward afterwards
+    expected, _ = reference_reward_and_success(*kernel_args(states, info["touching_table"]))
+    assert torch.equal(env.compute_dense_reward(None, None, info), expected)